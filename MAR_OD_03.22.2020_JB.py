@@ -28,10 +28,21 @@
 # configure script
 import geopandas as gpd
 import pandas as pd
+import numpy as np
 import os, sys, time
 # set file path of GOSTnets scripts.  
 sys.path.append(os.path.join(os.path.dirname(os.getcwd()), r'/Users/jobelanger/GOSTnets-master/GOSTnets'))
 import GOSTnets as gn
+import csr_graph as csr
+import snap_index as si
+import contraction as cho
+import facility_update as fu
+import facility_siting as fsite
+import isochrones as iso
+import walk_model as wm
+import od_engine as ode
+import od_store as ods
+import aggregate as agg
 import networkx as nx
 import osmnx as ox
 from shapely.ops import unary_union
@@ -51,8 +62,8 @@ outPth = r'/Users/jobelanger/GOSTnets-master/morocco/outputs'
 # In[ ]:
 
 
-# import G_time from previous script
-G = nx.read_gpickle(r'/Users/jobelanger/GOSTnets-master/morocco/G_time.pickle')
+# compiled G_time from previous script, used by the OD calculator
+G_csr = csr.CSRGraph.load(r'/Users/jobelanger/GOSTnets-master/morocco/G_time_csr.npz')
 
 
 # ### import origins and destinations
@@ -114,17 +125,30 @@ schools.head()
 # ### snap origins and destinations to the network 
 # 
 # 
-# now use geopandas pandana_snap to get closest network node associated with the origin and destination nodes. 
+# use the snap index saved with G_time (nodes in UTM 29N, EPSG:32629) to get the closest network node of every
+# origin and destination in one batched query. layers are reprojected from their own CRS, so villages in EPSG:32629
+# and markets / schools in EPSG:4326 can be snapped together. NN_dist is in meters.
 
 # In[ ]:
 
 
-# snap network to villages
-villages = gn.pandana_snap_c(G_time, 
-                           villages, 
-                           source_crs='epsg:32629', 
-                           target_crs='epsg:32629', 
-                           add_dist_to_node_col=True)
+snap_idx = si.SnapIndex.load(r'/Users/jobelanger/GOSTnets-master/morocco/G_time_snap.pickle')
+
+villages, health, markets, schools = snap_idx.snap(villages, health, markets, schools)
+
+
+# ### walking model for villages far from the road network
+# 
+# villages over 5 km from a road get their own node, joined to their 3 nearest road nodes by walking edges at 5 km/h
+# (pass friction_fil to scale walking time by terrain). G_csr becomes the combined walk + drive graph and the far
+# villages' NN points to their own node, so the OD below includes the walking leg.
+
+# In[ ]:
+
+
+G_csr, villages = wm.add_walk_connectors(G_csr, villages, snap_idx, min_dist=5000, walk_speed=5, k=3)
+
+villages.loc[villages.walk_dist > 0].head()
 
 
 # In[ ]:
@@ -146,171 +170,259 @@ villages_ls
 # In[ ]:
 
 
-# snap destination 1: Health
-health = gn.pandana_snap(G_time, 
-                         health, 
-                         source_crs='epsg:32629',
-                         target_crs='epsg:32629', 
-                         add_dist_to_node_col=True)
-
-health.head()
+health_ls = list(set(list(health.NN)))
+health_ls
 
 
 # In[ ]:
 
 
-health_ls = list(set(list(health.NN)))
-health_ls
+markets_ls = list(set(list(markets.NN)))
+markets_ls
 
 
 # In[ ]:
 
 
-# snap destination 2: Markets
-markets = gn.pandana_snap(G_time, 
-                           markets, 
-                           source_crs='epsg:4326', 
-                           target_crs='epsg:4326', 
-                           add_dist_to_node_col=True)
+schools_ls = list(set(list(schools.NN)))
+schools_ls
 
-markets.head()
 
+# ### calculate origin-destination matrices 
+# 
+# run the OD calculator for villages to all three destinations on the compiled graph.
+# the destination sets are merged so each village's shortest-path tree is built once and read off for every service.
+# villages are split into blocks and solved on all cores, set n_workers to limit the number of processes
+# 
+# returns one dataframe with a column per (service, destination) pair, which we will split per service and export to .csv.
 
 # In[ ]:
 
 
-markets_ls = list(set(list(markets.NN)))
-markets_ls
+OD_all = ode.calculate_OD_services(G_csr, 
+                                   villages_ls, 
+                                   {'health': health_ls, 
+                                    'markets': markets_ls, 
+                                    'schools': schools_ls}, 
+                                   fail_value=9999999, 
+                                   n_workers=None)
+
+# check the shape to verify results
+OD_all.shape
 
 
 # In[ ]:
 
 
-# snap destination 3: Schools
-schools = gn.pandana_snap(G_time, 
-                           schools, 
-                           source_crs='epsg:4326', 
-                           target_crs='epsg:4326', 
-                           add_dist_to_node_col=True)
+# use minutes as the measure by dividing every value in the OD matrix by 60, the fail value is kept as it is. 
+OD_all = OD_all.where(OD_all == 9999999, OD_all/60)
 
-schools.head()
+# 'VH' stands for village-to-health, 'VM' village-to-markets, 'VS' village-to-schools
+OD_VHdf = OD_all['health']
+OD_VMdf = OD_all['markets']
+OD_VSdf = OD_all['schools']
 
+OD_VHdf
+
+
+# ### bounded OD within a travel-time cutoff
+# 
+# for dense destination sets only trips up to the cutoff matter. searches stop at the cutoff and only the pairs reached
+# are stored, as a sparse matrix (villages x schools). pairs not stored are further than the cutoff or unreachable.
 
 # In[ ]:
 
 
-schools_ls = list(set(list(schools.NN)))
-schools_ls
+# cutoff in seconds, the unit of the 'time' edge attribute
+cutoff = 120 * 60
 
+OD_VS_bounded = ode.calculate_OD_sparse(G_csr, villages_ls, schools_ls, cutoff)
+OD_VS_bounded = OD_VS_bounded/60
 
-# ### calculate origin-destination matrices 
-# 
-# run gostnets OD calculator for villages to each of the three destinations
+OD_VS_bounded.nnz
+
+
+# ### facility-siting what-ifs with the contraction hierarchy
 # 
-# returns numpy matrix of format o-d with shortest travel time, which we will convert to a pandas dataframe, and then to a .csv.
+# if the contraction hierarchy was built in the prep script, OD matrices for new facility lists are answered from it
+# without searching the whole graph. same output as calculate_OD on G_time. the villages' upward searches are kept
+# after the first query, so every new list (e.g. health_ls plus proposed clinic nodes) only searches upwards from its
+# facilities. the hierarchy is built on the road graph, so villages are queried from their nearest road node (the
+# walking leg of far villages is not included).
 
 # In[ ]:
 
 
-# OD matrix villages to destination 1: Health
-# 'VH' stands for village-to-health
-OD_VH = gn.calculate_OD(G_time, 
-                     villages_ls, 
-                     health_ls, 
-                     fail_value=9999999)
+G_ch = cho.ContractionHierarchy.load(r'/Users/jobelanger/GOSTnets-master/morocco/G_time_ch.npz')
 
-OD
+villages_road_ls = list(set(list(snap_idx.snap(villages)[0].NN)))
+OD_VH_whatif = G_ch.calculate_OD(villages_road_ls, health_ls, fail_value=9999999)
+OD_VH_whatif = np.where(OD_VH_whatif == 9999999, OD_VH_whatif, OD_VH_whatif/60)
 
 
-# In[ ]:
+# ### nearest facility per village
+# 
+# when only the closest facility matters, skip the full OD matrix: one multi-source search from all facilities
+# on the reversed graph returns the shortest time and the nearest facility node for every village.
 
+# In[ ]:
 
-# check the shape to verify results
-OD_VH.shape
 
+NF_VH = ode.nearest_facility(G_csr, villages_ls, health_ls, fail_value=9999999)
+NF_VM = ode.nearest_facility(G_csr, villages_ls, markets_ls, fail_value=9999999)
+NF_VS = ode.nearest_facility(G_csr, villages_ls, schools_ls, fail_value=9999999)
 
-# In[ ]:
+# convert seconds to minutes
+for NF in [NF_VH, NF_VM, NF_VS]:
+    NF['time'] = NF['time'].where(NF['time'] == 9999999, NF['time']/60)
 
+NF_VH.head()
 
-# use minutes as the measure by dividing every value in the OD matrix by 60. 
-# then convert the array to a df.
-OD_VH = OD_VH/60
 
-OD_VHdf = pd.DataFrame(OD_VH, columns=health_ls, index=villages_ls)
+# ### join results back to villages and summarize per commune (phase 8)
+# 
+# villages_ls only keeps each snapped node once. broadcast the nearest facility results back to every village
+# through its NN, name the nearest facility after the health centres snapped to that node, and summarize
+# travel times per commune with population weights. set admin_cols / pop_col to the columns of Tinghir_Villages.
 
-OD_VHdf
+# In[ ]:
 
 
-# In[ ]:
+admin_cols = ['commune']
+pop_col = None
 
+villages_acc = villages
+for name, NF in [('health_', NF_VH), ('markets_', NF_VM), ('schools_', NF_VS)]:
+    villages_acc = agg.broadcast_to_villages(villages_acc, NF, prefix=name)
+villages_acc['health_name'] = villages_acc['health_nearest'].map(agg.node_labels(health, health.columns[0]))
 
-## OD matrix villages to destination 2: Markets/Commune Centers)
-# 'VM' stands for village-to-markets
-OD_VM = gn.calculate_OD(G_time, 
-                     markets_ls, 
-                     health_ls, 
-                     fail_value=9999999)
+commune_stats = {name: agg.accessibility_stats(villages_acc, name + '_time', admin_cols, weight_col=pop_col, 
+                                               thresholds=(30, 60, 120), percentiles=(50, 90))
+                 for name in ['health', 'markets', 'schools']}
+commune_stats = pd.concat(commune_stats, axis=1)
+commune_stats
 
-OD_VM
 
+# ### accessibility surfaces
+# 
+# travel time in minutes from every 100 m cell over Tinghir to the nearest health centre, market and school.
+# each cell walks to one of its nearest network nodes at walk_speed (km/h), then drives. one band per service,
+# written as a tiled, compressed GeoTIFF to open in QGIS.
 
 # In[ ]:
 
 
-OD_VM.shape
+aoi_shp = gpd.read_file(os.path.join(dataPth, 'tinghirP.shp'))
 
+iso.accessibility_raster(G_csr, 
+                         snap_idx, 
+                         {'health': health_ls, 
+                          'markets': markets_ls, 
+                          'schools': schools_ls}, 
+                         aoi_shp, 
+                         os.path.join(outPth, 'tinghir_accessibility_100m.tif'), 
+                         resolution=100, 
+                         walk_speed=5)
 
-# In[ ]:
 
+# ### export OD matrix dataframes to .csv
+# 
+# export OD matrix dataframes to a .csv to view in QGIS and verify with Morocco field team
 
-OD_VM = OD_VM/60
+# In[ ]:
 
-OD_VMdf = pd.DataFrame(OD_VM, columns=markets_ls, index=villages_ls)
 
-OD_VMdf
+# rewrite output path to be Morocco gostnets output folder.
+pth = outPth
+OD_VHdf.to_csv(os.path.join(pth, 'OD_village2health.csv'))
+OD_VMdf.to_csv(os.path.join(pth, 'OD_village2market.csv'))
+OD_VSdf.to_csv(os.path.join(pth, 'OD_village2school.csv'))
+villages_acc.drop(columns='geometry').to_csv(os.path.join(pth, 'villages_accessibility.csv'))
+commune_stats.to_csv(os.path.join(pth, 'commune_accessibility.csv'))
 
 
+# ### interactive facility siting
+# 
+# keep the nearest health facility of every village and update it when a facility is added or removed,
+# instead of re-running the OD over every village. the state is saved so the next session starts from it.
+
 # In[ ]:
 
 
-# OD matrix villages to destination 3: Schools
-# 'VS' stands for village-to-schools
-OD_VS = gn.calculate_OD(G_time, 
-                     schools_ls, 
-                     health_ls, 
-                     fail_value=9999999)
+NF_state = fu.NearestFacilityState.build(G_csr, villages_ls, health_ls)
+
+# e.g. open a clinic at a candidate node / close an existing one:
+# changed = NF_state.add_facility(new_clinic_node)
+# changed = NF_state.remove_facility(health_ls[0])
 
-OD_VS
+NF_state.save(os.path.join(outPth, 'NF_village2health_state.npz'))
+NF_state.to_frame().head()
 
 
+# ### facility siting: where to put k new health centres
+# 
+# candidates here are the village nodes themselves. villages are weighted by the number of villages per snapped node,
+# set weight_col to the population column to weigh by population. minimizes weighted travel time from each village
+# to its nearest health centre, set coverage_time (minutes) to maximize the villages reached within it instead.
+
 # In[ ]:
 
 
-OD_VS.shape
+candidates_ls = villages_ls
 
+# seconds to minutes, the fail value is kept so it matches the fail_value of site_facilities and NF_VH
+T_candidates = fsite.candidate_times(G_csr, candidates_ls, villages_ls, n_workers=None)
+T_candidates = np.where(T_candidates == 9999999, T_candidates, T_candidates/60)
+village_weights = fsite.node_weights(villages, villages_ls, weight_col=None)
 
-# In[ ]:
+new_health = fsite.site_facilities(T_candidates, 
+                                   k=10, 
+                                   weights=village_weights, 
+                                   current=NF_VH['time'].values, 
+                                   coverage_time=None, 
+                                   candidates=candidates_ls)
+new_health
 
 
-OD_VS = O_VS/60
+# ### stream OD results to parquet
+# 
+# long format (origin_id, destination_id, minutes), one folder per service, written block by block while the OD runs.
+# much smaller and faster to load than the dense .csv matrices. set top_k to keep only the k nearest facilities per village.
+# overwrite=True replaces the dataset of an earlier run, without it a non-empty folder is refused.
+
+# In[ ]:
 
-OD_VSdf = pd.DataFrame(OD_VS, columns=schools_ls, index=villages_ls)
 
-OD_VSdf
+ods.write_OD_parquet(G_csr, 
+                     villages_ls, 
+                     {'health': health_ls, 
+                      'markets': markets_ls, 
+                      'schools': schools_ls}, 
+                     os.path.join(pth, 'OD_villages.parquet'), 
+                     top_k=None, 
+                     overwrite=True)
 
 
-# ### export OD matrix dataframes to .csv
+# ### memory-mapped OD matrices
 # 
-# export OD matrix dataframes to a .csv to view in QGIS and verify with Morocco field team
+# for national runs the villages x facilities matrix does not fit in memory as float64. write_OD_memmap writes it
+# block by block into a memory-mapped float32 file (or uint16 whole minutes) with the origin / destination IDs
+# alongside. ODMatrix.open maps it back without reading it, rows / columns are only loaded when sliced.
 
 # In[ ]:
 
 
-# rewrite output path to be Morocco gostnets output folder.
-pth = outPth
-OD_VH.to_file(pth, 'OD_village2health.csv')
-OD_VM.to_file(pth, 'OD_village2market.csv')
-OD_VS.to_file(pth, 'OD_village2school.csv')
+OD_stores = ods.write_OD_memmap(G_csr, 
+                                villages_ls, 
+                                {'health': health_ls, 
+                                 'markets': markets_ls, 
+                                 'schools': schools_ls}, 
+                                os.path.join(pth, 'OD_villages_mm'), 
+                                dtype='float32')
+
+# later, e.g. from the analysis notebook
+OD_VS_mm = ods.ODMatrix.open(os.path.join(pth, 'OD_villages_mm', 'service=schools'))
+OD_VS_mm.to_frame(origins=villages_ls[:10])
 
 
 # In[ ]:
@@ -29,12 +29,24 @@ import os, sys, time
 # set file path of GOSTnets scripts
 sys.path.append(os.path.join(r'/Users/jobelanger/GOSTnets-master/GOSTnets'))
 import GOSTnets as gn
+import csr_graph as csr
+import snap_index as si
+import od_engine as ode
+import od_store as ods
+import graph_store as gs
+import tiled_clean as tcl
+import components as cmp
+import aggregate as agg
+import stage_cache as sc
+import profiling as prf
+import scenarios as scn
+import walk_model as wm
 import networkx as nx
 import osmnx as ox
 from shapely.ops import unary_union
 from shapely.wkt import loads
 from shapely.geometry import LineString, MultiLineString, Point
-import load_osm as losm
+import pbf_ingest as pbf
 
 
 # set file path and load osm.pbf
@@ -45,7 +57,15 @@ outPth = r'/Users/jobelanger/GOSTnets-master/morocco/outputs'
 # osm pbf last downloaded on: [insert date]
 fil = r'morocco-latest.osm.pbf'
 f = os.path.join(pth, 'data', fil)
-mar = losm.OSM_to_network(f)
+# stage cache: every stage below is keyed by a hash of its inputs (PBF checksum, AOI geometry, clean tolerance,
+# UTM EPSG, speedDict) and the stage before it. stages whose inputs have not changed are loaded from the cache,
+# e.g. editing speedDict only re-runs the time conversion and the OD stage, not the network clean.
+cache = sc.StageCache(os.path.join(pth, 'cache'))
+pbf_checksum = cache.file_checksum(f)
+
+# run report: wall / CPU time, peak memory and output sizes of every stage, saved as outputs/run_report.json.
+# set profile_stage to a stage name (e.g. 'clean') to also profile it, profile_mode = 'sample' writes collapsed stacks
+prof = prf.RunProfiler('tinghir', profile_stage = None, profile_mode = 'cprofile', out_dir = outPth)
 
 aoi = r'/Users/jobelanger/GOSTnets-master/mar/tinghirP.shp'
 
@@ -56,11 +76,25 @@ shp_poly = shp.geometry.iloc[0]
 # Check that the shape looks right
 print(shp_poly)
 
-# create G from tinghir roads within AOI
-G = ox.graph_from_polygon(bound, network_type='drive')
+# road types to keep
+accepted_roadTypes = ['residential', 'unclassified', 'track','service','tertiary','road','secondary','primary','trunk','primary_link','trunk_link','tertiary_link','secondary_link']
+
+# load only the tinghir roads from the national pbf: the AOI bounding box and road types are filtered while the
+# pbf is decoded, and only roads intersecting the AOI are kept.
+with prof.stage('ingest') as st:
+    mar = cache.run('ingest', lambda: pbf.OSM_to_network_aoi(f, shp, acceptedRoads = accepted_roadTypes, 
+                                                             tags = ['surface']), 
+                    [pbf_checksum, shp, accepted_roadTypes, ['surface']])
+    st.output(mar.roads_raw)
 
-# save the roads object as a pickle
-gn.save(G, 'mar_unclean', './', pickle=True, nodes=False, edges=True)
+# create G from tinghir roads within AOI
+def aoi_network(mar):
+    mar.generateRoadsGDF(verbose = False)
+    mar.initialReadIn()
+    return mar.network
+with prof.stage('aoi_network') as st:
+    G = cache.run('aoi_network', lambda: aoi_network(mar), [cache.keys['ingest']])
+    st.output(G)
 
 # Clean network and export as "clean" networkx Graph object.
 # set the EPSG code for Morocco (MAR).
@@ -69,6 +103,13 @@ UTMZs = {'MAR':32629}
 # do not adjust. OSM natively comes in ESPG 4326.
 WGS = {'init':'epsg:4326'}
 
+# clean tolerance passed to gn.clean_network
+tolerance = 0.5
+
+# the network is cleaned tile by tile across a process pool (tile edge and overlap in meters)
+tile_size = 50000
+overlap = 5000
+
 # this process can clean multiple networks at once in a loop style
 countries = ['MAR']
 
@@ -84,11 +125,12 @@ for country in countries:
         
     UTM = {'init': 'epsg:%d' % UTMZs[country]}
     
-    G = nx.read_gpickle(os.path.join(data_pth, 'mar_unclean.pickle'))
+    with prof.stage('clean', country = country) as st:
+        G = cache.run('clean', lambda: tcl.clean_network_tiled(G, data_pth, country, UTM, WGS, tolerance, 
+                                                               tile_size = tile_size, overlap = overlap), 
+                      [cache.keys['aoi_network'], country, UTMZs[country], WGS, tolerance, tile_size, overlap])
+        st.output(G)
     
-    G = gn.clean_network(G, data_pth, country, UTM, WGS, 0.5, verbose = False)
-    
-    nx.write_gpickle(G, os.path.join(data_pth, 'mar_clean.pickle'))
     print('\nend: %s' % time.ctime())
     print('\n--- processing complete for: %s ---' % country)
 
@@ -97,26 +139,24 @@ print(G)
 # find the largest subgraph of the network graph. 
 # network analysis will only work correctly on graphs that are fully connected, otherwise there will be error.
 
-# find largest sub graph of your Graph.
-print('G before:')
-print(G.size())
-G_before = G.size()
-largest = max(nx.strongly_connected_components(G), key=len)
-G = nx.induced_subgraph(G, largest).copy()
-print('G after:')
-print(G.size())
-G_after = G.size()
+# find largest sub graph of your Graph. components are labelled on arrays (scipy) and cached, the largest one
+# is kept as a view of G, so the network is not copied.
+G_clean = G
+with prof.stage('largest') as st:
+    comps = cache.run('largest', lambda: cmp.strong_components(G_clean), [cache.keys['clean']])
+    G = comps.subgraph(G_clean)
+    st.output(G)
+print(comps)
 
 # calculate the percent of the network that is completed.
 # analysis will only work correctly on graphs that are connected.
-G_diff = (G_before - G_after)
-G_diffPerc = (G_diff/G_before) * 100
-G_percent = 100 - G_diffPerc
-print(G_diff)
-print(G_diffPerc)
+G_summary = comps.summary()
+print('G before: %d edges' % G_summary['edges_before'])
+print('G after: %d edges' % G_summary['edges_after'])
+G_percent = G_summary['edges_percent_kept']
+print(G_summary['edges_before'] - G_summary['edges_after'])
+print(100 - G_percent)
 print(G_percent)
-# save the largest subgraph
-gn.save(G, 'G_largest', './', pickle=True, nodes=False, edges=True)
 
 
 # convert your network graph (default measurement in length) to a graph mesured in time.
@@ -140,13 +180,23 @@ speedDict = {
 
 
 # convert network to time in minutes. use factor of 1000 to convert from km to meters
-G_time = gn.convert_network_to_time(G, 
-                                    distance_tag = 'length', 
-                                    road_col = 'infra_type', 
-                                    speed_dict = speedDict, 
-                                    factor = 1000)
-# save G_time object as pickle
-gn.save(G_time, 'G_time', './', pickle=True, nodes=False, edges=True)
+with prof.stage('time') as st:
+    G_time = cache.run('time', lambda: gn.convert_network_to_time(G, 
+                                                                   distance_tag = 'length', 
+                                                                   road_col = 'infra_type', 
+                                                                   speed_dict = speedDict, 
+                                                                   factor = 1000), 
+                       [cache.keys['largest'], speedDict, 'length', 'infra_type', 1000])
+    st.output(G_time)
+
+# compile G_time for the OD stage: compressed sparse row arrays (int32 node indices, float32 travel times, node ID mapping)
+with prof.stage('compile') as st:
+    G_csr = csr.compile_graph(G_time, weight = 'time')
+    st.output(G_csr)
+print(G_csr)
+G_csr.save('./G_time_csr.npz')
+# G_time as node / edge parquet files for QA outside python, loaded back with gs.read_graph
+gs.write_graph(G_time, './G_time')
 
 
 
@@ -155,8 +205,7 @@ gn.save(G_time, 'G_time', './', pickle=True, nodes=False, edges=True)
 ###
 
 
-# import G_time from previous script
-G = nx.read_gpickle(r'/Users/jobelanger/GOSTnets-master/morocco/G_time.pickle')
+# G_time and G_csr are already in memory from part 1 (and in the stage cache)
 
 # import origins and destinations
 # next, import origins (Tinghir villages) and destinations (health centres, markets, and schools). 
@@ -190,14 +239,30 @@ schools.head()
 
 
 # ### snap origins and destinations to the network 
-# now use geopandas pandana_snap to get closest network node associated with the origin and destination nodes. 
-
-# snap network to villages
-villages = gn.pandana_snap_c(G_time, 
-                           villages, 
-                           source_crs='epsg:32629', 
-                           target_crs='epsg:32629', 
-                           add_dist_to_node_col=True)
+# use a snap index over the G_time nodes in UTM 29N (EPSG:32629) to get the closest network node of every origin
+# and destination in one batched query. layers are reprojected from their own CRS, NN_dist is in meters.
+# the index is cached with G_time, so it is only rebuilt when G_time changes.
+with prof.stage('snap_index') as st:
+    snap_idx = cache.run('snap_index', lambda: si.build_snap_index(G_time, graph_crs = 'epsg:4326', crs = 'epsg:32629'), 
+                         [cache.keys['time'], 'epsg:32629'])
+
+# villages and facilities that would have snapped into a component dropped by the largest subgraph step.
+# snapping to G_time puts them on the nearest node of the kept component (main_NN), check the distances.
+dropped_snaps = comps.snap_report(si.build_snap_index(G_clean, graph_crs = 'epsg:4326', crs = 'epsg:32629'), 
+                                  villages = villages, health = health, markets = markets, schools = schools)
+print(dropped_snaps.groupby('layer').size())
+
+with prof.stage('snap') as st:
+    villages, health, markets, schools = snap_idx.snap(villages, health, markets, schools)
+    st.output(villages, 'villages')
+    st.output(health, 'health')
+    st.output(markets, 'markets')
+    st.output(schools, 'schools')
+# walking model: villages over 5 km from a road get their own node, joined to their 3 nearest road nodes by walking
+# edges at 5 km/h. G_csr becomes the combined walk + drive graph and far villages' NN points to their own node.
+with prof.stage('walk') as st:
+    G_csr, villages = wm.add_walk_connectors(G_csr, villages, snap_idx, min_dist=5000, walk_speed=5, k=3)
+    st.output(G_csr)
 # two new columns have been created with nearest network node from the node to the graph.
 villages.head()
 # create a list of villages using NN.
@@ -205,98 +270,148 @@ villages.head()
 villages_ls = list(set(list(villages.NN)))
 villages_ls
 
-# snap destination 1: Health
-health = gn.pandana_snap(G_time, 
-                         health, 
-                         source_crs='epsg:32629',
-                         target_crs='epsg:32629', 
-                         add_dist_to_node_col=True)
-
-health.head()
 health_ls = list(set(list(health.NN)))
 health_ls
 
-# snap destination 2: Markets
-markets = gn.pandana_snap(G_time, 
-                           markets, 
-                           source_crs='epsg:4326', 
-                           target_crs='epsg:4326', 
-                           add_dist_to_node_col=True)
-
-markets.head()
 markets_ls = list(set(list(markets.NN)))
 markets_ls
 
-# snap destination 3: Schools
-schools = gn.pandana_snap(G_time, 
-                           schools, 
-                           source_crs='epsg:4326', 
-                           target_crs='epsg:4326', 
-                           add_dist_to_node_col=True)
-
-schools.head()
 schools_ls = list(set(list(schools.NN)))
 schools_ls
 
 # ### calculate origin-destination matrices
-# run gostnets OD calculator for villages to each of the three destinations
-# returns numpy matrix of format o-d with shortest travel time, which we will convert to a pandas dataframe, and then to a .csv.
-
-# OD matrix villages to destination 1: Health
-# 'VH' stands for village-to-health
-OD_VH = gn.calculate_OD(G_time, 
-                     villages_ls, 
-                     health_ls, 
-                     fail_value=9999999)
-
-OD_VH
+# run the OD calculator for villages to all three destinations on the compiled graph.
+# the destination sets are merged so each village's shortest-path tree is built once and read off for every service.
+# villages are split into blocks and solved on all cores, set n_workers to limit the number of processes
+# returns one dataframe with a column per (service, destination) pair, which we will split per service and export to .csv.
+with prof.stage('od') as st:
+    OD_all = ode.calculate_OD_services(G_csr, 
+                                       villages_ls, 
+                                       {'health': health_ls, 
+                                        'markets': markets_ls, 
+                                        'schools': schools_ls}, 
+                                       fail_value=9999999, 
+                                       n_workers=None)
+    # villages x destinations per service in the run report
+    for name in ['health', 'markets', 'schools']:
+        st.output(OD_all[name], name)
 # check the shape to verify results
-OD_VH.shape
-
-
-# use minutes as the measure by dividing every value in the OD matrix by 60. 
-# then convert the array to a df.
-OD_VH = OD_VH/60
-OD_VHdf = pd.DataFrame(OD_VH, columns=health_ls, index=villages_ls)
+OD_all.shape
+
+# use minutes as the measure by dividing every value in the OD matrix by 60, the fail value is kept as it is. 
+OD_all = OD_all.where(OD_all == 9999999, OD_all/60)
+# 'VH' stands for village-to-health, 'VM' village-to-markets, 'VS' village-to-schools
+OD_VHdf = OD_all['health']
+OD_VMdf = OD_all['markets']
+OD_VSdf = OD_all['schools']
 OD_VHdf
 
-
-## OD matrix villages to destination 2: Markets/Commune Centers)
-# 'VM' stands for village-to-markets
-OD_VM = gn.calculate_OD(G_time, 
-                     markets_ls, 
-                     health_ls, 
-                     fail_value=9999999)
-OD_VM
-OD_VM.shape
-
-
-OD_VM = OD_VM/60
-OD_VMdf = pd.DataFrame(OD_VM, columns=markets_ls, index=villages_ls)
-OD_VMdf
-
-# OD matrix villages to destination 3: Schools
-# 'VS' stands for village-to-schools
-OD_VS = gn.calculate_OD(G_time, 
-                     schools_ls, 
-                     health_ls, 
-                     fail_value=9999999)
-OD_VS
-OD_VS.shape
-
-
-OD_VS = O_VS/60
-OD_VSdf = pd.DataFrame(OD_VS, columns=schools_ls, index=villages_ls)
-OD_VSdf
+# bounded OD within a travel-time cutoff
+# for dense destination sets only trips up to the cutoff matter. searches stop at the cutoff and only the pairs reached
+# are stored, as a sparse matrix (villages x schools). pairs not stored are further than the cutoff or unreachable.
+cutoff = 120 * 60 # seconds, the unit of the 'time' edge attribute
+OD_VS_bounded = ode.calculate_OD_sparse(G_csr, villages_ls, schools_ls, cutoff)
+OD_VS_bounded = OD_VS_bounded/60
+OD_VS_bounded.nnz
+
+# speed scenarios
+# edge lengths and infra_type are stored once and the travel times of every scenario are derived in one step,
+# then the OD runs on each scenario over the same topology. add scenarios by copying speedDict and editing speeds.
+# G_scenarios is the road graph only: the walking connector nodes of far villages are not in it, so villages are
+# snapped to their nearest road node again (the walking leg is left out of the scenario times) rather than using
+# villages_ls. the seasonal cell below uses the same road-node list.
+villages_road_ls = list(set(list(snap_idx.snap(villages)[0].NN)))
+G_scenarios = scn.compile_scenario_graph(G, distance_tag = 'length', road_col = 'infra_type', factor = 1000)
+speedScenarios = {'baseline': speedDict, 
+                  'rainy': dict(speedDict, unclassified=15, road=10, track=5)}
+NF_VH_scenarios = scn.run_scenarios(G_scenarios, speedScenarios, ode.nearest_facility, villages_road_ls, health_ls)
+NF_VH_scenarios['rainy'].head()
+
+# seasonal accessibility
+# speeds per season and road surface (osm surface tag, grouped into paved / unpaved), 0 kmph closes the road.
+# returns villages x (service, season) nearest facility times in one run, seasons with the same speeds are solved once.
+# like the speed scenarios, villages are taken at their road node (villages_road_ls), the walking connector nodes
+# are not in G_seasons.
+G_seasons = scn.compile_scenario_graph(G, distance_tag = 'length', road_col = 'infra_type', factor = 1000, 
+                                       surface_lookup = mar.tags['surface'])
+seasonProfiles = scn.SpeedProfiles.from_dicts({'dry': speedDict, 
+                                               'rainy': dict(speedDict, track={'paved': 20, 'unpaved': 5, 'default': 10}, 
+                                                             unclassified={'paved': 30, 'unpaved': 10}), 
+                                               'snow': dict(speedDict, track=0, unclassified={'paved': 20, 'unpaved': 0})})
+seasonCalendar = {'jan': 'snow', 'feb': 'snow', 'mar': 'rainy', 'apr': 'rainy', 'may': 'dry', 'jun': 'dry', 
+                  'jul': 'dry', 'aug': 'dry', 'sep': 'dry', 'oct': 'rainy', 'nov': 'rainy', 'dec': 'snow'}
+NF_seasons = scn.seasonal_accessibility(G_seasons, seasonProfiles, villages_road_ls, 
+                                        {'health': health_ls, 'markets': markets_ls, 'schools': schools_ls}, 
+                                        fail_value=9999999, calendar=seasonCalendar)
+NF_seasons = NF_seasons.where(NF_seasons == 9999999, NF_seasons/60)
+NF_seasons['health'].head()
+
+# nearest facility per village
+# when only the closest facility matters, skip the full OD matrix: one multi-source search from all facilities
+# on the reversed graph returns the shortest time and the nearest facility node for every village.
+with prof.stage('nearest_facility') as st:
+    NF_VH = ode.nearest_facility(G_csr, villages_ls, health_ls, fail_value=9999999)
+    NF_VM = ode.nearest_facility(G_csr, villages_ls, markets_ls, fail_value=9999999)
+    NF_VS = ode.nearest_facility(G_csr, villages_ls, schools_ls, fail_value=9999999)
+    st.output(NF_VH, 'health')
+    st.output(NF_VM, 'markets')
+    st.output(NF_VS, 'schools')
+for NF in [NF_VH, NF_VM, NF_VS]:
+    NF['time'] = NF['time'].where(NF['time'] == 9999999, NF['time']/60)
+NF_VH.head()
+
+# join results back to villages and summarize per commune (phase 8)
+# villages_ls only keeps each snapped node once: broadcast the nearest facility results back to every village
+# through its NN and summarize travel times per commune with population weights.
+# set admin_cols / pop_col to the columns of Tinghir_Villages.
+admin_cols = ['commune']
+pop_col = None
+villages_acc = villages
+for name, NF in [('health_', NF_VH), ('markets_', NF_VM), ('schools_', NF_VS)]:
+    villages_acc = agg.broadcast_to_villages(villages_acc, NF, prefix=name)
+commune_stats = pd.concat({name: agg.accessibility_stats(villages_acc, name + '_time', admin_cols, weight_col=pop_col)
+                           for name in ['health', 'markets', 'schools']}, axis=1)
+commune_stats
 
 # ### export OD matrix dataframes to .csv
 # 
 # export OD matrix dataframes to a .csv to view in QGIS and verify with Morocco field team
 # rewrite output path to be Morocco gostnets output folder.
 pth = outPth
-OD_VH.to_file(pth, 'OD_village2health.csv')
-OD_VM.to_file(pth, 'OD_village2market.csv')
-OD_VS.to_file(pth, 'OD_village2school.csv')
+with prof.stage('export_csv') as st:
+    OD_VHdf.to_csv(os.path.join(pth, 'OD_village2health.csv'))
+    OD_VMdf.to_csv(os.path.join(pth, 'OD_village2market.csv'))
+    OD_VSdf.to_csv(os.path.join(pth, 'OD_village2school.csv'))
+    villages_acc.drop(columns='geometry').to_csv(os.path.join(pth, 'villages_accessibility.csv'))
+    commune_stats.to_csv(os.path.join(pth, 'commune_accessibility.csv'))
+    NF_seasons.to_csv(os.path.join(pth, 'villages_seasonal_accessibility.csv'))
+    st.output(villages_acc)
+
+# stream OD results to parquet: long format (origin_id, destination_id, minutes), one folder per service,
+# written block by block while the OD runs. set top_k to keep only the k nearest facilities per village.
+# overwrite=True replaces the dataset of an earlier run, without it a non-empty folder is refused.
+with prof.stage('export_parquet') as st:
+    ods.write_OD_parquet(G_csr, 
+                         villages_ls, 
+                         {'health': health_ls, 
+                          'markets': markets_ls, 
+                          'schools': schools_ls}, 
+                         os.path.join(pth, 'OD_villages.parquet'), 
+                         top_k=None, 
+                         overwrite=True)
+
+# national runs: memory-mapped float32 matrices written block by block, opened later with ods.ODMatrix.open
+with prof.stage('export_memmap') as st:
+    OD_stores = ods.write_OD_memmap(G_csr, 
+                                    villages_ls, 
+                                    {'health': health_ls, 
+                                     'markets': markets_ls, 
+                                     'schools': schools_ls}, 
+                                    os.path.join(pth, 'OD_villages_mm'))
+
+# run report: which stage took the time / memory
+prof.save(os.path.join(outPth, 'run_report.json'))
+pd.DataFrame(prof.stages).set_index('stage')[['wall_s', 'cpu_s', 'cpu_children_s', 'peak_rss_mb']]
 
 # files can be found at: 
 print(pth)
\ No newline at end of file
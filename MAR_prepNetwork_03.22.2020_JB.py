@@ -32,12 +32,19 @@ import os, sys, time
 # set file path of GOSTnets scripts
 sys.path.append(os.path.join(r'/Users/jobelanger/GOSTnets-master/GOSTnets'))
 import GOSTnets as gn
+import csr_graph as csr
+import snap_index as si
+import contraction as cho
+import scenarios as scn
+import graph_store as gs
+import tiled_clean as tcl
+import components as cmp
 import networkx as nx
 import osmnx as ox
 from shapely.ops import unary_union
 from shapely.wkt import loads
 from shapely.geometry import LineString, MultiLineString, Point
-import load_osm as losm
+import pbf_ingest as pbf
 
 
 # set file path and load osm.pbf
@@ -48,7 +55,6 @@ outPth = r'/Users/jobelanger/GOSTnets-master/morocco/outputs'
 # osm pbf last downloaded on: [insert date]
 fil = r'morocco-latest.osm.pbf'
 f = os.path.join(pth, 'data', fil)
-mar = losm.OSM_to_network(f)
 
 
 aoi = r'/Users/jobelanger/GOSTnets-master/mar/tinghirP.shp'
@@ -60,11 +66,22 @@ shp_poly = shp.geometry.iloc[0]
 # Check that the shape looks right
 print(shp_poly)
 
+# road types to keep
+accepted_roadTypes = ['residential', 'unclassified', 'track','service','tertiary','road','secondary','primary','trunk','primary_link','trunk_link','tertiary_link','secondary_link']
+
+# load only the tinghir roads from the national pbf: the AOI bounding box and road types are filtered while the
+# pbf is decoded, and only roads intersecting the AOI are kept.
+mar = pbf.OSM_to_network_aoi(f, shp, acceptedRoads = accepted_roadTypes)
+print(mar.roads_raw.infra_type.value_counts())
+
 # create G from tinghir roads within AOI
-G = ox.graph_from_polygon(bound, network_type='drive')
+mar.generateRoadsGDF(verbose = False)
+mar.initialReadIn()
+G = mar.network
 
-# save the roads object as a pickle
-gn.save(G, 'mar_unclean', './', pickle=True, nodes=False, edges=True)
+# save the roads object as node / edge parquet files; clean_countries reads it back, so check that
+# infra_type / osm_id (lists on merged edges) and the node IDs come back unchanged
+gs.write_graph(G, './mar_unclean', verify = True)
 
 
 # ## Step 2: Clean network and export as "clean" networkx Graph object.
@@ -74,29 +91,33 @@ UTMZs = {'MAR':32629}
 # do not adjust. OSM natively comes in ESPG 4326.
 WGS = {'init':'epsg:4326'}
 
-# this process can clean multiple networks at once in a loop style
+# this process can clean multiple networks at once: countries are cleaned concurrently, one process each
 countries = ['MAR']
 
+# clean tile by tile across a process pool: tile edge and overlap in meters. set tile_size = None to run
+# gn.clean_network over the whole network in one go. the overlap should be longer than the longest road
+# segment between junctions.
+tile_size = 50000
+overlap = 5000
+
 # adjust to your input filepath:
 base_pth = os.path.join(os.path.dirname(os.getcwd()), r'/Users/jobelanger/GOSTnets-master/morocco')
 data_pth = os.path.join(base_pth, 'outputs')
 
-for country in countries:
-    print('\n--- processing for: %s ---\n' % country)
-    print('start: %s\n' % time.ctime())
+print('start: %s\n' % time.ctime())
+print('Outputs can be found at: %s\n' % (data_pth))
 
-    print('Outputs can be found at: %s\n' % (data_pth))
-        
-    UTM = {'init': 'epsg:%d' % UTMZs[country]}
-    
-    G = nx.read_gpickle(os.path.join(data_pth, 'mar_unclean.pickle'))
-    
-    G = gn.clean_network(G, data_pth, country, UTM, WGS, 0.5, verbose = False)
-    
-    nx.write_gpickle(G, os.path.join(data_pth, 'mar_clean.pickle'))
-    print('\nend: %s' % time.ctime())
+graphs = {country: gs.read_graph(os.path.join(data_pth, '%s_unclean' % country.lower())).to_networkx() 
+          for country in countries}
+
+cleaned = tcl.clean_countries(graphs, data_pth, UTMZs, WGS, 0.5, tile_size = tile_size, overlap = overlap)
+
+for country, G in cleaned.items():
+    gs.write_graph(G, os.path.join(data_pth, '%s_clean' % country.lower()))
     print('\n--- processing complete for: %s ---' % country)
+print('\nend: %s' % time.ctime())
 
+G = cleaned['MAR']
 
 print(G)
 
@@ -104,28 +125,36 @@ print(G)
 # ### find the largest subgraph of the network graph. 
 # network analysis will only work correctly on graphs that are fully connected, otherwise there will be error.
 
-# find largest sub graph of your Graph.
-print('G before:')
-print(G.size())
-G_before = G.size()
-largest = max(nx.strongly_connected_components(G), key=len)
-G = nx.induced_subgraph(G, largest).copy()
-print('G after:')
-print(G.size())
-G_after = G.size()
+# find largest sub graph of your Graph. components are labelled on arrays (scipy) and the largest one is kept
+# as a view of G, so the network is not copied.
+G_clean = G
+G, comps = cmp.largest_component(G_clean)
+print(comps)
 
 # calculate the percent of the network that is completed.
 # analysis will only work correctly on graphs that are connected.
-G_diff = (G_before - G_after)
-G_diffPerc = (G_diff/G_before) * 100
-G_percent = 100 - G_diffPerc
-print(G_diff)
-print(G_diffPerc)
+G_summary = comps.summary()
+print('G before: %d edges' % G_summary['edges_before'])
+print('G after: %d edges' % G_summary['edges_after'])
+G_percent = G_summary['edges_percent_kept']
+print(G_summary['edges_before'] - G_summary['edges_after'])
+print(100 - G_percent)
 print(G_percent)
 
+# villages and facilities whose nearest node is in a dropped component, with the nearest node of the kept
+# component to re-snap them to
+snap_idx_clean = si.build_snap_index(G_clean, graph_crs = 'epsg:4326', crs = 'epsg:32629')
+dropped_snaps = comps.snap_report(snap_idx_clean, 
+                                  villages = gpd.read_file(os.path.join(dataPth, 'Tinghir_Villages.shp')), 
+                                  health = gpd.read_file(os.path.join(dataPth, 'Tinghir_Health.shp')), 
+                                  markets = gpd.read_file(os.path.join(dataPth, 'tinghirMarketsP.shp')), 
+                                  schools = gpd.read_file(os.path.join(dataPth, 'tinghirSchoolP.shp')))
+print(dropped_snaps.groupby('layer').size())
+dropped_snaps.to_csv(os.path.join(outPth, 'dropped_component_snaps.csv'))
+
 
 # save the largest subgraph
-gn.save(G, 'G_largest', './', pickle=True, nodes=False, edges=True)
+gs.write_graph(G, './G_largest')
 
 
 # ### convert your network graph (default measurement in length) to a graph mesured in time.
@@ -157,8 +186,48 @@ G_time = gn.convert_network_to_time(G,
                                     factor = 1000)
 
 
-# save G_time object as pickle
-gn.save(G_time, 'G_time', './', pickle=True, nodes=False, edges=True)
+# save G_time as node / edge parquet files (id, x, y / u, v, length, infra_type, time, ...), readable in QGIS.
+# gs.read_graph loads them back as arrays, the networkx graph is only rebuilt with .to_networkx()
+gs.write_graph(G_time, './G_time')
+
+
+# ### compile G_time for the OD stage
+# 
+# freeze G_time into compressed sparse row arrays (int32 node indices, float32 travel times, node ID mapping).
+# the OD script runs on this instead of the networkx dict-of-dicts.
+G_csr = csr.compile_graph(G_time, weight = 'time')
+print(G_csr)
+G_csr.save('./G_time_csr.npz')
+
+
+# ### build the snap index for G_time
+# 
+# nearest-node search tree over the G_time nodes in UTM 29N (EPSG:32629), saved with the graph so the OD script
+# snaps all origin and destination layers without rebuilding it.
+snap_idx = si.build_snap_index(G_time, graph_crs = 'epsg:4326', crs = 'epsg:32629')
+print(snap_idx)
+snap_idx.save('./G_time_snap.pickle')
+
+
+# ### optional: contraction hierarchy for facility-siting what-ifs
+# 
+# preprocess G_time once so OD queries for new facility lists (new clinics, proposed schools) only search a small
+# part of the graph. the build is pure python and takes a while on large graphs (about 6 minutes for 40,000 nodes),
+# so it is off by default.
+build_ch = False
+if build_ch:
+    G_ch = cho.build_contraction_hierarchy(G_csr, verbose = True)
+    print(G_ch)
+    G_ch.save('./G_time_ch.npz')
+
+
+# ### store the topology for speed scenarios
+# 
+# edge lengths and infra_type are stored once, so speed scenarios (rainy season, road upgrades) can be swept
+# without re-running convert_network_to_time. see scenarios.run_scenarios.
+G_scenarios = scn.compile_scenario_graph(G, distance_tag = 'length', road_col = 'infra_type', factor = 1000)
+print(G_scenarios)
+G_scenarios.save('./G_scenarios.npz')
 
 
 # ### now move on to the next script to run the OD matrices: "MAR_OD_03.22.2020_JB"
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Morocco Accessibility Model: aggregation (phase 8)
+#
+# the OD stage works on de-duplicated snapped nodes (villages_ls). These functions put the per-node results
+# back on every village through the villages -> NN mapping with vectorized indexing, and summarize them
+# per commune / province with population weights in one grouped pass, without python loops over villages.
+
+import numpy as np
+import pandas as pd
+
+
+def broadcast_to_villages(villages, node_results, node_col = 'NN', prefix = ''):
+    """
+    Function for joining per-node results back to every village
+
+    :param villages: the snapped villages (Geo)DataFrame, several villages can share a node
+    :param node_results: DataFrame indexed by node, e.g. nearest_facility output or OD_VHdf
+    :param node_col: villages column holding the snapped node
+    :param prefix: prefix for the joined column names, e.g. 'health_'
+    :returns: a copy of villages with the node_results columns added, missing (NaN / None / <NA>) for villages
+              whose node has no result. Integer and boolean columns keep their dtype, as nullable Int64 / boolean
+              when some villages are missing
+    """
+    villages = villages.copy()
+    pos = node_results.index.get_indexer(villages[node_col].values)
+    found = pos >= 0
+    for col in node_results.columns:
+        values = node_results[col].to_numpy()
+        if found.all():
+            out = values[pos]
+        elif values.dtype.kind in 'iub':
+            out = pd.array(values[pos], dtype = 'Int64' if values.dtype.kind in 'iu' else 'boolean')
+            out[~found] = pd.NA
+        else:
+            out = np.empty(len(villages), dtype = values.dtype if values.dtype.kind in 'fO' else float)
+            out[found] = values[pos[found]]
+            out[~found] = None if out.dtype.kind == 'O' else np.nan
+        villages['%s%s' % (prefix, col)] = out
+    return villages
+
+
+def node_labels(layer, name_col, node_col = 'NN', sep = '; '):
+    """
+    Function for naming snapped nodes after the features snapped to them, e.g. the health centre names
+
+    :param layer: a snapped (Geo)DataFrame, e.g. health
+    :param name_col: column holding the feature name
+    :param node_col: column holding the snapped node
+    :param sep: separator when several features share a node
+    :returns: a Series of names indexed by node
+    """
+    return layer.groupby(node_col)[name_col].agg(lambda s: sep.join(str(v) for v in s))
+
+
+def _group_first(mask, starts, n):
+    # position of the first True of every group in sorted order, n when none
+    pos = np.where(mask, np.arange(len(mask)), n)
+    return np.minimum.reduceat(pos, starts)
+
+
+def accessibility_stats(villages, time_col, by, weight_col = None, thresholds = (30, 60, 120),
+                        percentiles = (50, 90), fail_value = 9999999):
+    """
+    Function for population-weighted accessibility statistics per admin unit
+
+    :param villages: villages DataFrame with a travel time column (e.g. from broadcast_to_villages)
+    :param time_col: column holding the travel time, in minutes
+    :param by: column (or list of columns) to group by, e.g. 'commune' or ['province', 'commune']
+    :param weight_col: population column, None weighs villages equally
+    :param thresholds: report the weighted share of villages beyond each of these times
+    :param percentiles: weighted percentiles of travel time to report
+    :param fail_value: times at or above this (or NaN) count as unreachable: excluded from the mean, beyond every
+                       threshold and at the top of the percentiles
+    :returns: a DataFrame indexed by group with columns villages, population, mean, p<q>, share_over_<t>,
+              share_unreachable. Villages with a missing admin key are kept as their own (NaN) group
+    """
+    by = [by] if isinstance(by, str) else list(by)
+    t = villages[time_col].values.astype(float)
+    w = np.ones(len(villages)) if weight_col is None else villages[weight_col].fillna(0).values.astype(float)
+    unreachable = ~np.isfinite(t) | (t >= fail_value)
+    t = np.where(unreachable, np.inf, t)
+
+    grouped = villages.groupby(by, sort = True, dropna = False)
+    codes = grouped.ngroup().values
+    n_groups = grouped.ngroups
+    index = grouped.size().index
+
+    total = np.bincount(codes, weights = w, minlength = n_groups)
+    reach_w = np.where(unreachable, 0, w)
+    reach_t = np.where(unreachable, 0, t)
+    reach_total = np.bincount(codes, weights = reach_w, minlength = n_groups)
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        stats = {'villages': np.bincount(codes, minlength = n_groups),
+                 'population': total,
+                 'mean': np.bincount(codes, weights = reach_w * reach_t, minlength = n_groups) / reach_total}
+
+        # weighted percentiles: sort by (group, time) and find where the cumulative weight crosses q
+        order = np.lexsort((t, codes))
+        cs, ts, ws = codes[order], t[order], w[order]
+        starts = np.flatnonzero(np.r_[True, cs[1:] != cs[:-1]])
+        cum = np.cumsum(ws)
+        group_offset = np.repeat(cum[starts] - ws[starts], np.diff(np.r_[starts, len(cs)]))
+        frac = (cum - group_offset) / total[cs]
+        present = cs[starts]
+        for q in percentiles:
+            first = _group_first(frac >= q / 100., starts, len(cs))
+            p = np.full(n_groups, np.nan)
+            ok = first < len(cs)
+            p[present[ok]] = ts[first[ok]]
+            stats['p%g' % q] = p
+
+        for x in thresholds:
+            stats['share_over_%g' % x] = np.bincount(codes, weights = w * (t > x), minlength = n_groups) / total
+        stats['share_unreachable'] = np.bincount(codes, weights = w * unreachable, minlength = n_groups) / total
+
+    return pd.DataFrame(stats, index = index)
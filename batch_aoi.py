@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Morocco Accessibility Model: batch AOIs
+#
+# runs the OD stage for many provinces over one national graph. The national network is built, cleaned, timed
+# and compiled once; each province then takes the nodes inside its polygon, buffered by a margin, as a CSR
+# subgraph. The nodes are found through a KD-tree over the projected node coordinates, so there is no OSM query
+# and no networkx copy per province. The buffer lets villages near a border reach facilities on the other side.
+# Every village is assigned to exactly one province (the polygon holding it, else the nearest one), so the
+# merged results have one row per village and border villages are not counted twice. Provinces are solved
+# across a process pool.
+
+import multiprocessing as mp
+import os
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+import aggregate as agg
+import od_engine as ode
+import od_store as ods
+from snap_index import build_snap_index
+
+
+def assign_provinces(points, provinces, name_col, crs = 'epsg:32629'):
+    """
+    Function for assigning every point to exactly one province
+
+    a point inside (or on the edge of) several polygons gets the first of them, a point outside every polygon
+    gets the nearest one.
+
+    :param points: GeoDataFrame of points, e.g. villages
+    :param provinces: GeoDataFrame of province polygons
+    :param name_col: provinces column holding the province name
+    :param crs: projected CRS used to find the nearest province
+    :returns: a Series of province names aligned with points
+    """
+    pts = gpd.GeoDataFrame(geometry = points.geometry.values, crs = points.crs).to_crs(crs)
+    polys = provinces[[name_col, 'geometry']].to_crs(crs).reset_index(drop = True)
+
+    hit = gpd.sjoin(pts, polys, how = 'inner', predicate = 'intersects')
+    hit = hit[~hit.index.duplicated(keep = 'first')]
+    out = pd.Series(None, index = range(len(pts)), dtype = object)
+    out[hit.index] = hit[name_col].values
+
+    missing = out.isnull().values
+    if missing.any():
+        near = gpd.sjoin_nearest(pts[missing], polys, how = 'left')
+        near = near[~near.index.duplicated(keep = 'first')]
+        out[near.index] = near[name_col].values
+    out.index = points.index
+    return out
+
+
+def province_mask(snap_idx, polygon, buffer = 20000):
+    """
+    Function for the nodes of one province subgraph
+
+    :param snap_idx: a SnapIndex over the graph nodes, in the graph node order
+    :param polygon: province polygon in the CRS of snap_idx
+    :param buffer: margin around the polygon in CRS units (meters)
+    :returns: boolean node mask
+    """
+    import shapely
+
+    area = polygon.buffer(buffer) if buffer else polygon
+    minx, miny, maxx, maxy = area.bounds
+    cx, cy = (minx + maxx) / 2., (miny + maxy) / 2.
+    candidates = np.asarray(snap_idx.tree.query_ball_point([cx, cy], np.hypot(maxx - cx, maxy - cy)),
+                            dtype = np.int64)
+    mask = np.zeros(len(snap_idx.node_ids), dtype = bool)
+    if len(candidates):
+        xy = snap_idx.tree.data[candidates]
+        mask[candidates[shapely.contains_xy(area, xy[:, 0], xy[:, 1])]] = True
+    return mask
+
+
+# state shared with province worker processes, inherited on fork or sent once per worker
+_batch_state = {}
+
+
+def _init_batch_worker(state):
+    if state is not None:
+        _batch_state.update(state)
+
+
+def _run_province(name):
+    st = _batch_state
+    G = st['G']
+    mask = province_mask(st['snap_idx'], st['polygons'][name], st['buffer'])
+    # the province's own villages always stay in, even when they snap beyond the buffer
+    origins = st['origins'][name]
+    o_idx = G.index(origins)
+    mask[o_idx[o_idx >= 0]] = True
+    sub = G.subgraph(mask)
+
+    results, info = {}, {'province': name, 'nodes': sub.n_nodes, 'edges': sub.n_edges, 'origins': len(origins)}
+    dests = {}
+    for service, nodes in st['services'].items():
+        d_idx = G.index(nodes)
+        dests[service] = [n for n, i in zip(nodes, d_idx) if i >= 0 and mask[i]]
+        NF = ode.nearest_facility(sub, origins, dests[service], fail_value = st['fail_value'], cutoff = st['cutoff'])
+        results[service] = NF
+        info['%s_destinations' % service] = len(dests[service])
+        info['%s_unreached' % service] = int((NF['time'] == st['fail_value']).sum())
+
+    if st['od_pth'] is not None:
+        ods.write_OD_parquet(sub, origins, dests, os.path.join(st['od_pth'], 'province=%s' % name),
+                             cutoff = st['cutoff'], max_bytes = st['max_bytes'])
+    return name, results, info
+
+
+def run_provinces(G, provinces, villages, services, name_col = 'NAME', buffer = 20000, graph_crs = 'epsg:4326',
+                  crs = 'epsg:32629', fail_value = 9999999, cutoff = None, n_workers = None, od_pth = None,
+                  overwrite = False, max_bytes = ode.OD_BLOCK_BYTES):
+    """
+    Function for the nearest facility of every village, province by province over one national graph
+
+    :param G: the national CSRGraph (compiled G_time, optionally with walk connectors), with node coordinates
+    :param provinces: GeoDataFrame of province polygons
+    :param villages: snapped villages (NN column) over the whole country
+    :param services: dict of service name: snapped facility layer, or list of facility nodes
+    :param name_col: provinces column holding the province name
+    :param buffer: margin in meters around each province, facilities and roads within it are used
+    :param graph_crs: CRS of the node coordinates of G
+    :param crs: projected CRS the provinces are buffered in
+    :param fail_value: the value to return if no facility can be reached
+    :param cutoff: optional maximum travel time (same units as the edge weights)
+    :param n_workers: number of worker processes, defaults to os.cpu_count()
+    :param od_pth: if set, the province OD matrices are also written there as Parquet,
+                   partitioned province=<name>/service=<service>
+    :param overwrite: replace od_pth when it already holds files, otherwise a non-empty od_pth raises a ValueError
+    :param max_bytes: memory budget in bytes of the OD blocks written to od_pth, split between the workers
+    :returns: (a copy of villages with 'province' and '<service>_time' / '<service>_nearest' columns,
+               a DataFrame with one row per province: nodes, edges, origins, destinations and unreached villages)
+    """
+    if od_pth is not None:
+        # cleared once for the whole dataset, so provinces dropped since the last run do not linger either
+        ods.prepare_out_pth(od_pth, overwrite = overwrite)
+    snap_idx = build_snap_index(G, graph_crs = graph_crs, crs = crs)
+    villages = villages.copy()
+    villages['province'] = assign_provinces(villages, provinces, name_col, crs = crs).values
+
+    polys = provinces.to_crs(crs)
+    polygons = {}
+    for name, geom in zip(polys[name_col], polys.geometry):
+        polygons[name] = polygons[name].union(geom) if name in polygons else geom
+    origins = {name: list(dict.fromkeys(v.NN)) for name, v in villages.groupby('province')}
+    names = [n for n in polygons if n in origins]
+    services = {s: list(dict.fromkeys(layer.NN)) if hasattr(layer, 'NN') else list(dict.fromkeys(layer))
+                for s, layer in services.items()}
+
+    # provinces with the most villages first, so the pool is not left waiting on a large one at the end
+    order = sorted(names, key = lambda n: -len(origins[n]))
+    n_workers = min(n_workers or os.cpu_count() or 1, max(1, len(order)))
+    state = dict(G = G, snap_idx = snap_idx, polygons = polygons, buffer = buffer, origins = origins,
+                 services = services, fail_value = fail_value, cutoff = cutoff, od_pth = od_pth,
+                 max_bytes = max_bytes // n_workers)
+
+    if n_workers == 1:
+        _batch_state.update(state)
+        try:
+            results = [_run_province(n) for n in order]
+        finally:
+            _batch_state.clear()
+    else:
+        if 'fork' in mp.get_all_start_methods():
+            ctx = mp.get_context('fork')
+            _batch_state.update(state)
+            initargs = (None,)
+        else:
+            ctx = mp.get_context()
+            initargs = (state,)
+        try:
+            with ctx.Pool(n_workers, initializer = _init_batch_worker, initargs = initargs) as pool:
+                results = list(pool.imap_unordered(_run_province, order))
+        finally:
+            _batch_state.clear()
+
+    # merge: each village takes the results of its own province only
+    parts = []
+    for name, res, _ in results:
+        part = villages[villages['province'] == name]
+        for service in services:
+            part = agg.broadcast_to_villages(part, res[service], prefix = service + '_')
+        parts.append(part)
+    merged = pd.concat(parts).reindex(villages.index) if parts else villages
+    summary = pd.DataFrame([info for _, _, info in results]).set_index('province').reindex(names)
+    return merged, summary
@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Morocco Accessibility Model: synthetic benchmarks
+#
+# times the pipeline stages without the Morocco PBF or the Tinghir shapefiles. A jittered grid road network with
+# the attributes of the OSM graphs (length in km, infra_type from the speedDict road types, node x / y in
+# EPSG:4326 around Tinghir) and random village / facility points are generated at increasing sizes, and the time
+# conversion, cleaning, strongly connected component, snapping and OD stages are timed with
+# profiling.RunProfiler. Every stage record is appended to a JSON lines file, compare() lines up the last two
+# runs per size and stage so a slowdown shows as a ratio above 1. The GOSTnets stages (convert_network_to_time,
+# clean_network) are skipped when GOSTnets cannot be imported, cleaning only runs up to clean_max_nodes.
+#
+#     python benchmarks.py --scales 1000 10000 100000 1000000 --out benchmarks.jsonl
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+import networkx as nx
+import geopandas as gpd
+
+import components as cmp
+import od_engine as ode
+import profiling as prf
+import scenarios as scn
+import snap_index as si
+
+# speedDict of the prep script, and the share of each road type in the synthetic network
+SPEED_DICT = {'residential': 30, 'primary': 60, 'primary_link': 55, 'trunk': 40, 'trunk_link': 35,
+              'secondary': 50, 'secondary_link': 45, 'tertiary': 40, 'tertiary_link': 35, 'unclassified': 30,
+              'road': 20, 'crossing': 20, 'living_street': 10}
+ROAD_SHARE = {'residential': 0.3, 'unclassified': 0.25, 'road': 0.1, 'tertiary': 0.1, 'secondary': 0.06,
+              'primary': 0.04, 'trunk': 0.02, 'living_street': 0.05, 'tertiary_link': 0.02, 'secondary_link': 0.02,
+              'primary_link': 0.02, 'trunk_link': 0.01, 'crossing': 0.01}
+
+# Tinghir, and meters per degree there
+ORIGIN = (-5.53, 31.51)
+M_PER_DEG = (111320. * np.cos(np.radians(ORIGIN[1])), 110574.)
+
+
+def synthetic_network(n_nodes, spacing = 250., drop = 0.1, oneway = 0.05, geometry = False, seed = 0):
+    """
+    Function for a synthetic road network shaped like the OSM graphs
+
+    a square grid of about n_nodes jittered nodes, with a share of the grid edges dropped and a share one-way
+    (so there are small strongly connected components to prune).
+
+    :param n_nodes: approximate number of nodes
+    :param spacing: grid spacing in meters
+    :param drop: share of grid edges removed
+    :param oneway: share of the remaining edges only added in one direction
+    :param geometry: also give every edge a straight LineString 'Wkt', as gn.clean_network needs
+    :param seed: random seed
+    :returns: a networkx MultiDiGraph with node x / y (EPSG:4326) and edge length (km), infra_type, osm_id
+    """
+    rng = np.random.default_rng(seed)
+    side = int(np.ceil(np.sqrt(n_nodes)))
+    n = side * side
+    gx, gy = np.meshgrid(np.arange(side), np.arange(side))
+    mx = gx.ravel() * spacing + rng.uniform(-0.3, 0.3, n) * spacing
+    my = gy.ravel() * spacing + rng.uniform(-0.3, 0.3, n) * spacing
+
+    idx = np.arange(n).reshape(side, side)
+    u = np.concatenate([idx[:, :-1].ravel(), idx[:-1, :].ravel()])
+    v = np.concatenate([idx[:, 1:].ravel(), idx[1:, :].ravel()])
+    keep = rng.random(len(u)) >= drop
+    u, v = u[keep], v[keep]
+
+    # km, with a little curvature on top of the straight line
+    length = np.hypot(mx[u] - mx[v], my[u] - my[v]) * rng.uniform(1., 1.2, len(u)) / 1000.
+    roads = np.array(list(ROAD_SHARE))
+    p = np.array(list(ROAD_SHARE.values()))
+    infra = roads[rng.choice(len(roads), len(u), p = p / p.sum())]
+    both = rng.random(len(u)) >= oneway
+
+    G = nx.MultiDiGraph(crs = 'epsg:4326')
+    lon = ORIGIN[0] + mx / M_PER_DEG[0]
+    lat = ORIGIN[1] + my / M_PER_DEG[1]
+    G.add_nodes_from((i, {'x': lon[i], 'y': lat[i]}) for i in range(n))
+    attrs = [{'length': float(length[k]), 'infra_type': str(infra[k]), 'osm_id': k} for k in range(len(u))]
+    if geometry:
+        import shapely
+        lines = shapely.linestrings(np.stack([np.stack([lon[u], lat[u]], 1), np.stack([lon[v], lat[v]], 1)], 1))
+        for a, line in zip(attrs, lines):
+            a['Wkt'] = line
+    G.add_edges_from(zip(u.tolist(), v.tolist(), attrs))
+    G.add_edges_from((v[k], u[k], dict(attrs[k])) for k in np.flatnonzero(both).tolist())
+    return G
+
+
+def synthetic_points(G, n, seed = 0):
+    """
+    Function for random points over the extent of a synthetic network, e.g. villages or facilities
+
+    :param G: a graph from synthetic_network
+    :param n: number of points
+    :param seed: random seed
+    :returns: a GeoDataFrame of points in EPSG:4326
+    """
+    rng = np.random.default_rng(seed)
+    x = np.array([d['x'] for _, d in G.nodes(data = True)])
+    y = np.array([d['y'] for _, d in G.nodes(data = True)])
+    px = rng.uniform(x.min(), x.max(), n)
+    py = rng.uniform(y.min(), y.max(), n)
+    return gpd.GeoDataFrame({'id': np.arange(n)}, geometry = gpd.points_from_xy(px, py), crs = 'epsg:4326')
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr = subprocess.DEVNULL,
+                                       cwd = os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_scale(n_nodes, villages_per_node = 0.05, facilities = 50, max_origins = 5000, n_workers = 1, seed = 0,
+              with_gostnets = True, clean_max_nodes = 10000):
+    """
+    Function for timing the pipeline stages on one synthetic network size
+
+    :param n_nodes: approximate number of network nodes
+    :param villages_per_node: villages generated per network node
+    :param facilities: number of facility points per service (health, markets, schools)
+    :param max_origins: cap on the number of village nodes in the OD stage
+    :param n_workers: worker processes for the OD stage, 1 runs it in this process
+    :param seed: random seed
+    :param with_gostnets: also time gn.convert_network_to_time and the tiled clean when GOSTnets can be imported
+    :param clean_max_nodes: largest network the cleaning stage is run on
+    :returns: the RunProfiler of the run
+    """
+    prof = prf.RunProfiler('synthetic_%d' % n_nodes)
+    gn = None
+    if with_gostnets:
+        try:
+            import GOSTnets as gn
+        except ImportError:
+            pass
+
+    with prof.stage('generate') as st:
+        G = st.output(synthetic_network(n_nodes, geometry = gn is not None and n_nodes <= clean_max_nodes,
+                                        seed = seed))
+        villages = st.output(synthetic_points(G, max(10, int(n_nodes * villages_per_node)), seed = seed + 1),
+                             'villages')
+        services = [synthetic_points(G, facilities, seed = seed + 2 + i) for i in range(3)]
+
+    if gn is not None:
+        with prof.stage('convert_to_time_gostnets') as st:
+            st.output(gn.convert_network_to_time(G, distance_tag = 'length', road_col = 'infra_type',
+                                                 speed_dict = SPEED_DICT, factor = 1000))
+        if n_nodes <= clean_max_nodes:
+            import tiled_clean as tcl
+            wpath = tempfile.mkdtemp()
+            try:
+                with prof.stage('clean', workers = n_workers) as st:
+                    st.output(tcl.clean_network_tiled(G, wpath, 'synthetic', {'init': 'epsg:32629'},
+                                                      {'init': 'epsg:4326'}, 0.5, tile_size = 20000,
+                                                      overlap = 2000, n_workers = n_workers))
+            finally:
+                shutil.rmtree(wpath, ignore_errors = True)
+
+    with prof.stage('convert_to_time') as st:
+        SG = scn.compile_scenario_graph(G, distance_tag = 'length', road_col = 'infra_type', factor = 1000)
+        G_csr = st.output(SG.graph(SPEED_DICT))
+
+    with prof.stage('scc') as st:
+        G_main, comps = cmp.largest_component(G_csr)
+        st.output(G_main)
+        st.set(components = comps.n_components)
+
+    with prof.stage('snap_index') as st:
+        snap_idx = si.build_snap_index(G_main, graph_crs = 'epsg:4326', crs = 'epsg:32629')
+    with prof.stage('snap') as st:
+        snapped = snap_idx.snap(villages, *services)
+        st.output(snapped[0], 'villages')
+
+    origins = list(dict.fromkeys(snapped[0].NN.tolist()))[:max_origins]
+    with prof.stage('od') as st:
+        for name, layer in zip(['health', 'markets', 'schools'], snapped[1:]):
+            dests = list(dict.fromkeys(layer.NN.tolist()))
+            if n_workers == 1:
+                OD = ode.calculate_OD(G_main, origins, dests)
+            else:
+                OD = ode.calculate_OD_parallel(G_main, origins, dests, n_workers = n_workers)
+            st.output(OD, name)
+
+    with prof.stage('nearest_facility') as st:
+        st.output(ode.nearest_facility(G_main, origins, list(dict.fromkeys(snapped[1].NN.tolist()))), 'health')
+
+    return prof
+
+
+def _run_stamp(run_id):
+    # epoch seconds of the local time at the start of a run id, NaN if it does not start with one
+    try:
+        return time.mktime(time.strptime(run_id[:19], '%Y-%m-%dT%H:%M:%S'))
+    except ValueError:
+        return np.nan
+
+
+def run(scales, out_fil, **kwargs):
+    """
+    Function for running the benchmark at every scale and appending the stage records to a results file
+
+    :param scales: list of approximate network sizes, e.g. [1000, 10000, 100000, 1000000]
+    :param out_fil: JSON lines results file, one line per scale and stage
+    :param kwargs: passed to run_scale
+    :returns: a DataFrame of this run's stage records
+    """
+    commit = _git_commit()
+    # the id only has to be unique, runs are ordered on run_started (epoch seconds)
+    started = time.time()
+    run_id = '%s-%s' % (time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(started)), uuid.uuid4().hex[:8])
+    rows = []
+    for n_nodes in scales:
+        prof = run_scale(n_nodes, **kwargs)
+        report = prof.report()
+        for rec in report['stages']:
+            row = dict(rec, scale = n_nodes, run = run_id, run_started = started, host = report['host'],
+                       commit = commit)
+            row.pop('profile', None)
+            rows.append(row)
+        with open(out_fil, 'a') as f:
+            for row in rows[-len(report['stages']):]:
+                f.write(json.dumps(row, default = str) + '\n')
+        print('%d nodes: %s' % (n_nodes, ', '.join('%s %.2fs' % (r['stage'], r['wall_s'])
+                                                   for r in report['stages'])))
+    return pd.DataFrame(rows)
+
+
+def compare(out_fil, metric = 'wall_s'):
+    """
+    Function for comparing the last two runs in a results file
+
+    :param out_fil: JSON lines results file written by run
+    :param metric: the stage measure to compare, e.g. 'wall_s' or 'peak_rss_mb'
+    :returns: a DataFrame indexed by (scale, stage) with the previous and last values and their ratio
+    """
+    df = pd.read_json(out_fil, lines = True)
+    df['run'] = df['run'].astype(str)
+    # records written before run_started existed are ordered by the timestamp in their run id
+    stamp = df['run'].map(_run_stamp)
+    if 'run_started' in df:
+        stamp = df['run_started'].fillna(stamp)
+    runs = stamp.groupby(df['run']).min().sort_values(kind = 'stable').index.tolist()
+    df = df[df['run'].isin(runs[-2:])]
+    last = df[df['run'] == runs[-1]].groupby(['scale', 'stage'])[metric].last()
+    if len(runs) < 2:
+        return pd.DataFrame({'last': last})
+    prev = df[df['run'] == runs[-2]].groupby(['scale', 'stage'])[metric].last()
+    out = pd.DataFrame({'previous': prev, 'last': last}).dropna()
+    out['ratio'] = out['last'] / out['previous']
+    return out
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'synthetic network benchmarks')
+    parser.add_argument('--scales', type = int, nargs = '+', default = [1000, 10000, 100000, 1000000])
+    parser.add_argument('--out', default = 'benchmarks.jsonl')
+    parser.add_argument('--max-origins', type = int, default = 5000)
+    parser.add_argument('--facilities', type = int, default = 50)
+    parser.add_argument('--workers', type = int, default = 1)
+    parser.add_argument('--no-gostnets', action = 'store_true')
+    parser.add_argument('--clean-max-nodes', type = int, default = 10000)
+    args = parser.parse_args()
+
+    run(args.scales, args.out, max_origins = args.max_origins, facilities = args.facilities,
+        n_workers = args.workers, with_gostnets = not args.no_gostnets,
+        clean_max_nodes = args.clean_max_nodes)
+    print(compare(args.out))
+    sys.exit(0)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Morocco Accessibility Model: connected component pruning
+#
+# labels the strongly connected components of the network on arrays with scipy.sparse.csgraph instead of
+# nx.strongly_connected_components, and keeps the largest one as a boolean node / edge mask: a subgraph view
+# for networkx, masked arrays for CSRGraph, so the graph is never copied. snap_report lists the villages and
+# facilities whose nearest node is in a dropped component, with their nearest node in the kept one.
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse import csgraph
+
+from csr_graph import CSRGraph, node_id_array
+from snap_index import SnapIndex
+
+
+class Components(object):
+    """
+    Strongly connected components of a graph
+
+    :param node_ids: array of node IDs
+    :param labels: component label of every node
+    :param edge_u: edge source positions in node_ids
+    :param edge_v: edge target positions in node_ids
+    """
+    def __init__(self, node_ids, labels, edge_u, edge_v):
+        self.node_ids = np.asarray(node_ids)
+        self.labels = np.asarray(labels)
+        self.sizes = np.bincount(self.labels)
+        self.main = int(self.sizes.argmax()) if len(self.sizes) else 0
+        self.node_mask = self.labels == self.main
+        self.edge_mask = self.node_mask[edge_u] & self.node_mask[edge_v]
+
+    def __repr__(self):
+        return 'Components: %d, largest %d of %d nodes' % (len(self.sizes), self.sizes.max() if len(self.sizes)
+                                                           else 0, len(self.node_ids))
+
+    @property
+    def n_components(self):
+        return len(self.sizes)
+
+    @property
+    def dropped_nodes(self):
+        return self.node_ids[~self.node_mask]
+
+    def summary(self):
+        """
+        Function for the pruning summary
+
+        :returns: a dict with node / edge counts before and after, and the percent of edges kept
+        """
+        n_edges = len(self.edge_mask)
+        kept = int(self.edge_mask.sum())
+        return {'components': self.n_components,
+                'nodes_before': len(self.node_ids), 'nodes_after': int(self.node_mask.sum()),
+                'edges_before': n_edges, 'edges_after': kept,
+                'edges_percent_kept': 100. * kept / n_edges if n_edges else 100.}
+
+    def subgraph(self, G):
+        """
+        Function for the largest component of G without copying it
+
+        :param G: the graph the components were computed on
+        :returns: a read-only subgraph view for a networkx graph, a CSRGraph of the kept nodes for a CSRGraph
+        """
+        if isinstance(G, CSRGraph):
+            return G.subgraph(self.node_mask)
+        return G.subgraph(self.node_ids[self.node_mask].tolist())
+
+    def snap_report(self, snap_idx, **layers):
+        """
+        Function for listing the features that snap into dropped components
+
+        :param snap_idx: a snap_index.SnapIndex over all nodes of the unpruned graph
+        :param layers: point layers by name, e.g. villages = villages, health = health
+        :returns: a DataFrame with one row per feature snapping to a dropped component: layer, feature index,
+                  NN / NN_dist (dropped node), component size, and main_NN / main_NN_dist, the nearest node
+                  of the largest component to re-snap to
+        """
+        pos = pd.Index(self.node_ids).get_indexer(snap_idx.node_ids)
+        in_main = np.where(pos >= 0, self.node_mask[np.maximum(pos, 0)], False)
+        main_idx = SnapIndex(snap_idx.node_ids[in_main], snap_idx.tree.data[in_main, 0],
+                             snap_idx.tree.data[in_main, 1], crs = snap_idx.crs)
+
+        names = list(layers)
+        snapped = snap_idx.snap(*[layers[n] for n in names])
+        rows = []
+        for name, layer in zip(names, snapped):
+            nn_pos = pd.Index(self.node_ids).get_indexer(layer['NN'].values)
+            dropped = (nn_pos >= 0) & ~self.node_mask[np.maximum(nn_pos, 0)]
+            if not dropped.any():
+                continue
+            sub = layer[dropped]
+            main = main_idx.snap(sub)[0]
+            rows.append(pd.DataFrame({'layer': name,
+                                      'feature': sub.index,
+                                      'NN': sub['NN'].values,
+                                      'NN_dist': sub['NN_dist'].values,
+                                      'component_nodes': self.sizes[self.labels[nn_pos[dropped]]],
+                                      'main_NN': main['NN'].values,
+                                      'main_NN_dist': main['NN_dist'].values}))
+        if not rows:
+            return pd.DataFrame(columns = ['layer', 'feature', 'NN', 'NN_dist', 'component_nodes', 'main_NN',
+                                           'main_NN_dist'])
+        return pd.concat(rows, ignore_index = True)
+
+
+def strong_components(G):
+    """
+    Function for labelling the strongly connected components of a graph on arrays
+
+    :param G: a networkx graph, or a CSRGraph
+    :returns: a Components
+    """
+    if isinstance(G, CSRGraph):
+        n = G.n_nodes
+        u = np.repeat(np.arange(n), np.diff(G.indptr))
+        v = G.indices
+        node_ids = G.node_ids
+    else:
+        nodes = list(G.nodes())
+        pos = {node: i for i, node in enumerate(nodes)}
+        n = len(nodes)
+        edges = [(pos[a], pos[b]) for a, b in G.edges()]
+        u = np.array([e[0] for e in edges], dtype = np.int64)
+        v = np.array([e[1] for e in edges], dtype = np.int64)
+        node_ids = node_id_array(nodes)
+
+    adj = sparse.csr_matrix((np.ones(len(u), dtype = np.int8), (u, v)), shape = (n, n))
+    _, labels = csgraph.connected_components(adj, directed = True, connection = 'strong')
+    return Components(node_ids, labels, u, v)
+
+
+def largest_component(G):
+    """
+    Function for the largest strongly connected component, drop-in for
+    nx.induced_subgraph(G, max(nx.strongly_connected_components(G), key = len)) without the copy
+
+    :param G: a networkx graph, or a CSRGraph
+    :returns: (subgraph view / CSRGraph, Components)
+    """
+    comps = strong_components(G)
+    return comps.subgraph(G), comps
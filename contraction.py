@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Morocco Accessibility Model: contraction hierarchy
+#
+# optional preprocessing of the frozen G_time for repeated many-to-many queries, e.g. facility-siting
+# what-ifs where the OD is re-run for every new list of clinics or schools. Nodes are contracted in order
+# of importance and shortcuts keep shortest paths intact, so a query only has to search upwards from
+# each origin and destination. Many-to-many queries use buckets: the upward searches run in scipy over the upward
+# graph and drop the hubs a higher neighbour reaches more cheaply (a few dozen hubs are left per search), the
+# origins' hubs are grouped into buckets and every destination hub updates its column from its bucket. The origins' search spaces are
+# kept, so a what-if with a new facility list only searches upwards from the facilities and joins. The build is pure
+# python and run once in the prep script; the query is what is repeated.
+
+from heapq import heapify, heappush, heappop
+
+import numpy as np
+from scipy.sparse import csgraph
+
+from csr_graph import CSRGraph, compile_graph, from_edge_arrays
+from od_engine import OD_BLOCK_BYTES, od_chunk_size
+
+
+class ContractionHierarchy(object):
+    """
+    Contraction hierarchy over a compiled graph
+
+    :param rank: int array, contraction order of every node index
+    :param up: CSRGraph of the edges u -> v with rank[v] > rank[u] (shortcuts included)
+    :param down: CSRGraph of the reversed edges v <- u with rank[u] > rank[v], searched from destinations
+    """
+    def __init__(self, rank, up, down):
+        self.rank = np.asarray(rank, dtype = np.int32)
+        self.up = up
+        self.down = down
+        # last search space per direction, see search_space
+        self._spaces = {}
+
+    def __repr__(self):
+        return 'ContractionHierarchy with %d nodes, %d upward and %d downward edges' % (
+            self.up.n_nodes, self.up.n_edges, self.down.n_edges)
+
+    def search_space(self, nodes, reverse = False, cutoff = None, max_bytes = OD_BLOCK_BYTES):
+        """
+        Function for the upward search spaces of a list of nodes
+
+        the last search space of each direction is kept, so repeated what-ifs on the same villages only search
+        upwards from the new facility list.
+
+        :param nodes: a list of nodes, e.g. villages_ls
+        :param reverse: search the downward graph, as for destinations
+        :param cutoff: optional maximum travel time, same units as the edge weights
+        :param max_bytes: memory budget of one block of searches in bytes, see od_engine.od_chunk_size
+        :returns: (rows, hubs, dist) arrays sorted by hub: nodes[rows[k]] reaches node index hubs[k] in dist[k]
+        """
+        g, stall = (self.down, self.up) if reverse else (self.up, self.down)
+        idx = g.index(nodes)
+        key = (cutoff, idx.tobytes())
+        if reverse in self._spaces and self._spaces[reverse][0] == key:
+            return self._spaces[reverse][1]
+        space = _upward_spaces(g, stall, idx, cutoff, max_bytes)
+        self._spaces[reverse] = (key, space)
+        return space
+
+    def calculate_OD(self, origins, destinations, fail_value = 9999999, cutoff = None, max_bytes = OD_BLOCK_BYTES):
+        """
+        Function for generating an origin: destination matrix with bucket queries
+
+        :param origins: a list of origin nodes
+        :param destinations: a list of destination nodes
+        :param fail_value: the value to return if the trip cannot be completed (or takes longer than cutoff)
+        :param cutoff: optional maximum travel time, same units as the edge weights
+        :param max_bytes: memory budget of one block of upward searches in bytes
+        :returns: a numpy matrix of format OD[o][d] = shortest time possible
+        """
+        n_dest = len(destinations)
+        f_rows, f_hubs, f_dist = self.search_space(origins, cutoff = cutoff, max_bytes = max_bytes)
+        b_cols, b_hubs, b_dist = self.search_space(destinations, reverse = True, cutoff = cutoff,
+                                                   max_bytes = max_bytes)
+
+        # the origin entries are sorted by hub: ptr[h]:ptr[h + 1] are the origins whose search met hub h. Every
+        # destination entry updates its column with the origin entries of its hub, which are distinct origins
+        ptr = np.searchsorted(f_hubs, np.arange(self.up.n_nodes + 1)).tolist()
+        OD = np.full((n_dest, len(origins)), np.inf)
+        for c, h, d in zip(b_cols.tolist(), b_hubs.tolist(), b_dist.tolist()):
+            start, stop = ptr[h], ptr[h + 1]
+            if start == stop:
+                continue
+            rows = f_rows[start:stop]
+            col = OD[c]
+            col[rows] = np.minimum(col[rows], f_dist[start:stop] + d)
+        OD = OD.T.copy()
+
+        if cutoff is not None:
+            OD[OD > cutoff] = np.inf
+        OD[np.isinf(OD)] = fail_value
+        return OD
+
+    def save(self, path):
+        """
+        Save the hierarchy as a single .npz file, e.g. next to G_time.pickle
+
+        :param path: output file path
+        """
+        np.savez(path, rank = self.rank, node_ids = self.up.node_ids,
+                 up_indptr = self.up.indptr, up_indices = self.up.indices, up_weights = self.up.weights,
+                 down_indptr = self.down.indptr, down_indices = self.down.indices, down_weights = self.down.weights)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a hierarchy written by ContractionHierarchy.save
+
+        :param path: path to the .npz file
+        :returns: a ContractionHierarchy
+        """
+        with np.load(path, allow_pickle = True) as f:
+            up = CSRGraph(f['up_indptr'], f['up_indices'], f['up_weights'], f['node_ids'])
+            down = CSRGraph(f['down_indptr'], f['down_indices'], f['down_weights'], f['node_ids'])
+            down._node_index = up.node_index
+            return cls(f['rank'], up, down)
+
+
+def _upward_spaces(g, stall, idx, cutoff = None, max_bytes = OD_BLOCK_BYTES):
+    # upward searches with scipy from every node of idx, in blocks sized from the memory budget. Only the nodes
+    # reached are kept: (rows, hubs, dist) sorted by hub, rows are positions in idx. stall holds the edges coming
+    # down into every node from higher ones: a hub reached more cheaply through one of them is not at its shortest
+    # distance, it can never be the meeting hub of a shortest path and is dropped (stall-on-demand, applied after
+    # the search), which cuts the search spaces, and the bucket join, several times
+    limit = np.inf if cutoff is None else cutoff
+    valid = np.flatnonzero(idx >= 0)
+    chunk = od_chunk_size(g, max_bytes = max_bytes)
+    rows, hubs, dist = [np.zeros(0, dtype = np.int64)], [np.zeros(0, dtype = np.int64)], [np.zeros(0)]
+    for start in range(0, len(valid), chunk):
+        block = valid[start:start + chunk]
+        d = csgraph.dijkstra(g.matrix, directed = True, indices = idx[block], limit = limit)
+        r, h = np.nonzero(np.isfinite(d))
+        dh = d[r, h]
+
+        deg = np.diff(stall.indptr)[h]
+        first = np.cumsum(deg) - deg
+        e = np.repeat(stall.indptr[h] - first, deg) + np.arange(deg.sum())
+        via = d[np.repeat(r, deg), stall.indices[e]] + stall.weights[e]
+        best = np.full(len(r), np.inf)
+        has = np.flatnonzero(deg > 0)
+        if len(has):
+            best[has] = np.minimum.reduceat(via, first[has])
+        # relative margin, so float rounding never drops a hub at its shortest distance
+        keep = best >= dh * (1 - 1e-6)
+
+        rows.append(block[r[keep]])
+        hubs.append(h[keep].astype(np.int64))
+        dist.append(dh[keep])
+    rows, hubs, dist = np.concatenate(rows), np.concatenate(hubs), np.concatenate(dist)
+    order = np.argsort(hubs, kind = 'stable')
+    return rows[order], hubs[order], dist[order]
+
+
+def build_contraction_hierarchy(G, weight = 'time', settle_limit = 500, verbose = False):
+    """
+    Function for building a contraction hierarchy
+
+    nodes are contracted lazily by edge difference (shortcuts added minus edges removed, plus contracted
+    neighbours). Witness searches are capped at settle_limit settled nodes, when a cap is hit the shortcut
+    is added anyway, which costs a few extra edges but never correctness.
+
+    :param G: a CSRGraph, or a networkx graph which is compiled first
+    :param weight: the edge attribute to route on when G has to be compiled
+    :param settle_limit: maximum nodes settled per witness search
+    :param verbose: print progress every 10,000 contracted nodes
+    :returns: a ContractionHierarchy
+    """
+    if not isinstance(G, CSRGraph):
+        G = compile_graph(G, weight = weight)
+
+    n = G.n_nodes
+    indptr, indices, weights = G.indptr.tolist(), G.indices.tolist(), G.weights.astype(float).tolist()
+    out_adj = [dict() for _ in range(n)]
+    in_adj = [dict() for _ in range(n)]
+    for u in range(n):
+        for k in range(indptr[u], indptr[u + 1]):
+            v = indices[k]
+            if v == u:
+                continue
+            w = weights[k]
+            if w < out_adj[u].get(v, np.inf):
+                out_adj[u][v] = w
+                in_adj[v][u] = w
+
+    def witness(u, v, targets, max_cost):
+        # dijkstra from u in the remaining graph without v, tentative distances are valid upper bounds
+        dist = {u: 0.}
+        heap = [(0., u)]
+        remaining = set(targets)
+        settled = 0
+        while heap and remaining:
+            d, x = heappop(heap)
+            if d > dist[x]:
+                continue
+            if d > max_cost or settled >= settle_limit:
+                break
+            remaining.discard(x)
+            settled += 1
+            for y, w in out_adj[x].items():
+                if y == v:
+                    continue
+                nd = d + w
+                if nd < dist.get(y, np.inf):
+                    dist[y] = nd
+                    heappush(heap, (nd, y))
+        return dist
+
+    def shortcuts(v):
+        outs = out_adj[v]
+        sc = []
+        if not outs:
+            return sc
+        max_out = max(outs.values())
+        for u, w_uv in in_adj[v].items():
+            targets = [w for w in outs if w != u]
+            if not targets:
+                continue
+            dist = witness(u, v, targets, w_uv + max_out)
+            for w in targets:
+                via = w_uv + outs[w]
+                if dist.get(w, np.inf) > via:
+                    sc.append((u, w, via))
+        return sc
+
+    deleted = [0] * n
+
+    def priority(v):
+        sc = shortcuts(v)
+        return len(sc) - len(in_adj[v]) - len(out_adj[v]) + deleted[v], sc
+
+    heap = [(priority(v)[0], v) for v in range(n)]
+    heapify(heap)
+
+    rank = np.full(n, -1, dtype = np.int32)
+    up_u, up_v, up_w = [], [], []
+    dn_u, dn_v, dn_w = [], [], []
+    order = 0
+    while heap:
+        _, v = heappop(heap)
+        p, sc = priority(v)
+        if heap and p > heap[0][0]:
+            heappush(heap, (p, v))
+            continue
+
+        rank[v] = order
+        order += 1
+        if verbose and order % 10000 == 0:
+            print('contracted %d of %d nodes' % (order, n))
+
+        # every edge still touching v leads to a node contracted later, i.e. higher in the hierarchy
+        for w, wt in out_adj[v].items():
+            up_u.append(v)
+            up_v.append(w)
+            up_w.append(wt)
+        for u, wt in in_adj[v].items():
+            dn_u.append(v)
+            dn_v.append(u)
+            dn_w.append(wt)
+
+        for a, b, wt in sc:
+            if wt < out_adj[a].get(b, np.inf):
+                out_adj[a][b] = wt
+                in_adj[b][a] = wt
+
+        for w in out_adj[v]:
+            del in_adj[w][v]
+            deleted[w] += 1
+        for u in in_adj[v]:
+            del out_adj[u][v]
+            deleted[u] += 1
+        out_adj[v] = {}
+        in_adj[v] = {}
+
+    up = from_edge_arrays(G.node_ids, up_u, up_v, up_w)
+    down = from_edge_arrays(G.node_ids, dn_u, dn_v, dn_w)
+    down._node_index = up.node_index
+    return ContractionHierarchy(rank, up, down)
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Morocco Accessibility Model: compiled graph
+#
+# freezes G_time (networkx) into a compressed sparse row structure so the OD stage can run
+# on plain arrays instead of walking python dicts per edge.
+# node indices are int32, travel-time weights are float32 (seconds, as set by gn.convert_network_to_time).
+
+import numpy as np
+from scipy import sparse
+
+
+class CSRGraph(object):
+    """
+    Read-only compressed sparse row graph
+
+    :param indptr: int32 array of length n_nodes + 1, row offsets into indices / weights
+    :param indices: int32 array of edge target node indices
+    :param weights: float32 array of edge weights
+    :param node_ids: array of original node IDs, position i holds the ID of node index i
+    :param x: optional float array of node x coordinates
+    :param y: optional float array of node y coordinates
+    """
+    def __init__(self, indptr, indices, weights, node_ids, x = None, y = None):
+        self.indptr = np.asarray(indptr, dtype = np.int32)
+        self.indices = np.asarray(indices, dtype = np.int32)
+        self.weights = np.asarray(weights, dtype = np.float32)
+        self.node_ids = np.asarray(node_ids)
+        self.x = None if x is None else np.asarray(x, dtype = float)
+        self.y = None if y is None else np.asarray(y, dtype = float)
+        self._node_index = None
+        self._matrix = None
+        self._matrix_T = None
+
+    def __repr__(self):
+        return 'CSRGraph with %d nodes and %d edges' % (self.n_nodes, self.n_edges)
+
+    def __len__(self):
+        return self.n_nodes
+
+    @property
+    def n_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def n_edges(self):
+        return len(self.indices)
+
+    @property
+    def node_index(self):
+        # original node ID -> int index, built lazily
+        if self._node_index is None:
+            self._node_index = {n: i for i, n in enumerate(self.node_ids.tolist())}
+        return self._node_index
+
+    def index(self, nodes):
+        """
+        Map original node IDs to int indices
+
+        :param nodes: a list of node IDs
+        :returns: an int32 array of node indices, -1 where the node is not in the graph
+        """
+        node_index = self.node_index
+        return np.array([node_index.get(n, -1) for n in nodes], dtype = np.int32)
+
+    @property
+    def matrix(self):
+        # scipy view of the graph, shares the underlying arrays
+        if self._matrix is None:
+            self._matrix = sparse.csr_matrix((self.weights, self.indices, self.indptr),
+                                             shape = (self.n_nodes, self.n_nodes))
+        return self._matrix
+
+    @property
+    def matrix_T(self):
+        # reversed graph, used for searches from destinations back to origins
+        if self._matrix_T is None:
+            self._matrix_T = self.matrix.transpose().tocsr()
+        return self._matrix_T
+
+    def with_weights(self, weights):
+        """
+        New graph on the same topology with different edge weights
+
+        arrays and the node ID mapping are shared, not copied.
+
+        :param weights: array of edge weights in the order of self.indices
+        :returns: a CSRGraph
+        """
+        g = CSRGraph(self.indptr, self.indices, weights, self.node_ids, x = self.x, y = self.y)
+        g._node_index = self.node_index
+        return g
+
+    def subgraph(self, node_mask):
+        """
+        Graph induced by a subset of the nodes
+
+        edges are kept when both of their ends are, node order is preserved.
+
+        :param node_mask: boolean array over the nodes, True for the nodes to keep
+        :returns: a CSRGraph
+        """
+        node_mask = np.asarray(node_mask, dtype = bool)
+        keep = np.flatnonzero(node_mask)
+        new_idx = np.full(self.n_nodes, -1, dtype = np.int64)
+        new_idx[keep] = np.arange(len(keep))
+        u = np.repeat(np.arange(self.n_nodes), np.diff(self.indptr))
+        edge_mask = node_mask[u] & node_mask[self.indices]
+        # edges stay sorted by source, so the kept arrays are already in CSR order
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(new_idx[u[edge_mask]], minlength = len(keep)))])
+        return CSRGraph(indptr, new_idx[self.indices[edge_mask]], self.weights[edge_mask], self.node_ids[keep],
+                        x = None if self.x is None else self.x[keep], y = None if self.y is None else self.y[keep])
+
+    def save(self, path):
+        """
+        Save the compiled graph as a single .npz file
+
+        :param path: output file path
+        """
+        arrays = dict(indptr = self.indptr, indices = self.indices, weights = self.weights,
+                      node_ids = self.node_ids)
+        if self.x is not None:
+            arrays['x'] = self.x
+            arrays['y'] = self.y
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a compiled graph written by CSRGraph.save
+
+        :param path: path to the .npz file
+        :returns: a CSRGraph
+        """
+        with np.load(path, allow_pickle = True) as f:
+            x = f['x'] if 'x' in f.files else None
+            y = f['y'] if 'y' in f.files else None
+            return cls(f['indptr'], f['indices'], f['weights'], f['node_ids'], x = x, y = y)
+
+
+def node_id_array(nodes):
+    # keep integer OSM IDs as int64, anything else as object
+    try:
+        return np.array(nodes, dtype = np.int64)
+    except (TypeError, ValueError, OverflowError):
+        arr = np.empty(len(nodes), dtype = object)
+        arr[:] = nodes
+        return arr
+
+
+def from_edge_arrays(node_ids, u, v, w, x = None, y = None):
+    """
+    Function for building a CSRGraph from integer edge arrays
+
+    parallel edges are collapsed to the fastest one.
+
+    :param node_ids: array of original node IDs
+    :param u: int array of edge source indices
+    :param v: int array of edge target indices
+    :param w: array of edge weights
+    :param x: optional node x coordinates
+    :param y: optional node y coordinates
+    :returns: a CSRGraph
+    """
+    n = len(node_ids)
+    u = np.asarray(u, dtype = np.int64)
+    v = np.asarray(v, dtype = np.int64)
+    w = np.asarray(w, dtype = np.float32)
+
+    # sort by (u, v, w) and keep the first edge of every (u, v) pair
+    order = np.lexsort((w, v, u))
+    u, v, w = u[order], v[order], w[order]
+    keep = np.ones(len(u), dtype = bool)
+    keep[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+    u, v, w = u[keep], v[keep], w[keep]
+
+    indptr = np.zeros(n + 1, dtype = np.int64)
+    np.cumsum(np.bincount(u, minlength = n), out = indptr[1:])
+    return CSRGraph(indptr, v, w, node_ids, x = x, y = y)
+
+
+def compile_graph(G, weight = 'time'):
+    """
+    Function for freezing a networkx graph into a CSRGraph
+
+    :param G: a graph containing one or more nodes, e.g. G_time from gn.convert_network_to_time
+    :param weight: the edge attribute to use as the edge weight
+    :returns: a CSRGraph with node x / y kept when every node has them
+    """
+    nodes = list(G.nodes())
+    node_index = {n: i for i, n in enumerate(nodes)}
+
+    n_edges = G.number_of_edges()
+    u = np.empty(n_edges, dtype = np.int64)
+    v = np.empty(n_edges, dtype = np.int64)
+    w = np.empty(n_edges, dtype = np.float32)
+    for i, (a, b, d) in enumerate(G.edges(data = True)):
+        u[i] = node_index[a]
+        v[i] = node_index[b]
+        w[i] = d.get(weight, 1)
+
+    x = y = None
+    node_data = G.nodes
+    if nodes and all('x' in node_data[n] and 'y' in node_data[n] for n in nodes):
+        x = np.array([node_data[n]['x'] for n in nodes], dtype = float)
+        y = np.array([node_data[n]['y'] for n in nodes], dtype = float)
+
+    if not G.is_directed():
+        u, v = np.concatenate([u, v]), np.concatenate([v, u])
+        w = np.concatenate([w, w])
+
+    return from_edge_arrays(node_id_array(nodes), u, v, w, x = x, y = y)
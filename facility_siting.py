@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Morocco Accessibility Model: facility siting
+#
+# picks k new health / school sites out of a list of candidate nodes to serve underserved villages, either
+# minimizing population-weighted travel time (p-median) or maximizing the population reached within T minutes
+# (maximum coverage). Both objectives are submodular, so lazy greedy is used: candidates sit in a priority queue
+# keyed by their last marginal gain, and only the top candidate is re-evaluated, as a vectorized row operation
+# on the candidate x village time matrix.
+
+from heapq import heapify, heappush, heappop
+
+import numpy as np
+import pandas as pd
+
+from od_engine import calculate_OD, calculate_OD_parallel
+
+
+def node_weights(villages, nodes, weight_col = None, node_col = 'NN'):
+    """
+    Function for summing village weights (e.g. population) per snapped node
+
+    several villages can snap to the same node, villages_ls only keeps the node once.
+
+    :param villages: the snapped villages GeoDataFrame
+    :param nodes: list of origin nodes, e.g. villages_ls
+    :param weight_col: village column to sum, None counts villages
+    :param node_col: column holding the snapped node
+    :returns: a numpy array of weights in the order of nodes
+    """
+    if weight_col is None:
+        w = villages.groupby(node_col).size()
+    else:
+        w = villages.groupby(node_col)[weight_col].sum()
+    return w.reindex(list(nodes)).fillna(0).values.astype(float)
+
+
+def candidate_times(G, candidates, origins, fail_value = 9999999, cutoff = None, n_workers = 1):
+    """
+    Function for the candidate x village travel-time matrix
+
+    :param G: a CSRGraph, or a networkx graph which is compiled first
+    :param candidates: list of candidate facility nodes
+    :param origins: list of village nodes, e.g. villages_ls
+    :param fail_value: time used for trips that cannot be completed (or are beyond cutoff)
+    :param cutoff: optional maximum travel time, same units as the edge weights
+    :param n_workers: number of worker processes, more than 1 (or None for all cores) uses calculate_OD_parallel
+    :returns: a float32 numpy matrix T[candidate][village], travel time from the village to the candidate
+    """
+    if n_workers == 1:
+        OD = calculate_OD(G, origins, candidates, fail_value = fail_value, cutoff = cutoff)
+    else:
+        OD = calculate_OD_parallel(G, origins, candidates, fail_value = fail_value, cutoff = cutoff,
+                                   n_workers = n_workers)
+    return np.ascontiguousarray(OD.T, dtype = np.float32)
+
+
+def site_facilities(T, k, weights = None, current = None, coverage_time = None, fail_value = 9999999,
+                    candidates = None):
+    """
+    Function for choosing k new facility sites with lazy greedy
+
+    :param T: candidate x village travel-time matrix, e.g. from candidate_times
+    :param k: number of sites to pick
+    :param weights: village weights (e.g. population from node_weights), None weighs villages equally
+    :param current: village times to the existing facilities (e.g. nearest_facility(...)['time'].values),
+                    None when there are no facilities yet
+    :param coverage_time: if set, maximize the weight of villages within this time (maximum coverage),
+                          otherwise minimize the weighted travel time (p-median)
+    :param fail_value: time used for villages that cannot reach any facility
+    :param candidates: optional candidate node IDs used to label the result, defaults to row numbers
+    :returns: a pandas DataFrame with one row per chosen site in pick order: 'candidate', 'gain', and
+              'objective' (weighted total time, or covered weight, after the pick)
+    """
+    T = np.asarray(T, dtype = np.float32)
+    n_cand, n_vil = T.shape
+    weights = np.ones(n_vil) if weights is None else np.asarray(weights, dtype = float)
+    if candidates is None:
+        candidates = np.arange(n_cand)
+    candidates = np.asarray(candidates)
+
+    if current is None:
+        best = np.full(n_vil, fail_value, dtype = float)
+    else:
+        best = np.minimum(np.asarray(current, dtype = float), fail_value)
+
+    if coverage_time is not None:
+        covers = T <= coverage_time
+        covered = best <= coverage_time
+
+        def gain(c):
+            return weights[covers[c] & ~covered].sum()
+
+        # all first gains at once
+        gains = (covers & ~covered[None, :]).astype(float).dot(weights)
+    else:
+        def gain(c):
+            return (np.maximum(best - T[c], 0) * weights).sum()
+
+        # in row blocks, so the temporary stays small with thousands of candidates
+        gains = np.concatenate([(np.maximum(best[None, :] - T[i:i + 512], 0) * weights[None, :]).sum(axis = 1)
+                                for i in range(0, n_cand, 512)])
+
+    # max-heap of (negated) stale gains, popped candidates are re-evaluated and only kept if still on top
+    heap = [(-g, c) for c, g in enumerate(gains.tolist())]
+    heapify(heap)
+    chosen = []
+    while heap and len(chosen) < k:
+        _, c = heappop(heap)
+        g = gain(c)
+        if heap and g < -heap[0][0]:
+            heappush(heap, (-g, c))
+            continue
+        if g <= 0:
+            break
+        if coverage_time is not None:
+            covered |= covers[c]
+            objective = weights[covered].sum()
+        else:
+            best = np.minimum(best, T[c])
+            objective = (best * weights).sum()
+        chosen.append((candidates[c], g, objective))
+
+    return pd.DataFrame(chosen, columns = ['candidate', 'gain', 'objective'])
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Morocco Accessibility Model: incremental nearest-facility updates
+#
+# keeps the nearest facility and travel time of every village, and updates them when a facility is added
+# or removed instead of re-running the OD stage over every village. Adding a facility runs one reverse search
+# from the new node, bounded by the worst current village time; removing one runs one multi-source search
+# from the remaining facilities and only re-assigns the villages that were served by it.
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csgraph
+
+from csr_graph import CSRGraph, compile_graph, node_id_array
+from od_engine import nearest_facility
+
+
+class NearestFacilityState(object):
+    """
+    Nearest facility and travel time of every origin, with add / remove updates
+
+    :param G: the CSRGraph the state was computed on
+    :param origins: list of origin nodes (e.g. villages_ls)
+    :param facilities: list of facility nodes currently open
+    :param times: array of travel times to the nearest facility, inf when none can be reached
+    :param nearest: array of nearest facility nodes, None when none can be reached
+    :param cutoff: travel time beyond which a facility is taken as unreachable, None for no limit
+    """
+    def __init__(self, G, origins, facilities, times, nearest, cutoff = None):
+        self.G = G
+        self.origins = list(origins)
+        self.facilities = list(dict.fromkeys(facilities))
+        self.times = np.array(times, dtype = float)
+        self.nearest = np.array(nearest, dtype = object)
+        self.cutoff = cutoff
+        self._o_idx = G.index(self.origins)
+
+    def __repr__(self):
+        return 'NearestFacilityState with %d origins and %d facilities' % (len(self.origins), len(self.facilities))
+
+    @classmethod
+    def build(cls, G, origins, facilities, weight = 'time', cutoff = None):
+        """
+        Function for the initial state, one multi-source search from all facilities
+
+        :param G: a CSRGraph, or a networkx graph which is compiled first
+        :param origins: list of origin nodes
+        :param facilities: list of facility nodes
+        :param weight: the edge attribute to route on when G has to be compiled
+        :param cutoff: travel time beyond which a facility is taken as unreachable, None for no limit
+        :returns: a NearestFacilityState
+        """
+        if not isinstance(G, CSRGraph):
+            G = compile_graph(G, weight = weight)
+        nf = nearest_facility(G, origins, facilities, fail_value = np.inf, cutoff = cutoff)
+        return cls(G, origins, facilities, nf['time'].values, nf['nearest'].values, cutoff = cutoff)
+
+    def to_frame(self, fail_value = 9999999):
+        """
+        Function for the current state as a nearest_facility DataFrame
+
+        :param fail_value: the value to return for origins that cannot reach any facility
+        :returns: a pandas DataFrame indexed by origin with columns 'time' and 'nearest'
+        """
+        times = np.where(np.isinf(self.times), fail_value, self.times)
+        return pd.DataFrame({'time': times, 'nearest': self.nearest}, index = self.origins)
+
+    def add_facility(self, node):
+        """
+        Function for opening a facility
+
+        :param node: the facility node
+        :returns: list of origins whose nearest facility changed to node
+        """
+        if node in self.facilities:
+            return []
+        self.facilities.append(node)
+        idx = self.G.index([node])[0]
+        if idx < 0:
+            return []
+
+        # nothing beyond the worst current village time can improve anything
+        bound = self.times.max() if len(self.times) else 0
+        if self.cutoff is not None:
+            bound = min(bound, self.cutoff)
+        dist = csgraph.dijkstra(self.G.matrix_T, directed = True, indices = idx, limit = bound)
+
+        valid = self._o_idx >= 0
+        new = np.full(len(self.origins), np.inf)
+        new[valid] = dist[self._o_idx[valid]]
+        better = new < self.times
+        self.times[better] = new[better]
+        self.nearest[better] = node
+        return [self.origins[i] for i in np.flatnonzero(better)]
+
+    def remove_facility(self, node):
+        """
+        Function for closing a facility
+
+        :param node: the facility node
+        :returns: list of origins that were served by node, now re-assigned to their next nearest facility
+        """
+        if node not in self.facilities:
+            return []
+        self.facilities.remove(node)
+
+        affected = np.flatnonzero(np.array([n == node for n in self.nearest], dtype = bool))
+        if len(affected) == 0:
+            return []
+
+        # one reverse search from all remaining facilities gives every node its nearest one, read for the
+        # affected villages only
+        times = np.full(len(affected), np.inf)
+        nearest = np.full(len(affected), None, dtype = object)
+        f_idx = self.G.index(self.facilities)
+        f_idx = f_idx[f_idx >= 0]
+        o_idx = self._o_idx[affected]
+        valid = o_idx >= 0
+        if len(f_idx) > 0 and valid.any():
+            dist, _, sources = csgraph.dijkstra(self.G.matrix_T, directed = True, indices = f_idx,
+                                                return_predecessors = True, min_only = True,
+                                                limit = np.inf if self.cutoff is None else self.cutoff)
+            times[valid] = dist[o_idx[valid]]
+            reached = np.isfinite(times)
+            nearest[reached] = self.G.node_ids[sources[o_idx[reached]]]
+        self.times[affected] = times
+        self.nearest[affected] = nearest
+        return [self.origins[i] for i in affected]
+
+    def save(self, path):
+        """
+        Save the state as a single .npz file (the graph is not included)
+
+        :param path: output file path
+        """
+        np.savez(path, origins = node_id_array(self.origins), facilities = node_id_array(self.facilities),
+                 times = self.times, nearest = self.nearest,
+                 cutoff = np.nan if self.cutoff is None else self.cutoff)
+
+    @classmethod
+    def load(cls, path, G):
+        """
+        Load a state written by NearestFacilityState.save
+
+        :param path: path to the .npz file
+        :param G: the CSRGraph the state was computed on
+        :returns: a NearestFacilityState
+        """
+        with np.load(path, allow_pickle = True) as f:
+            cutoff = float(f['cutoff'])
+            return cls(G, f['origins'].tolist(), f['facilities'].tolist(), f['times'], f['nearest'],
+                       cutoff = None if np.isnan(cutoff) else cutoff)
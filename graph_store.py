@@ -0,0 +1,304 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Morocco Accessibility Model: columnar graph files
+#
+# replaces the pickled networkx graphs between stages (mar_unclean, mar_clean, G_largest, G_time). A graph is
+# written as two Parquet files, nodes.parquet (id, x, y, ...) and edges.parquet (u, v, length, infra_type,
+# time, ...), which load straight into arrays and open in QGIS / DuckDB / R for QA. The networkx graph is only
+# rebuilt when asked for. Requires pyarrow.
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from csr_graph import from_edge_arrays
+
+
+def _arrow_table(df, meta = None):
+    # DataFrame -> pyarrow Table. Geometry columns are written as WKB, list columns (e.g. infra_type or osm_id
+    # holding a list on every merged edge) as arrow lists. Columns arrow cannot type (e.g. osm_id holding both
+    # ints and lists after simplification, or node IDs mixing ints and strings) are written as JSON strings,
+    # one value per row, and decoded again by read_graph.
+    import pyarrow as pa
+
+    arrays, names = [], []
+    geometry_columns, list_columns, json_columns = [], [], []
+    for col in df.columns:
+        values = df[col]
+        if values.dtype == object and any(hasattr(v, 'wkb') for v in values.head(100)):
+            values = pd.Series(_to_wkb(values.values), index = values.index)
+            geometry_columns.append(str(col))
+        try:
+            arr = pa.array(values, from_pandas = True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError, TypeError, ValueError):
+            arr = pa.array([None if _missing(v) else json.dumps(v, default = _json_default) for v in values],
+                           type = pa.string())
+            json_columns.append(str(col))
+        if pa.types.is_list(arr.type) or pa.types.is_large_list(arr.type):
+            list_columns.append(str(col))
+        arrays.append(arr)
+        names.append(str(col))
+
+    meta = dict(meta or {})
+    meta['geometry_columns'] = geometry_columns
+    meta['list_columns'] = list_columns
+    meta['json_columns'] = json_columns
+    table = pa.Table.from_arrays(arrays, names = names)
+    return table.replace_schema_metadata({'gostnets': json.dumps(meta, default = str)})
+
+
+def _json_default(value):
+    # numpy scalars / arrays inside object columns
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (set, frozenset, tuple)):
+        return list(value)
+    raise TypeError('graph attribute of type %s cannot be written' % type(value).__name__)
+
+
+def _to_pandas(table):
+    # pyarrow Table -> DataFrame, list columns back to python lists and JSON columns decoded
+    meta = _read_meta(table)
+    df = table.to_pandas()
+    for col in meta.get('list_columns', []):
+        if col in df.columns:
+            df[col] = pd.Series(table.column(col).to_pylist(), index = df.index, dtype = object)
+    for col in meta.get('json_columns', []):
+        if col in df.columns:
+            df[col] = pd.Series([None if v is None else json.loads(v) for v in table.column(col).to_pylist()],
+                                index = df.index, dtype = object)
+    return df
+
+
+def _to_wkb(geoms):
+    try:
+        import shapely
+        return shapely.to_wkb(geoms)
+    except (AttributeError, TypeError):
+        # shapely < 2, or non-geometry values mixed in
+        return [g.wkb if hasattr(g, 'wkb') else None for g in geoms]
+
+
+def _from_wkb(values):
+    try:
+        import shapely
+        return list(shapely.from_wkb(np.asarray(values, dtype = object)))
+    except AttributeError:
+        from shapely import wkb
+        return [None if g is None else wkb.loads(g) for g in values]
+
+
+def _missing(value):
+    return value is None or (isinstance(value, float) and np.isnan(value))
+
+
+def _same(a, b):
+    # attribute equality for the round-trip check: NaN equals NaN, geometries compare by coordinates
+    if _missing(a) and _missing(b):
+        return True
+    if hasattr(a, 'wkb') and hasattr(b, 'wkb'):
+        return a.equals_exact(b, 0)
+    try:
+        return bool(a == b)
+    except ValueError:
+        return np.array_equal(a, b)
+
+
+def _read_meta(table):
+    meta = table.schema.metadata or {}
+    return json.loads(meta.get(b'gostnets', b'{}').decode('utf-8'))
+
+
+def write_graph(G, out_pth, compression = 'zstd', verify = False):
+    """
+    Function for saving a networkx graph as node and edge Parquet files
+
+    every node / edge attribute becomes a column, shapely geometries are stored as WKB.
+
+    :param G: a networkx graph, e.g. G_time
+    :param out_pth: output folder, holding nodes.parquet and edges.parquet
+    :param compression: parquet compression codec
+    :param verify: read the files back and raise a ValueError unless every node and edge attribute matches G
+    :returns: out_pth
+    """
+    import pyarrow.parquet as pq
+
+    if not os.path.exists(out_pth):
+        os.makedirs(out_pth)
+
+    nodes = pd.DataFrame.from_records([d for _, d in G.nodes(data = True)], index = range(G.number_of_nodes()))
+    nodes.insert(0, 'id', [n for n in G.nodes()])
+
+    multigraph = G.is_multigraph()
+    if multigraph:
+        edges = list(G.edges(keys = True, data = True))
+        cols = {'u': [e[0] for e in edges], 'v': [e[1] for e in edges], 'key': [e[2] for e in edges]}
+    else:
+        edges = list(G.edges(data = True))
+        cols = {'u': [e[0] for e in edges], 'v': [e[1] for e in edges]}
+    attrs = pd.DataFrame.from_records([e[-1] for e in edges], index = range(len(edges)))
+    edges = pd.concat([pd.DataFrame(cols), attrs.drop(columns = [c for c in cols if c in attrs.columns])],
+                      axis = 1)
+
+    meta = {'directed': G.is_directed(), 'multigraph': multigraph, 'graph': G.graph}
+    pq.write_table(_arrow_table(nodes, meta), os.path.join(out_pth, 'nodes.parquet'), compression = compression)
+    pq.write_table(_arrow_table(edges, meta), os.path.join(out_pth, 'edges.parquet'), compression = compression)
+    if verify:
+        check_roundtrip(G, read_graph(out_pth).to_networkx())
+    return out_pth
+
+
+def check_roundtrip(G, H):
+    """
+    Function for checking that a graph read back from Parquet holds the same nodes, edges and attributes
+
+    :param G: the networkx graph that was written
+    :param H: the graph rebuilt by read_graph(...).to_networkx()
+    :returns: None, raises a ValueError naming the first node / edge that differs
+    """
+    def _diff(a, b):
+        # a NaN attribute is written as null and left out on read, like an absent one
+        a = {k: v for k, v in a.items() if not _missing(v)}
+        if set(a) != set(b):
+            return 'attributes %s' % sorted(set(a) ^ set(b), key = str)
+        for k in a:
+            if not _same(a[k], b[k]):
+                return '%s: %r != %r' % (k, a[k], b[k])
+        return None
+
+    if G.number_of_nodes() != H.number_of_nodes() or G.number_of_edges() != H.number_of_edges():
+        raise ValueError('graph sizes differ: %d / %d nodes, %d / %d edges' % (
+            G.number_of_nodes(), H.number_of_nodes(), G.number_of_edges(), H.number_of_edges()))
+    for n, d in G.nodes(data = True):
+        if n not in H:
+            raise ValueError('node %r missing after read' % (n,))
+        diff = _diff(d, H.nodes[n])
+        if diff:
+            raise ValueError('node %r differs, %s' % (n, diff))
+    edges = G.edges(keys = True, data = True) if G.is_multigraph() else G.edges(data = True)
+    for e in edges:
+        if not H.has_edge(*e[:-1]):
+            raise ValueError('edge %r missing after read' % (e[:-1],))
+        diff = _diff(e[-1], H.get_edge_data(*e[:-1]))
+        if diff:
+            raise ValueError('edge %r differs, %s' % (e[:-1], diff))
+
+
+def read_graph(pth, edge_columns = None, node_columns = None):
+    """
+    Function for loading a graph written by write_graph, as arrays
+
+    :param pth: the graph folder
+    :param edge_columns: edge attributes to load, e.g. ['time'], None for all
+    :param node_columns: node attributes to load besides the ID, None for all
+    :returns: a GraphTable
+    """
+    import pyarrow.parquet as pq
+
+    if node_columns is not None:
+        node_columns = ['id'] + [c for c in node_columns if c != 'id']
+    nodes = pq.read_table(os.path.join(pth, 'nodes.parquet'), columns = node_columns)
+    meta = _read_meta(nodes)
+    if edge_columns is not None:
+        keys = ['u', 'v', 'key'] if meta.get('multigraph') else ['u', 'v']
+        edge_columns = keys + [c for c in edge_columns if c not in keys]
+    edges = pq.read_table(os.path.join(pth, 'edges.parquet'), columns = edge_columns)
+    geometry_columns = meta['geometry_columns'] + _read_meta(edges)['geometry_columns']
+    return GraphTable(_to_pandas(nodes), _to_pandas(edges), meta, geometry_columns)
+
+
+class GraphTable(object):
+    """
+    Graph loaded as node and edge tables
+
+    :param nodes: DataFrame with an 'id' column and the node attributes
+    :param edges: DataFrame with 'u', 'v' (node IDs), 'key' for multigraphs, and the edge attributes
+    :param meta: dict with 'directed', 'multigraph' and the networkx graph attributes ('graph')
+    :param geometry_columns: node / edge columns holding WKB geometries
+    """
+    def __init__(self, nodes, edges, meta, geometry_columns = ()):
+        self.nodes = nodes
+        self.edges = edges
+        self.meta = meta
+        self.geometry_columns = list(geometry_columns)
+        self._u = None
+        self._v = None
+        self._G = None
+
+    def __repr__(self):
+        return 'GraphTable with %d nodes and %d edges' % (len(self.nodes), len(self.edges))
+
+    @property
+    def node_ids(self):
+        return self.nodes['id'].values
+
+    def edge_index(self):
+        """
+        Function for the edge end points as node positions
+
+        :returns: (u, v) int arrays, positions in self.nodes
+        """
+        if self._u is None:
+            index = pd.Index(self.nodes['id'])
+            self._u = index.get_indexer(self.edges['u'])
+            self._v = index.get_indexer(self.edges['v'])
+        return self._u, self._v
+
+    def compile(self, weight = 'time'):
+        """
+        Function for compiling the graph for the OD stage without building networkx
+
+        :param weight: the edge column to route on
+        :returns: a CSRGraph
+        """
+        u, v = self.edge_index()
+        w = self.edges[weight].values.astype(float)
+        if not self.meta.get('directed', True):
+            u, v, w = np.concatenate([u, v]), np.concatenate([v, u]), np.concatenate([w, w])
+        x = y = None
+        if 'x' in self.nodes and 'y' in self.nodes and not self.nodes[['x', 'y']].isnull().values.any():
+            x = self.nodes['x'].values.astype(float)
+            y = self.nodes['y'].values.astype(float)
+        return from_edge_arrays(self.node_ids, u, v, w, x = x, y = y)
+
+    def to_networkx(self):
+        """
+        Function for rebuilding the networkx graph, built once and kept
+
+        :returns: a networkx graph of the type that was written (MultiDiGraph for G_time)
+        """
+        if self._G is not None:
+            return self._G
+        import networkx as nx
+
+        directed, multigraph = self.meta.get('directed', True), self.meta.get('multigraph', False)
+        if multigraph:
+            G = nx.MultiDiGraph() if directed else nx.MultiGraph()
+        else:
+            G = nx.DiGraph() if directed else nx.Graph()
+        G.graph.update(self.meta.get('graph', {}))
+
+        def _records(df, skip):
+            # attributes absent on a node / edge were written as nulls, they are left out again
+            cols = [c for c in df.columns if c not in skip]
+            data = {c: _from_wkb(df[c].values) if c in self.geometry_columns else df[c].tolist() for c in cols}
+            full = [c for c in cols if not df[c].isnull().any()]
+            sparse = [c for c in cols if c not in full]
+            records = [dict(zip(full, row)) for row in zip(*[data[c] for c in full])] if full else \
+                [{} for _ in range(len(df))]
+            for c in sparse:
+                for rec, value in zip(records, data[c]):
+                    if not _missing(value):
+                        rec[c] = value
+            return records
+
+        G.add_nodes_from(zip(self.nodes['id'].tolist(), _records(self.nodes, ('id',))))
+        ends = ['u', 'v', 'key'] if multigraph else ['u', 'v']
+        G.add_edges_from(zip(*[self.edges[c].tolist() for c in ends], _records(self.edges, ends)))
+        self._G = G
+        return G
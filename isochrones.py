@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Morocco Accessibility Model: accessibility surfaces
+#
+# continuous travel-time rasters to the health / market / school node sets, for the poverty mapping team.
+# One multi-source search per service gives the drive time from every graph node to the nearest facility;
+# every grid cell then walks to one of its nearest nodes (off-network leg at walk_speed) and drives from there.
+# The grid is processed in tiles, vectorized per tile and spread across a process pool, and written as a tiled,
+# compressed GeoTIFF with one band per service, in minutes.
+
+import multiprocessing as mp
+import os
+
+import numpy as np
+import rasterio
+from rasterio import features
+from rasterio.transform import from_origin
+from rasterio.windows import Window, transform as window_transform
+from scipy.sparse import csgraph
+from shapely.ops import unary_union
+
+from csr_graph import CSRGraph, compile_graph
+
+
+def node_times(G, sources, cutoff = None):
+    """
+    Function for the travel time from every node to the nearest source node
+
+    :param G: a CSRGraph
+    :param sources: list of facility nodes
+    :param cutoff: optional maximum travel time, same units as the edge weights
+    :returns: a float array over the node indices of G, inf where no source can be reached
+    """
+    s_idx = G.index(sources)
+    s_idx = np.unique(s_idx[s_idx >= 0])
+    if len(s_idx) == 0:
+        return np.full(G.n_nodes, np.inf)
+    return csgraph.dijkstra(G.matrix_T, directed = True, indices = s_idx, min_only = True,
+                            limit = np.inf if cutoff is None else cutoff)
+
+
+# state shared with tile worker processes, inherited on fork or sent once per worker
+_tile_state = {}
+
+
+def _init_tile_worker(state):
+    if state is not None:
+        _tile_state.update(state)
+
+
+def _tile(window):
+    st = _tile_state
+    row_off, col_off, height, width = window
+    res = st['resolution']
+    left, top = st['origin']
+
+    cols, rows = np.meshgrid(np.arange(col_off, col_off + width), np.arange(row_off, row_off + height))
+    x = left + (cols.ravel() + 0.5) * res
+    y = top - (rows.ravel() + 0.5) * res
+
+    dist, idx = st['snap_idx'].tree.query(np.column_stack([x, y]), k = st['k'])
+    dist = dist.reshape(len(x), -1)
+    idx = idx.reshape(len(x), -1)
+    found = idx < len(st['graph_idx'])
+    g_idx = np.where(found, st['graph_idx'][np.minimum(idx, len(st['graph_idx']) - 1)], -1)
+
+    walk = dist / st['walk_m_per_min']
+    if st['max_walk_dist'] is not None:
+        walk[dist > st['max_walk_dist']] = np.inf
+    walk[~found | (g_idx < 0)] = np.inf
+
+    out = np.empty((len(st['times']), height, width), dtype = np.float32)
+    for b, t in enumerate(st['times']):
+        cell = (t[np.maximum(g_idx, 0)] + walk).min(axis = 1)
+        out[b] = cell.reshape(height, width)
+
+    tile_transform = window_transform(Window(col_off, row_off, width, height), st['transform'])
+    inside = features.geometry_mask([st['aoi']], (height, width), tile_transform, invert = True,
+                                    all_touched = True)
+    out[:, ~inside] = st['nodata']
+    out[~np.isfinite(out)] = st['nodata']
+    return window, out
+
+
+def accessibility_raster(G, snap_idx, services, aoi, out_fil, resolution = 100, walk_speed = 5, k = 4,
+                         max_walk_dist = None, cutoff = None, tile_size = 1024, n_workers = None, nodata = -1,
+                         weight = 'time'):
+    """
+    Function for rasterizing travel time to facility sets over an area of interest
+
+    cell time = min over the k nearest nodes of (NN_dist / walk_speed + drive time from the node to the
+    nearest facility), in minutes.
+
+    :param G: a CSRGraph, or a networkx graph which is compiled first
+    :param snap_idx: a snap_index.SnapIndex over the graph nodes, its projected CRS is the raster CRS
+    :param services: dict of service name: list of facility nodes, one band per service
+    :param aoi: GeoDataFrame of the area of interest (e.g. tinghirP.shp), cells outside are nodata
+    :param out_fil: output GeoTIFF path
+    :param resolution: cell size in CRS units (meters for UTM)
+    :param walk_speed: off-network walking speed in km/h
+    :param k: number of nearest nodes considered per cell
+    :param max_walk_dist: optional maximum walking distance to a node (meters), cells further are nodata
+    :param cutoff: optional maximum drive time, same units as the edge weights
+    :param tile_size: tile edge in cells, a multiple of the 256 cell GeoTIFF blocks
+    :param n_workers: number of worker processes, defaults to os.cpu_count()
+    :param nodata: nodata value
+    :param weight: the edge attribute to route on when G has to be compiled
+    :returns: out_fil
+    """
+    if not isinstance(G, CSRGraph):
+        G = compile_graph(G, weight = weight)
+
+    names = list(services)
+    # drive time from every node to the nearest facility, seconds -> minutes
+    times = [node_times(G, services[n], cutoff = cutoff) / 60. for n in names]
+    graph_idx = G.index(snap_idx.node_ids.tolist())
+
+    aoi_geom = unary_union(list(aoi.to_crs(snap_idx.crs).geometry))
+    minx, miny, maxx, maxy = aoi_geom.bounds
+    left = float(np.floor(minx / resolution) * resolution)
+    top = float(np.ceil(maxy / resolution) * resolution)
+    width = int(np.ceil((maxx - left) / resolution))
+    height = int(np.ceil((top - miny) / resolution))
+    transform = from_origin(left, top, resolution, resolution)
+
+    windows = [(r, c, min(tile_size, height - r), min(tile_size, width - c))
+               for r in range(0, height, tile_size) for c in range(0, width, tile_size)]
+
+    state = dict(snap_idx = snap_idx, graph_idx = graph_idx, times = times, k = k,
+                 walk_m_per_min = walk_speed * 1000 / 60., max_walk_dist = max_walk_dist,
+                 resolution = resolution, origin = (left, top), transform = transform,
+                 aoi = aoi_geom, nodata = nodata)
+
+    profile = dict(driver = 'GTiff', width = width, height = height, count = len(names), dtype = 'float32',
+                   crs = snap_idx.crs, transform = transform, nodata = nodata, tiled = True,
+                   blockxsize = 256, blockysize = 256, compress = 'deflate', predictor = 3, BIGTIFF = 'IF_SAFER')
+
+    n_workers = n_workers or os.cpu_count() or 1
+    with rasterio.open(out_fil, 'w', **profile) as dst:
+        for b, n in enumerate(names):
+            dst.set_band_description(b + 1, str(n))
+
+        if n_workers == 1 or len(windows) == 1:
+            _tile_state.update(state)
+            try:
+                for window in windows:
+                    (r, c, h, w), out = _tile(window)
+                    dst.write(out, window = Window(c, r, w, h))
+            finally:
+                _tile_state.clear()
+            return out_fil
+
+        if 'fork' in mp.get_all_start_methods():
+            ctx = mp.get_context('fork')
+            _tile_state.update(state)
+            initargs = (None,)
+        else:
+            ctx = mp.get_context()
+            initargs = (state,)
+        try:
+            with ctx.Pool(min(n_workers, len(windows)), initializer = _init_tile_worker,
+                          initargs = initargs) as pool:
+                # tiles are written as they finish, in any order
+                for (r, c, h, w), out in pool.imap_unordered(_tile, windows):
+                    dst.write(out, window = Window(c, r, w, h))
+        finally:
+            _tile_state.clear()
+
+    return out_fil
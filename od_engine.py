@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Morocco Accessibility Model: OD engine
+#
+# helper functions for the OD stage (phase 3) that work alongside gn.calculate_OD.
+# G_time is the graph produced by gn.convert_network_to_time in MAR_prepNetwork,
+# edge travel times are stored in seconds on the 'time' attribute.
+# functions accept either the networkx G_time or a CSRGraph compiled from it (see csr_graph.py).
+
+import multiprocessing as mp
+import os
+from heapq import heappush, heappop
+from itertools import count
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse import csgraph
+
+from csr_graph import CSRGraph, compile_graph
+
+
+# default memory budget of one block of shortest-path trees (chunk_size x nodes float64 distances), in bytes
+OD_BLOCK_BYTES = 256 << 20
+
+def _edge_weight(edata, weight, multigraph):
+    # for multigraphs (osmnx / GOSTnets output) take the fastest parallel edge
+    if multigraph:
+        return min(d.get(weight, 1) for d in edata.values())
+    return edata.get(weight, 1)
+
+
+def multi_source_dijkstra(G, sources, weight = 'time', reverse = False, cutoff = None):
+    """
+    Function for running one Dijkstra search from many sources at once
+
+    :param G: a graph containing one or more nodes
+    :param sources: a list of source nodes. Nodes not in G are ignored
+    :param weight: the edge attribute holding the travel cost
+    :param reverse: if True, walk edges backwards (v -> u), i.e. search on the reversed graph without copying it
+    :param cutoff: optional maximum cost, nodes beyond it are not settled
+    :returns: two dicts, {node: shortest cost} and {node: source that reached it first}
+    """
+    adj = G.pred if reverse else G.succ
+    multigraph = G.is_multigraph()
+
+    dist = {}
+    label = {}
+    seen = {}
+    c = count()
+    heap = []
+    for s in sources:
+        if s in G and s not in seen:
+            seen[s] = 0
+            heappush(heap, (0, next(c), s, s))
+
+    while heap:
+        d, _, v, src = heappop(heap)
+        if v in dist:
+            continue
+        dist[v] = d
+        label[v] = src
+        for u, edata in adj[v].items():
+            vu_dist = d + _edge_weight(edata, weight, multigraph)
+            if cutoff is not None and vu_dist > cutoff:
+                continue
+            if u not in seen or vu_dist < seen[u]:
+                seen[u] = vu_dist
+                heappush(heap, (vu_dist, next(c), u, src))
+
+    return dist, label
+
+
+def nearest_facility(G, origins, destinations, fail_value = 9999999, weight = 'time', cutoff = None):
+    """
+    Function for finding the nearest destination for every origin
+
+    Instead of building the full origins x destinations matrix with gn.calculate_OD,
+    this runs a single multi-source Dijkstra from all destination nodes on the reversed graph.
+
+    :param G: a graph containing one or more nodes
+    :param origins: a list of origin nodes (e.g. villages_ls)
+    :param destinations: a list of destination nodes (e.g. health_ls)
+    :param fail_value: the value to return if no destination can be reached from the origin (within cutoff)
+    :param weight: the edge attribute to route on
+    :param cutoff: optional maximum travel time (same units as the edge weights), the search stops there
+    :returns: a pandas DataFrame indexed by origin with columns 'time' (shortest time to any destination)
+              and 'nearest' (the destination node that achieves it, None if unreachable)
+    """
+    if isinstance(G, CSRGraph):
+        return _nearest_facility_csr(G, origins, destinations, fail_value, cutoff)
+
+    dist, label = multi_source_dijkstra(G, destinations, weight = weight, reverse = True, cutoff = cutoff)
+
+    times = np.array([dist.get(o, fail_value) for o in origins], dtype = float)
+    nearest = pd.Series([label.get(o) for o in origins], dtype = object)
+
+    return pd.DataFrame({'time': times, 'nearest': nearest.values}, index = list(origins))
+
+
+def _nearest_facility_csr(G, origins, destinations, fail_value, cutoff = None):
+    o_idx = G.index(origins)
+    d_idx = G.index(destinations)
+    d_idx = np.unique(d_idx[d_idx >= 0])
+
+    times = np.full(len(o_idx), fail_value, dtype = float)
+    nearest = pd.Series([None] * len(o_idx), dtype = object)
+    if len(d_idx) > 0:
+        dist, _, sources = csgraph.dijkstra(G.matrix_T, directed = True, indices = d_idx,
+                                            return_predecessors = True, min_only = True,
+                                            limit = np.inf if cutoff is None else cutoff)
+        valid = o_idx >= 0
+        o_dist = np.full(len(o_idx), np.inf)
+        o_dist[valid] = dist[o_idx[valid]]
+        reached = np.isfinite(o_dist)
+        times[reached] = o_dist[reached]
+        nearest[reached] = G.node_ids[sources[o_idx[reached]]]
+
+    return pd.DataFrame({'time': times, 'nearest': nearest.values}, index = list(origins))
+
+
+def od_chunk_size(G, chunk_size = None, max_bytes = OD_BLOCK_BYTES):
+    """
+    Function for the number of shortest-path trees computed per block
+
+    every tree holds a float64 distance for each node of the graph, so a fixed chunk would need about 10 GB per
+    block on the national graph. The chunk is taken from the memory budget instead.
+
+    :param G: a CSRGraph
+    :param chunk_size: a fixed number of trees per block, returned as it is when set
+    :param max_bytes: memory budget of one block in bytes
+    :returns: number of trees per block, at least 1
+    """
+    if chunk_size:
+        return int(chunk_size)
+    return max(1, int(max_bytes // (8 * max(1, G.n_nodes))))
+
+
+def iter_OD_blocks(G, origins, destinations, cutoff = None, chunk_size = None, max_bytes = OD_BLOCK_BYTES):
+    """
+    Generator over blocks of an origin: destination matrix on the compiled graph
+
+    Shortest-path trees are grown with scipy.sparse.csgraph from whichever side of the matrix is smaller
+    (from the destinations on the reversed graph when there are fewer destinations than origins),
+    chunk_size trees at a time so memory stays bounded.
+
+    :param G: a CSRGraph
+    :param origins: a list of origin nodes
+    :param destinations: a list of destination nodes
+    :param cutoff: optional maximum travel time (same units as the edge weights), searches stop there
+    :param chunk_size: number of shortest-path trees computed per block, None derives it from max_bytes
+    :param max_bytes: memory budget of one block in bytes, see od_chunk_size
+    :returns: yields (rows, cols, block) where rows / cols are positions in origins / destinations and
+              block[i, j] is the time from origins[rows[i]] to destinations[cols[j]], inf if not reached
+    """
+    o_idx = G.index(origins)
+    d_idx = G.index(destinations)
+    limit = np.inf if cutoff is None else cutoff
+
+    reverse = len(d_idx) < len(o_idx)
+    if reverse:
+        matrix, src_idx, tgt_idx = G.matrix_T, d_idx, o_idx
+    else:
+        matrix, src_idx, tgt_idx = G.matrix, o_idx, d_idx
+
+    src_rows = np.flatnonzero(src_idx >= 0)
+    tgt_cols = np.flatnonzero(tgt_idx >= 0)
+    chunk_size = od_chunk_size(G, chunk_size, max_bytes)
+    for start in range(0, len(src_rows), chunk_size):
+        rows = src_rows[start:start + chunk_size]
+        dist = csgraph.dijkstra(matrix, directed = True, indices = src_idx[rows], limit = limit)
+        block = dist[:, tgt_idx[tgt_cols]]
+        if reverse:
+            yield tgt_cols, rows, block.T
+        else:
+            yield rows, tgt_cols, block
+
+
+def calculate_OD(G, origins, destinations, fail_value = 9999999, weight = 'time', chunk_size = None,
+                 cutoff = None, max_bytes = OD_BLOCK_BYTES):
+    """
+    Function for generating an origin: destination matrix on the compiled graph
+
+    drop-in for gn.calculate_OD, built from iter_OD_blocks.
+
+    :param G: a CSRGraph, or a networkx graph which is compiled first
+    :param origins: a list of origin nodes
+    :param destinations: a list of destination nodes
+    :param fail_value: the value to return if the trip cannot be completed, or takes longer than cutoff
+    :param weight: the edge attribute to route on when G has to be compiled
+    :param chunk_size: number of shortest-path trees computed per block, None derives it from max_bytes
+    :param cutoff: optional maximum travel time (same units as the edge weights, seconds for G_time)
+    :param max_bytes: memory budget of one block in bytes, see od_chunk_size
+    :returns: a numpy matrix of format OD[o][d] = shortest time possible
+    """
+    if not isinstance(G, CSRGraph):
+        G = compile_graph(G, weight = weight)
+
+    OD = np.full((len(origins), len(destinations)), fail_value, dtype = float)
+    for rows, cols, block in iter_OD_blocks(G, origins, destinations, cutoff = cutoff, chunk_size = chunk_size,
+                                            max_bytes = max_bytes):
+        block[np.isinf(block)] = fail_value
+        OD[np.ix_(rows, cols)] = block
+
+    return OD
+
+
+def calculate_OD_sparse(G, origins, destinations, cutoff, weight = 'time', chunk_size = None,
+                        max_bytes = OD_BLOCK_BYTES):
+    """
+    Function for generating a bounded origin: destination matrix stored sparsely
+
+    searches stop at cutoff and only the pairs reached within it are stored, so for dense destination
+    sets (e.g. schools) the output grows with the number of nearby pairs rather than origins x destinations.
+
+    :param G: a CSRGraph, or a networkx graph which is compiled first
+    :param origins: a list of origin nodes
+    :param destinations: a list of destination nodes
+    :param cutoff: maximum travel time (same units as the edge weights, seconds for G_time), e.g. 120 * 60
+    :param weight: the edge attribute to route on when G has to be compiled
+    :param chunk_size: number of shortest-path trees computed per block, None derives it from max_bytes
+    :param max_bytes: memory budget of one block in bytes, see od_chunk_size
+    :returns: a scipy.sparse csr_matrix of shape (origins, destinations). Pairs beyond cutoff or unreachable
+              are not stored. Zero-time pairs (origin and destination on the same node) are kept as explicit
+              entries, so test for stored entries rather than for zeros.
+    """
+    if not isinstance(G, CSRGraph):
+        G = compile_graph(G, weight = weight)
+
+    r_all, c_all, t_all = [], [], []
+    for rows, cols, block in iter_OD_blocks(G, origins, destinations, cutoff = cutoff, chunk_size = chunk_size,
+                                            max_bytes = max_bytes):
+        i, j = np.nonzero(np.isfinite(block))
+        r_all.append(rows[i])
+        c_all.append(cols[j])
+        t_all.append(block[i, j].astype(np.float32))
+
+    shape = (len(origins), len(destinations))
+    if not t_all:
+        return sparse.csr_matrix(shape, dtype = np.float32)
+    return sparse.csr_matrix((np.concatenate(t_all), (np.concatenate(r_all), np.concatenate(c_all))),
+                             shape = shape)
+
+
+# state shared with OD worker processes, set once per pool (inherited on fork, sent once per worker otherwise)
+_worker_state = {}
+
+
+def _init_od_worker(state):
+    if state is not None:
+        _worker_state.update(state)
+
+
+def _od_block(bounds):
+    start, stop = bounds
+    st = _worker_state
+    return calculate_OD(st['G'], st['origins'][start:stop], st['destinations'],
+                        fail_value = st['fail_value'], chunk_size = st['chunk_size'], cutoff = st['cutoff'],
+                        max_bytes = st['max_bytes'])
+
+
+def calculate_OD_parallel(G, origins, destinations, fail_value = 9999999, weight = 'time',
+                          n_workers = None, block_size = None, chunk_size = None, cutoff = None,
+                          max_bytes = OD_BLOCK_BYTES):
+    """
+    Function for generating an origin: destination matrix across a pool of worker processes
+
+    origins are split into contiguous blocks, each worker solves its blocks with calculate_OD and the row
+    blocks are stacked back in the original origin order. The compiled graph is handed to the workers once:
+    inherited through fork where available, otherwise sent once per worker at pool start, never per task.
+
+    :param G: a CSRGraph, or a networkx graph which is compiled first
+    :param origins: a list of origin nodes (e.g. villages_ls)
+    :param destinations: a list of destination nodes
+    :param fail_value: the value to return if the trip cannot be completed
+    :param weight: the edge attribute to route on when G has to be compiled
+    :param n_workers: number of worker processes, defaults to os.cpu_count()
+    :param block_size: number of origins per task, defaults to an even split of 4 tasks per worker
+    :param chunk_size: number of shortest-path trees computed per block inside a worker, None derives it
+                       from max_bytes
+    :param cutoff: optional maximum travel time (same units as the edge weights), see calculate_OD
+    :param max_bytes: memory budget in bytes of the blocks of all workers together, split evenly between them
+    :returns: a numpy matrix of format OD[o][d] = shortest time possible
+    """
+    if not isinstance(G, CSRGraph):
+        G = compile_graph(G, weight = weight)
+
+    origins = list(origins)
+    n_workers = n_workers or os.cpu_count() or 1
+    if block_size is None:
+        block_size = max(1, -(-len(origins) // (n_workers * 4)))
+    blocks = [(i, min(i + block_size, len(origins))) for i in range(0, len(origins), block_size)]
+
+    if n_workers == 1 or len(blocks) <= 1:
+        return calculate_OD(G, origins, destinations, fail_value = fail_value, chunk_size = chunk_size,
+                            cutoff = cutoff, max_bytes = max_bytes)
+
+    n_workers = min(n_workers, len(blocks))
+    state = dict(G = G, origins = origins, destinations = list(destinations), fail_value = fail_value,
+                 chunk_size = chunk_size, cutoff = cutoff, max_bytes = max_bytes // n_workers)
+
+    if 'fork' in mp.get_all_start_methods():
+        ctx = mp.get_context('fork')
+        _worker_state.update(state)
+        initargs = (None,)
+    else:
+        ctx = mp.get_context()
+        initargs = (state,)
+
+    try:
+        with ctx.Pool(n_workers, initializer = _init_od_worker, initargs = initargs) as pool:
+            # map keeps the block order, so rows come back in the original origin order
+            parts = pool.map(_od_block, blocks)
+    finally:
+        _worker_state.clear()
+
+    return np.vstack(parts)
+
+
+def calculate_OD_services(G, origins, services, fail_value = 9999999, weight = 'time',
+                          n_workers = 1, chunk_size = None, cutoff = None, max_bytes = OD_BLOCK_BYTES):
+    """
+    Function for generating the OD matrices of several services in one pass
+
+    all services share the same origins and graph, so the destination sets are merged and every
+    shortest-path tree is grown once and read off for all services together, instead of one full
+    OD run per service.
+
+    :param G: a CSRGraph, or a networkx graph which is compiled first
+    :param origins: a list of origin nodes (e.g. villages_ls)
+    :param services: a dict of service name: list of destination nodes, e.g. {'health': health_ls, ...}
+    :param fail_value: the value to return if the trip cannot be completed
+    :param weight: the edge attribute to route on when G has to be compiled
+    :param n_workers: number of worker processes, more than 1 uses calculate_OD_parallel
+    :param chunk_size: number of shortest-path trees computed per block, None derives it from max_bytes
+    :param cutoff: optional maximum travel time (same units as the edge weights), see calculate_OD
+    :param max_bytes: memory budget of the blocks in bytes, shared by the workers, see od_chunk_size
+    :returns: a pandas DataFrame indexed by origin with (service, destination) columns,
+              df['health'] is the villages x health matrix
+    """
+    if not isinstance(G, CSRGraph):
+        G = compile_graph(G, weight = weight)
+
+    origins = list(origins)
+    names = list(services)
+    dests = [list(services[n]) for n in names]
+    union = list(dict.fromkeys(d for ds in dests for d in ds))
+
+    if n_workers is None or n_workers > 1:
+        OD = calculate_OD_parallel(G, origins, union, fail_value = fail_value, n_workers = n_workers,
+                                   chunk_size = chunk_size, cutoff = cutoff, max_bytes = max_bytes)
+    else:
+        OD = calculate_OD(G, origins, union, fail_value = fail_value, chunk_size = chunk_size, cutoff = cutoff,
+                          max_bytes = max_bytes)
+
+    pos = {d: i for i, d in enumerate(union)}
+    cols = np.array([pos[d] for ds in dests for d in ds], dtype = np.int64)
+    columns = pd.MultiIndex.from_tuples([(n, d) for n, ds in zip(names, dests) for d in ds],
+                                        names = ['service', 'destination'])
+
+    return pd.DataFrame(OD[:, cols], index = origins, columns = columns)
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Morocco Accessibility Model: OD outputs
+#
+# writers for the OD stage (phase 4) that stream results to disk block by block, so peak memory
+# does not grow with villages x facilities.
+
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from csr_graph import CSRGraph, compile_graph, node_id_array
+from od_engine import OD_BLOCK_BYTES, iter_OD_blocks, od_chunk_size
+
+
+def _merge_top_k(best_t, best_d, rows, sub, sub_d, k):
+    # keep the k smallest times per row across the running best and the new block
+    cand_t = np.hstack([best_t[rows], sub])
+    cand_d = np.hstack([best_d[rows], np.broadcast_to(sub_d, sub.shape)])
+    if cand_t.shape[1] > k:
+        idx = np.argpartition(cand_t, k - 1, axis = 1)[:, :k]
+        cand_t = np.take_along_axis(cand_t, idx, axis = 1)
+        cand_d = np.take_along_axis(cand_d, idx, axis = 1)
+    best_t[rows] = cand_t
+    best_d[rows] = cand_d
+
+
+def prepare_out_pth(out_pth, overwrite = False):
+    """
+    Function for making sure a dataset folder starts empty, so part files of an earlier run cannot survive a rerun
+
+    :param out_pth: output folder
+    :param overwrite: remove the folder and everything in it when it is not empty, otherwise raise a ValueError
+    :returns: out_pth
+    """
+    if os.path.isdir(out_pth) and os.listdir(out_pth):
+        if not overwrite:
+            raise ValueError('%s is not empty, pass overwrite = True to replace it' % out_pth)
+        shutil.rmtree(out_pth)
+    elif os.path.exists(out_pth) and not os.path.isdir(out_pth):
+        if not overwrite:
+            raise ValueError('%s exists and is not a folder, pass overwrite = True to replace it' % out_pth)
+        os.remove(out_pth)
+    return out_pth
+
+
+def write_OD_parquet(G, origins, destinations, out_pth, cutoff = None, top_k = None, unit = 60.,
+                     weight = 'time', chunk_size = None, compression = 'snappy', overwrite = False,
+                     max_bytes = OD_BLOCK_BYTES):
+    """
+    Function for streaming an origin: destination matrix to Parquet in long format
+
+    rows are (origin_id, destination_id, minutes) and only reached pairs are written. Each block of
+    shortest-path trees is flushed to its own part file as soon as it is computed. With several services
+    the destination sets are solved in one pass and written to hive-style partitions (service=health/...),
+    so the output folder opens as one dataset in pandas / pyarrow / QGIS.
+
+    :param G: a CSRGraph, or a networkx graph which is compiled first
+    :param origins: a list of origin nodes (e.g. villages_ls)
+    :param destinations: a list of destination nodes, or a dict of service name: list of destination nodes
+    :param out_pth: output folder
+    :param cutoff: optional maximum travel time (same units as the edge weights), pairs beyond it are not written
+    :param top_k: if set, only write the k nearest destinations per origin (and service), with a 'rank' column
+    :param unit: divisor applied to the edge weight unit, 60 converts the seconds of G_time to minutes
+    :param weight: the edge attribute to route on when G has to be compiled
+    :param chunk_size: number of shortest-path trees computed (and rows blocks flushed) at a time, None derives it
+                       from max_bytes
+    :param compression: parquet compression codec
+    :param overwrite: replace out_pth when it already holds files, otherwise a non-empty out_pth raises a ValueError
+    :param max_bytes: memory budget of one block of shortest-path trees in bytes, see od_engine.od_chunk_size
+    :returns: a list of the part files written
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    prepare_out_pth(out_pth, overwrite = overwrite)
+    if not isinstance(G, CSRGraph):
+        G = compile_graph(G, weight = weight)
+
+    origins = list(origins)
+    if isinstance(destinations, dict):
+        services = {name: list(ds) for name, ds in destinations.items()}
+    else:
+        services = {None: list(destinations)}
+    union = list(dict.fromkeys(d for ds in services.values() for d in ds))
+    pos = {d: i for i, d in enumerate(union)}
+    svc_cols = {name: np.array([pos[d] for d in ds], dtype = np.int64) for name, ds in services.items()}
+    chunk_size = od_chunk_size(G, chunk_size, max_bytes)
+    svc_ids = {name: node_id_array(ds) for name, ds in services.items()}
+    o_ids = node_id_array(origins)
+
+    written = []
+    parts = {name: 0 for name in services}
+
+    def _flush(name, columns):
+        folder = out_pth if name is None else os.path.join(out_pth, 'service=%s' % name)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        fil = os.path.join(folder, 'part-%05d.parquet' % parts[name])
+        pq.write_table(pa.table(columns), fil, compression = compression)
+        parts[name] += 1
+        written.append(fil)
+
+    if top_k:
+        best = {name: (np.full((len(origins), top_k), np.inf),
+                       np.full((len(origins), top_k), -1, dtype = np.int64)) for name in services}
+
+    for rows, cols, block in iter_OD_blocks(G, origins, union, cutoff = cutoff, chunk_size = chunk_size):
+        # union position -> column in this block
+        colpos = np.full(len(union), -1, dtype = np.int64)
+        colpos[cols] = np.arange(len(cols))
+        for name, sc in svc_cols.items():
+            bc = colpos[sc]
+            sub_d = np.flatnonzero(bc >= 0)
+            sub = block[:, bc[sub_d]]
+            if top_k:
+                _merge_top_k(best[name][0], best[name][1], rows, sub, sub_d, top_k)
+                continue
+            i, j = np.nonzero(np.isfinite(sub))
+            if len(i) == 0:
+                continue
+            _flush(name, {'origin_id': o_ids[rows[i]],
+                          'destination_id': svc_ids[name][sub_d[j]],
+                          'minutes': (sub[i, j] / unit).astype(np.float32)})
+
+    if top_k:
+        for name, (best_t, best_d) in best.items():
+            order = np.argsort(best_t, axis = 1, kind = 'stable')
+            best_t = np.take_along_axis(best_t, order, axis = 1)
+            best_d = np.take_along_axis(best_d, order, axis = 1)
+            for start in range(0, len(origins), chunk_size * 64):
+                bt = best_t[start:start + chunk_size * 64]
+                bd = best_d[start:start + chunk_size * 64]
+                i, j = np.nonzero(np.isfinite(bt))
+                if len(i) == 0:
+                    continue
+                _flush(name, {'origin_id': o_ids[start + i],
+                              'destination_id': svc_ids[name][bd[i, j]],
+                              'minutes': (bt[i, j] / unit).astype(np.float32),
+                              'rank': (j + 1).astype(np.int16)})
+
+    return written
+
+
+# nodata of the on-disk matrices, per dtype
+_NODATA = {'float32': np.inf, 'uint16': np.iinfo(np.uint16).max}
+
+
+def _encode(block, dtype):
+    # travel times (already in output units) -> stored values, unreached pairs -> nodata
+    if dtype == 'float32':
+        return block.astype(np.float32)
+    nodata = _NODATA[dtype]
+    out = np.round(np.where(np.isfinite(block), block, nodata))
+    return np.minimum(out, nodata).astype(np.uint16)
+
+
+class ODMatrix(object):
+    """
+    Origin: destination matrix stored as a memory-mapped .npy file
+
+    the folder holds matrix.npy, origins.npy / destinations.npy (the node IDs of the rows / columns) and
+    meta.json. Opening it maps the file without reading it, so rows and columns are only loaded when sliced.
+
+    :param path: the store folder
+    :param matrix: the memory-mapped matrix
+    :param origins: array of origin node IDs, one per row
+    :param destinations: array of destination node IDs, one per column
+    :param meta: dict with 'unit' (divisor applied to the edge weights, 60 = minutes for G_time) and 'nodata'
+    """
+    def __init__(self, path, matrix, origins, destinations, meta):
+        self.path = path
+        self.matrix = matrix
+        self.origins = origins
+        self.destinations = destinations
+        self.meta = meta
+        self._o_index = None
+        self._d_index = None
+
+    def __repr__(self):
+        return 'ODMatrix %d x %d %s, unit %g' % (self.shape[0], self.shape[1], self.matrix.dtype, self.unit)
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    @property
+    def unit(self):
+        return self.meta['unit']
+
+    @property
+    def nodata(self):
+        return self.meta['nodata']
+
+    @classmethod
+    def create(cls, path, origins, destinations, dtype = 'float32', unit = 60.):
+        """
+        Function for an empty store, every pair set to nodata
+
+        :param path: output folder
+        :param origins: list of origin nodes
+        :param destinations: list of destination nodes
+        :param dtype: 'float32', or 'uint16' for whole output units (e.g. minutes), at half the size
+        :param unit: divisor applied to the edge weights before storing
+        :returns: an ODMatrix opened for writing
+        """
+        if dtype not in _NODATA:
+            raise ValueError('dtype must be one of %s' % list(_NODATA))
+        if not os.path.exists(path):
+            os.makedirs(path)
+        origins = node_id_array(list(origins))
+        destinations = node_id_array(list(destinations))
+        np.save(os.path.join(path, 'origins.npy'), origins)
+        np.save(os.path.join(path, 'destinations.npy'), destinations)
+        meta = {'dtype': dtype, 'unit': float(unit), 'nodata': _NODATA[dtype]}
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+        matrix = np.lib.format.open_memmap(os.path.join(path, 'matrix.npy'), mode = 'w+', dtype = dtype,
+                                           shape = (len(origins), len(destinations)))
+        step = max(1, (1 << 24) // max(1, len(destinations)))
+        for start in range(0, len(origins), step):
+            matrix[start:start + step] = meta['nodata']
+        return cls(path, matrix, origins, destinations, meta)
+
+    @classmethod
+    def open(cls, path, mode = 'r'):
+        """
+        Function for opening a store without reading the matrix
+
+        :param path: the store folder
+        :param mode: 'r' read only, 'r+' to convert units or write in place
+        :returns: an ODMatrix
+        """
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        matrix = np.load(os.path.join(path, 'matrix.npy'), mmap_mode = mode)
+        origins = np.load(os.path.join(path, 'origins.npy'), allow_pickle = True)
+        destinations = np.load(os.path.join(path, 'destinations.npy'), allow_pickle = True)
+        return cls(path, matrix, origins, destinations, meta)
+
+    def __getitem__(self, key):
+        return self.matrix[key]
+
+    def _positions(self, nodes, axis):
+        if axis == 0:
+            if self._o_index is None:
+                self._o_index = pd.Index(self.origins)
+            index = self._o_index
+        else:
+            if self._d_index is None:
+                self._d_index = pd.Index(self.destinations)
+            index = self._d_index
+        return index.get_indexer(list(nodes))
+
+    def rows(self, origins):
+        """
+        Function for the rows of some origins, only those rows are read from disk
+
+        :param origins: list of origin nodes
+        :returns: array (len(origins), n destinations), nodata rows for unknown origins
+        """
+        pos = self._positions(origins, 0)
+        out = np.full((len(pos), self.shape[1]), self.nodata, dtype = self.matrix.dtype)
+        found = pos >= 0
+        out[found] = self.matrix[pos[found]]
+        return out
+
+    def cols(self, destinations):
+        """
+        Function for the columns of some destinations
+
+        :param destinations: list of destination nodes
+        :returns: array (n origins, len(destinations)), nodata columns for unknown destinations
+        """
+        pos = self._positions(destinations, 1)
+        out = np.full((self.shape[0], len(pos)), self.nodata, dtype = self.matrix.dtype)
+        found = np.flatnonzero(pos >= 0)
+        step = max(1, (1 << 24) // max(1, self.shape[1]))
+        for start in range(0, self.shape[0], step):
+            out[start:start + step, found] = self.matrix[start:start + step, pos[found]]
+        return out
+
+    def to_frame(self, origins = None, destinations = None, fail_value = 9999999):
+        """
+        Function for a labelled DataFrame of part of the matrix, like OD_VHdf
+
+        :param origins: list of origin nodes, None for all
+        :param destinations: list of destination nodes, None for all
+        :param fail_value: value for pairs that were not reached
+        :returns: a pandas DataFrame indexed by origin with one column per destination
+        """
+        origins = self.origins if origins is None else node_id_array(list(origins))
+        values = self.rows(origins)
+        if destinations is None:
+            destinations = self.destinations
+        else:
+            destinations = node_id_array(list(destinations))
+            pos = self._positions(destinations, 1)
+            values = np.where(pos >= 0, values[:, np.maximum(pos, 0)], self.nodata)
+        values = np.where(values == self.nodata, fail_value, values)
+        return pd.DataFrame(values, index = origins, columns = destinations)
+
+    def convert_units(self, divisor):
+        """
+        Function for converting the stored times in place, e.g. seconds to minutes, one row block at a time
+
+        needs a float32 store opened with mode 'r+'.
+
+        :param divisor: the stored values are divided by it, 60 converts seconds to minutes
+        """
+        if self.matrix.dtype != np.float32:
+            raise ValueError('only float32 stores can be converted in place')
+        step = max(1, (1 << 24) // max(1, self.shape[1]))
+        for start in range(0, self.shape[0], step):
+            self.matrix[start:start + step] /= np.float32(divisor)
+        self.flush()
+        self.meta['unit'] = self.meta['unit'] * divisor
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f)
+
+    def flush(self):
+        if hasattr(self.matrix, 'flush'):
+            self.matrix.flush()
+
+
+def write_OD_memmap(G, origins, destinations, out_pth, dtype = 'float32', unit = 60., cutoff = None,
+                    weight = 'time', chunk_size = None, max_bytes = OD_BLOCK_BYTES):
+    """
+    Function for writing an origin: destination matrix to a memory-mapped store, block by block
+
+    the full matrix is never held in memory: each block of shortest-path trees is written to the mapped file
+    as soon as it is computed. With several services the destination sets are solved in one pass and each
+    service gets its own store in out_pth/service=<name>.
+
+    :param G: a CSRGraph, or a networkx graph which is compiled first
+    :param origins: a list of origin nodes (e.g. villages_ls)
+    :param destinations: a list of destination nodes, or a dict of service name: list of destination nodes
+    :param out_pth: output folder
+    :param dtype: 'float32', or 'uint16' to store whole output units (rounded), unreached pairs are nodata
+    :param unit: divisor applied to the edge weight unit, 60 converts the seconds of G_time to minutes
+    :param cutoff: optional maximum travel time (same units as the edge weights), pairs beyond it are nodata
+    :param weight: the edge attribute to route on when G has to be compiled
+    :param chunk_size: number of shortest-path trees computed per block, None derives it from max_bytes
+    :param max_bytes: memory budget of one block of shortest-path trees in bytes, see od_engine.od_chunk_size
+    :returns: an ODMatrix, or a dict of service name: ODMatrix
+    """
+    if not isinstance(G, CSRGraph):
+        G = compile_graph(G, weight = weight)
+
+    origins = list(origins)
+    if isinstance(destinations, dict):
+        services = {name: list(ds) for name, ds in destinations.items()}
+    else:
+        services = {None: list(destinations)}
+    union = list(dict.fromkeys(d for ds in services.values() for d in ds))
+    pos = {d: i for i, d in enumerate(union)}
+    svc_cols = {name: np.array([pos[d] for d in ds], dtype = np.int64) for name, ds in services.items()}
+
+    stores = {name: ODMatrix.create(out_pth if name is None else os.path.join(out_pth, 'service=%s' % name),
+                                    origins, ds, dtype = dtype, unit = unit)
+              for name, ds in services.items()}
+
+    for rows, cols, block in iter_OD_blocks(G, origins, union, cutoff = cutoff, chunk_size = chunk_size,
+                                            max_bytes = max_bytes):
+        colpos = np.full(len(union), -1, dtype = np.int64)
+        colpos[cols] = np.arange(len(cols))
+        for name, sc in svc_cols.items():
+            bc = colpos[sc]
+            sub_d = np.flatnonzero(bc >= 0)
+            if len(sub_d) == 0:
+                continue
+            stores[name].matrix[np.ix_(rows, sub_d)] = _encode(block[:, bc[sub_d]] / unit, dtype)
+
+    for store in stores.values():
+        store.flush()
+    if None in stores:
+        return stores[None]
+    return stores
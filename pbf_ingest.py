@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Morocco Accessibility Model: windowed PBF ingest
+#
+# reads only the roads of an area of interest out of a national osm.pbf. The road-type whitelist and the
+# AOI bounding box are handed to the OGR OSM driver so geometries are only built for candidate ways, the
+# exact intersect runs against a prepared AOI geometry, and a GeoDataFrame is built for the AOI roads only.
+# the output matches load_osm.OSM_to_network.roads_raw, so generateRoadsGDF / initialReadIn work unchanged.
+# GDAL and load_osm are only imported when a pbf is read, so importing this module, or pipeline.py, does not
+# need the GOSTnets / OGR stack.
+
+import re
+
+import geopandas as gpd
+from shapely import wkb
+from shapely.ops import unary_union
+from shapely.prepared import prep
+
+
+def _aoi_geometry(aoi):
+    # accept a shapely geometry in EPSG:4326 or a GeoDataFrame / GeoSeries in any CRS
+    if hasattr(aoi, 'geometry') and hasattr(aoi, 'crs'):
+        if aoi.crs is not None:
+            aoi = aoi.to_crs('epsg:4326')
+        return unary_union(list(aoi.geometry))
+    return aoi
+
+
+def _other_tag(other_tags, tag):
+    # value of one tag in the OGR OSM other_tags hstore string, e.g. '"surface"=>"unpaved","lanes"=>"2"'
+    if not other_tags:
+        return None
+    m = re.search(r'"%s"=>"((?:[^"\\]|\\.)*)"' % re.escape(tag), other_tags)
+    return m.group(1) if m else None
+
+
+def fetch_roads_aoi(osmFile, aoi, acceptedRoads = None, includeFerries = False, tags = None):
+    """
+    Function for reading the roads inside an area of interest from an osm.pbf
+
+    :param osmFile: path to the osm.pbf
+    :param aoi: the AOI, a shapely geometry in EPSG:4326 or a GeoDataFrame (e.g. tinghirP.shp)
+    :param acceptedRoads: list of highway types to keep (e.g. accepted_roadTypes), None keeps all
+    :param includeFerries: also keep ferry routes, as load_osm.OSM_to_network(includeFerries = True)
+    :param tags: optional list of other OSM tags to add as columns, e.g. ['surface'], None where a way has none
+    :returns: a GeoDataFrame with columns osm_id, infra_type, [tags], geometry in EPSG:4326
+    """
+    from osgeo import gdal, ogr
+
+    tags = list(tags or [])
+    aoi = _aoi_geometry(aoi)
+    aoi_prep = prep(aoi)
+    minx, miny, maxx, maxy = aoi.bounds
+
+    # index node locations on disk, the national file does not fit the default in-memory index
+    gdal.SetConfigOption('OSM_USE_CUSTOM_INDEXING', 'YES')
+    gdal.SetConfigOption('OSM_COMPRESS_NODES', 'YES')
+
+    where = ['highway IS NOT NULL']
+    if acceptedRoads is not None:
+        where = ["highway IN (%s)" % ', '.join("'%s'" % r.replace("'", "''") for r in acceptedRoads)]
+    if includeFerries:
+        where.append("other_tags LIKE '%\"route\"=>\"ferry\"%'")
+    sql = "SELECT osm_id, highway, other_tags FROM lines WHERE %s" % ' OR '.join(where)
+
+    bbox = ogr.CreateGeometryFromWkt('POLYGON ((%f %f, %f %f, %f %f, %f %f, %f %f))' % (
+        minx, miny, maxx, miny, maxx, maxy, minx, maxy, minx, miny))
+
+    data = ogr.GetDriverByName('OSM').Open(osmFile)
+    # the bbox filter is applied while the driver decodes, ways outside it never get a geometry
+    lyr = data.ExecuteSQL(sql, spatialFilter = bbox)
+
+    roads = []
+    for feature in lyr:
+        geom = feature.GetGeometryRef()
+        if geom is None:
+            continue
+        shapely_geo = wkb.loads(bytes(geom.ExportToWkb()))
+        if not aoi_prep.intersects(shapely_geo):
+            continue
+        highway = feature.GetField('highway')
+        if highway is None:
+            highway = 'ferry'
+        other_tags = feature.GetField('other_tags') if tags else None
+        roads.append([feature.GetField('osm_id'), highway] + [_other_tag(other_tags, t) for t in tags] +
+                     [shapely_geo])
+
+    data.ReleaseResultSet(lyr)
+    data = None
+
+    return gpd.GeoDataFrame(roads, columns = ['osm_id', 'infra_type'] + tags + ['geometry'], crs = 'epsg:4326')
+
+
+def OSM_to_network_aoi(osmFile, aoi, acceptedRoads = None, includeFerries = False, tags = None):
+    """
+    Function for a load_osm.OSM_to_network restricted to an area of interest
+
+    same object as losm.OSM_to_network(osmFile), but roads_raw only holds the whitelisted roads intersecting
+    the AOI, so the rest of the country is never loaded into a GeoDataFrame.
+
+    :param osmFile: path to the osm.pbf
+    :param aoi: the AOI, a shapely geometry in EPSG:4326 or a GeoDataFrame
+    :param acceptedRoads: list of highway types to keep, None keeps all
+    :param includeFerries: also keep ferry routes
+    :param tags: optional list of other OSM tags to read, e.g. ['surface']. They are kept apart from roads_raw
+                 (the network build only carries infra_type and osm_id) in .tags, indexed by osm_id
+    :returns: a load_osm.OSM_to_network
+    """
+    import load_osm as losm
+
+    roads = fetch_roads_aoi(osmFile, aoi, acceptedRoads = acceptedRoads, includeFerries = includeFerries,
+                            tags = tags)
+    tags = list(tags or [])
+    # OSM_to_network.__init__ reads the whole pbf, the instance is filled with the AOI roads instead
+    net = losm.OSM_to_network.__new__(losm.OSM_to_network)
+    net.osmFile = osmFile
+    net.tags = roads[['osm_id'] + tags].drop_duplicates('osm_id').set_index('osm_id')
+    net.roads_raw = roads.drop(columns = tags)
+    return net
@@ -0,0 +1,456 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Morocco Accessibility Model: pipeline
+#
+# one entry point for the prep network and OD scripts. A YAML / TOML config gives the PBF, the AOI, the speed
+# dictionary, the origin layer, the named destination layers, the cutoff and the outputs, and the whole chain
+# (ingest -> clean -> largest component -> time -> snap -> OD -> export) runs in one process, with every
+# intermediate kept in memory (and in the stage cache). The point layers are read while the network is
+# built, the snap index is built while G_time is compiled, and the exports are written while the next OD
+# output is computed. Seasonal speed profiles add a village x service x season table of nearest facility times.
+# A config can list several jobs (e.g. one per province) that only override some keys; they run as independent
+# concurrent processes. With a 'batch' layer of provinces, one job builds the national network once and solves
+# every province over it (see batch_aoi.py).
+#
+#     python pipeline.py tinghir.yml
+#     python pipeline.py provinces.yml --jobs tinghir ouarzazate --n-jobs 2
+
+import argparse
+import concurrent.futures as cf
+import copy
+import json
+import multiprocessing as mp
+import os
+import sys
+
+import geopandas as gpd
+import pandas as pd
+
+import aggregate as agg
+import batch_aoi as bat
+import components as cmp
+import csr_graph as csr
+import graph_store as gs
+import od_engine as ode
+import od_store as ods
+import profiling as prf
+import scenarios as scn
+import snap_index as si
+import stage_cache as sc
+import tiled_clean as tcl
+import walk_model as wm
+
+# every key a config can set, with the values of the Tinghir scripts
+DEFAULTS = {
+    'name': 'run',
+    'pbf': None,                # national osm.pbf, or
+    'graph': None,              # a graph_store folder (e.g. outputs/mar_unclean), used instead of the pbf
+    'aoi': None,                # AOI polygon layer, all features are merged
+    'aoi_filter': None,         # {column: value} selecting the AOI features, e.g. {'NAME': 'Tinghir'}
+    'batch': None,              # {'layer': provinces, 'name_col': 'NAME', 'buffer': 20000}, one network for all
+    'roads': ['residential', 'unclassified', 'track', 'service', 'tertiary', 'road', 'secondary', 'primary',
+              'trunk', 'primary_link', 'trunk_link', 'tertiary_link', 'secondary_link'],
+    'utm': 32629,
+    'wgs': 4326,
+    # clean: None skips cleaning, tile_size None cleans the whole network at once with gn.clean_network.
+    # stitch_tol: meters, new junction nodes of neighbouring tiles closer than this are merged
+    'clean': {'tolerance': 0.5, 'tile_size': 50000, 'overlap': 5000, 'stitch_tol': 1.},
+    'speeds': {'residential': 30, 'primary': 60, 'primary_link': 55, 'trunk': 40, 'trunk_link': 35,
+               'secondary': 50, 'secondary_link': 45, 'tertiary': 40, 'tertiary_link': 35, 'unclassified': 30,
+               'road': 20, 'crossing': 20, 'living_street': 10},
+    'origins': None,            # village point layer
+    'clip_origins': True,       # keep only the origins inside the AOI
+    'destinations': {},         # {service: point layer}
+    'walk': {'min_dist': 5000, 'speed': 5, 'k': 3, 'friction': None},  # None skips the walking model
+    'seasons': None,            # {season: speed overrides on top of speeds, per road type or {surface: kmph}}
+    'calendar': None,           # {month: season}, output columns follow it, default one column per season
+    'cutoff': None,             # minutes, trips beyond it are unreached
+    'od_block_mb': 256,         # memory budget of the OD blocks of one job (shortest-path trees x nodes), in MB
+    'fail_value': 9999999,
+    'admin_cols': None,         # village columns to summarize by, e.g. ['commune']
+    'pop_col': None,
+    'outputs': {'dir': 'outputs', 'formats': ['csv'], 'top_k': None},   # formats: csv, parquet, memmap
+    'cache': 'cache',
+    'workers': None,            # worker processes per job, defaults to the cores shared between the jobs
+}
+
+# config keys holding file paths, resolved against the config folder
+_PATH_KEYS = ['pbf', 'graph', 'aoi', 'origins', 'cache']
+
+
+def _merge(base, over):
+    # nested dict update, over wins; None in over replaces the whole value
+    out = copy.deepcopy(base)
+    for k, v in over.items():
+        if isinstance(v, dict) and isinstance(out.get(k), dict):
+            out[k] = _merge(out[k], v)
+        else:
+            out[k] = copy.deepcopy(v)
+    return out
+
+
+def _resolve(cfg, root):
+    def _pth(p):
+        return p if p is None or os.path.isabs(p) else os.path.normpath(os.path.join(root, p))
+    for k in _PATH_KEYS:
+        cfg[k] = _pth(cfg.get(k))
+    cfg['destinations'] = {name: _pth(p) for name, p in (cfg.get('destinations') or {}).items()}
+    if cfg.get('walk') and cfg['walk'].get('friction'):
+        cfg['walk']['friction'] = _pth(cfg['walk']['friction'])
+    if cfg.get('batch'):
+        cfg['batch']['layer'] = _pth(cfg['batch']['layer'])
+    if cfg.get('outputs'):
+        cfg['outputs']['dir'] = _pth(cfg['outputs']['dir'])
+    return cfg
+
+
+def load_config(fil):
+    """
+    Function for reading a pipeline config
+
+    top-level keys are the defaults of every job (see DEFAULTS), a 'jobs' list of dicts (each with a 'name')
+    overrides them per job. Relative paths are read from the config folder.
+
+    :param fil: a .yml / .yaml or .toml file
+    :returns: a dict of job name: full job config
+    """
+    ext = os.path.splitext(fil)[1].lower()
+    if ext in ('.yml', '.yaml'):
+        import yaml
+        with open(fil) as f:
+            raw = yaml.safe_load(f) or {}
+    elif ext == '.toml':
+        try:
+            import tomllib
+        except ImportError:
+            import tomli as tomllib
+        with open(fil, 'rb') as f:
+            raw = tomllib.load(f)
+    else:
+        raise ValueError('config must be .yml, .yaml or .toml: %s' % fil)
+
+    root = os.path.dirname(os.path.abspath(fil))
+    jobs = raw.pop('jobs', None) or [{}]
+    base = _merge(DEFAULTS, raw)
+    out = {}
+    for job in jobs:
+        cfg = _resolve(_merge(base, job), root)
+        if cfg['name'] in out:
+            raise ValueError('duplicate job name: %s' % cfg['name'])
+        if cfg['pbf'] is None and cfg['graph'] is None:
+            raise ValueError('job %s: set pbf or graph' % cfg['name'])
+        if cfg['origins'] is None or not cfg['destinations']:
+            raise ValueError('job %s: set origins and destinations' % cfg['name'])
+        out[cfg['name']] = cfg
+    return out
+
+
+def read_aoi(cfg):
+    """
+    Function for the AOI of a job
+
+    :param cfg: a job config
+    :returns: a GeoDataFrame of the AOI features (aoi_filter applied), or None when the job has no AOI.
+              Batch jobs without an AOI use their province layer.
+    """
+    fil = cfg['aoi'] or (cfg['batch'] or {}).get('layer')
+    if fil is None:
+        return None
+    aoi = gpd.read_file(fil)
+    for col, value in (cfg.get('aoi_filter') or {}).items():
+        aoi = aoi[aoi[col] == value]
+    if len(aoi) == 0:
+        raise ValueError('job %s: no AOI feature matches %s' % (cfg['name'], cfg['aoi_filter']))
+    return aoi
+
+
+def _read_points(fil, aoi = None):
+    # point layer with x / y columns, optionally only the points inside the AOI
+    layer = gpd.read_file(fil)
+    if aoi is not None:
+        layer = layer[layer.intersects(aoi.to_crs(layer.crs).unary_union)]
+    layer['x'] = layer.geometry.x
+    layer['y'] = layer.geometry.y
+    return layer
+
+
+def _ingest(cfg, aoi):
+    # network of the AOI roads, from the pbf or a saved graph (cut to the AOI bounding box), and the OSM surface
+    # of every way (osm_id: surface) for the seasonal profiles, None when the edges carry it themselves
+    if cfg['pbf'] is not None:
+        import pbf_ingest as pbf
+        mar = pbf.OSM_to_network_aoi(cfg['pbf'], aoi, acceptedRoads = cfg['roads'], tags = ['surface'])
+        mar.generateRoadsGDF(verbose = False)
+        mar.initialReadIn()
+        return mar.network, mar.tags['surface'].dropna().to_dict()
+    G = gs.read_graph(cfg['graph']).to_networkx()
+    if aoi is None:
+        return G, None
+    minx, miny, maxx, maxy = aoi.to_crs('epsg:%d' % cfg['wgs']).total_bounds
+    return G.subgraph([n for n, d in G.nodes(data = True)
+                       if minx <= d['x'] <= maxx and miny <= d['y'] <= maxy]).copy(), None
+
+
+def _write_csv(out_pth, OD, villages_acc, stats):
+    if OD is not None:
+        for name in OD.columns.get_level_values(0).unique():
+            OD[name].to_csv(os.path.join(out_pth, 'OD_village2%s.csv' % name))
+    villages_acc.drop(columns = 'geometry').to_csv(os.path.join(out_pth, 'villages_accessibility.csv'))
+    if stats is not None:
+        stats.to_csv(os.path.join(out_pth, 'admin_accessibility.csv'))
+
+
+def run_job(cfg, n_workers = None, verbose = True):
+    """
+    Function for running one job of a config in this process
+
+    :param cfg: a job config, from load_config
+    :param n_workers: worker processes for the clean and OD stages, overrides cfg['workers']
+    :param verbose: print the stage cache messages
+    :returns: a dict with the output folder, the files written and the run report
+    """
+    # GOSTnets (and its GDAL stack) is only needed to run a job, not to import this module or load configs
+    import GOSTnets as gn
+
+    n_workers = n_workers or cfg['workers'] or os.cpu_count() or 1
+    out_pth = os.path.join(cfg['outputs']['dir'], cfg['name'])
+    if not os.path.exists(out_pth):
+        os.makedirs(out_pth)
+    cache = sc.StageCache(cfg['cache'], verbose = verbose)
+    prof = prf.RunProfiler(cfg['name'], out_dir = out_pth)
+    UTM = {'init': 'epsg:%d' % cfg['utm']}
+    WGS = {'init': 'epsg:%d' % cfg['wgs']}
+    services = list(cfg['destinations'])
+
+    aoi = read_aoi(cfg)
+    # background thread: the point layers are read (and clipped) while the network is built
+    io = cf.ThreadPoolExecutor(max_workers = 2)
+    # exports run in the background while the next OD output is computed
+    pending = []
+
+    def _drain():
+        # forking while a read / export thread holds a lock can deadlock the child, so the background work is
+        # finished before every stage that forks worker processes (tiled clean, provinces, OD)
+        for future in list(layers.values()) + pending:
+            future.result()
+
+    try:
+        layers = {'villages': io.submit(_read_points, cfg['origins'], aoi if cfg['clip_origins'] else None)}
+        for name in services:
+            layers[name] = io.submit(_read_points, cfg['destinations'][name])
+
+        source = cache.file_checksum(cfg['pbf']) if cfg['pbf'] is not None else \
+            [cache.file_checksum(os.path.join(cfg['graph'], f)) for f in ('nodes.parquet', 'edges.parquet')]
+        with prof.stage('ingest') as st:
+            G, surfaces = cache.run('aoi_network', lambda: _ingest(cfg, aoi),
+                                    [source, aoi, cfg['roads'], cfg['wgs'], ['surface']])
+            st.output(G)
+        upstream = 'aoi_network'
+
+        if cfg['clean']:
+            c = cfg['clean']
+
+            def _clean():
+                if c['tile_size'] is None:
+                    return gn.clean_network(G, out_pth, cfg['name'], UTM, WGS, c['tolerance'], verbose = False)
+                return tcl.clean_network_tiled(G, out_pth, cfg['name'], UTM, WGS, c['tolerance'],
+                                               tile_size = c['tile_size'], overlap = c['overlap'],
+                                               n_workers = n_workers, stitch_tol = c['stitch_tol'])
+
+            _drain()
+            with prof.stage('clean') as st:
+                G = st.output(cache.run('clean', _clean, [cache.keys[upstream], cfg['utm'], cfg['wgs'],
+                                                          c['tolerance'], c['tile_size'], c['overlap'],
+                                                          c['stitch_tol']]))
+            upstream = 'clean'
+
+        with prof.stage('largest') as st:
+            comps = cache.run('largest', lambda: cmp.strong_components(G), [cache.keys[upstream]])
+            G_main = st.output(comps.subgraph(G))
+            st.set(**comps.summary())
+
+        with prof.stage('time') as st:
+            G_time = st.output(cache.run('time', lambda: gn.convert_network_to_time(
+                G_main, distance_tag = 'length', road_col = 'infra_type', speed_dict = cfg['speeds'],
+                factor = 1000), [cache.keys['largest'], cfg['speeds'], 'length', 'infra_type', 1000]))
+
+        # the snap index (KD-tree, pyproj) is built in the background while G_time is compiled
+        with prof.stage('compile') as st:
+            snap_future = io.submit(cache.run, 'snap_index', lambda: si.build_snap_index(
+                G_time, graph_crs = 'epsg:%d' % cfg['wgs'], crs = 'epsg:%d' % cfg['utm']),
+                [cache.keys['time'], cfg['utm']])
+            G_csr = st.output(csr.compile_graph(G_time, weight = 'time'))
+            snap_idx = snap_future.result()
+
+        with prof.stage('snap') as st:
+            names = ['villages'] + services
+            snapped = dict(zip(names, snap_idx.snap(*[layers[n].result() for n in names])))
+            for name in names:
+                st.output(snapped[name], name)
+        villages = snapped['villages']
+
+        if cfg['walk']:
+            w = cfg['walk']
+            with prof.stage('walk') as st:
+                G_csr, villages = wm.add_walk_connectors(G_csr, villages, snap_idx, min_dist = w['min_dist'],
+                                                         walk_speed = w['speed'], k = w['k'],
+                                                         friction_fil = w.get('friction'),
+                                                         graph_crs = 'epsg:%d' % cfg['wgs'])
+                st.output(G_csr)
+
+        villages_ls = list(dict.fromkeys(villages.NN))
+        dests = {name: list(dict.fromkeys(snapped[name].NN)) for name in services}
+        cutoff = None if cfg['cutoff'] is None else cfg['cutoff'] * 60.
+        formats = cfg['outputs']['formats']
+        written = []
+
+        max_bytes = int(cfg['od_block_mb'] * (1 << 20))
+
+        def _minutes(values):
+            return values.where(values == cfg['fail_value'], values / 60.)
+
+        if cfg['batch']:
+            # one national graph, every province solved over its own buffered subgraph across the pool
+            b = cfg['batch']
+            provinces = aoi if cfg['aoi'] is None else gpd.read_file(b['layer'])
+            _drain()
+            with prof.stage('provinces') as st:
+                villages_acc, province_summary = bat.run_provinces(
+                    G_csr, provinces, villages, {name: snapped[name] for name in services},
+                    name_col = b.get('name_col', 'NAME'), buffer = b.get('buffer', 20000),
+                    graph_crs = 'epsg:%d' % cfg['wgs'], crs = 'epsg:%d' % cfg['utm'],
+                    fail_value = cfg['fail_value'], cutoff = cutoff, n_workers = n_workers,
+                    od_pth = os.path.join(out_pth, 'OD.parquet') if 'parquet' in formats else None,
+                    overwrite = True, max_bytes = max_bytes)
+                st.output(province_summary)
+                for name in services:
+                    villages_acc[name + '_time'] = _minutes(villages_acc[name + '_time'])
+            province_summary.to_csv(os.path.join(out_pth, 'province_summary.csv'))
+            written.append(os.path.join(out_pth, 'province_summary.csv'))
+            if 'parquet' in formats:
+                written.append(os.path.join(out_pth, 'OD.parquet'))
+        else:
+            with prof.stage('nearest_facility') as st:
+                villages_acc = villages
+                for name in services:
+                    NF = ode.nearest_facility(G_csr, villages_ls, dests[name], fail_value = cfg['fail_value'],
+                                              cutoff = cutoff)
+                    NF['time'] = _minutes(NF['time'])
+                    villages_acc = agg.broadcast_to_villages(villages_acc, NF, prefix = name + '_')
+                    st.output(NF, name)
+
+        stats = None
+        if cfg['admin_cols']:
+            stats = pd.concat({name: agg.accessibility_stats(villages_acc, name + '_time', cfg['admin_cols'],
+                                                             weight_col = cfg['pop_col'],
+                                                             fail_value = cfg['fail_value'])
+                               for name in services}, axis = 1)
+
+        if cfg['seasons']:
+            # one profile per season over the road topology, identical profiles are solved once. built from G_main
+            # since G_time lengths are in meters. villages with a walking connector add their walk to the nearest
+            # road node.
+            with prof.stage('seasons') as st:
+                SG = scn.compile_scenario_graph(G_main, distance_tag = 'length', road_col = 'infra_type',
+                                                factor = 1000, surface_lookup = surfaces)
+                profiles = scn.SpeedProfiles.from_dicts({name: _merge(cfg['speeds'], over or {})
+                                                         for name, over in cfg['seasons'].items()})
+                road_nn = snapped['villages'].NN
+                cube = scn.seasonal_accessibility(SG, profiles, list(dict.fromkeys(road_nn)), dests,
+                                                  fail_value = cfg['fail_value'], cutoff = cutoff,
+                                                  calendar = cfg['calendar'])
+                st.output(cube)
+                seasonal = _minutes(cube.reindex(road_nn.values))
+                seasonal.index = villages_acc.index
+                if 'walk_time' in villages_acc:
+                    walk = villages_acc['walk_time'] / 60.
+                    seasonal = seasonal.where(seasonal == cfg['fail_value'], seasonal.add(walk, axis = 0))
+                seasonal.columns = ['%s_%s' % c for c in seasonal.columns]
+            pending.append(io.submit(seasonal.to_csv, os.path.join(out_pth, 'seasonal_accessibility.csv')))
+            written.append(os.path.join(out_pth, 'seasonal_accessibility.csv'))
+        if cfg['batch']:
+            pending.append(io.submit(_write_csv, out_pth, None, villages_acc, stats))
+            written.append(os.path.join(out_pth, 'villages_accessibility.csv'))
+            if stats is not None:
+                written.append(os.path.join(out_pth, 'admin_accessibility.csv'))
+        elif 'csv' in formats:
+            _drain()
+            with prof.stage('od') as st:
+                OD = ode.calculate_OD_services(G_csr, villages_ls, dests, fail_value = cfg['fail_value'],
+                                               n_workers = n_workers, cutoff = cutoff, max_bytes = max_bytes)
+                OD = _minutes(OD)
+                for name in services:
+                    st.output(OD[name], name)
+            pending.append(io.submit(_write_csv, out_pth, OD, villages_acc, stats))
+            written += [os.path.join(out_pth, 'OD_village2%s.csv' % n) for n in services]
+            written.append(os.path.join(out_pth, 'villages_accessibility.csv'))
+            if stats is not None:
+                written.append(os.path.join(out_pth, 'admin_accessibility.csv'))
+        if 'parquet' in formats and not cfg['batch']:
+            with prof.stage('export_parquet') as st:
+                st.output(ods.write_OD_parquet(G_csr, villages_ls, dests, os.path.join(out_pth, 'OD.parquet'),
+                                               cutoff = cutoff, top_k = cfg['outputs'].get('top_k'),
+                                               overwrite = True, max_bytes = max_bytes))
+            written.append(os.path.join(out_pth, 'OD.parquet'))
+        if 'memmap' in formats and not cfg['batch']:
+            with prof.stage('export_memmap') as st:
+                ods.write_OD_memmap(G_csr, villages_ls, dests, os.path.join(out_pth, 'OD_mm'), cutoff = cutoff,
+                                    max_bytes = max_bytes)
+            written.append(os.path.join(out_pth, 'OD_mm'))
+
+        with prof.stage('export_wait'):
+            for p in pending:
+                p.result()
+    finally:
+        io.shutdown(wait = True)
+
+    report = prof.save(os.path.join(out_pth, 'run_report.json'))
+    return {'name': cfg['name'], 'outputs': out_pth, 'files': written, 'report': report,
+            'dropped_components': comps.summary()}
+
+
+def run_jobs(jobs, names = None, n_jobs = None, n_workers = None, verbose = True):
+    """
+    Function for running several jobs (e.g. provinces) as concurrent processes
+
+    :param jobs: dict of job name: job config, from load_config
+    :param names: the jobs to run, None for all
+    :param n_jobs: number of jobs run at once, defaults to all of them up to os.cpu_count()
+    :param n_workers: worker processes per job, defaults to the cores divided between the concurrent jobs
+    :param verbose: print the stage cache messages
+    :returns: dict of job name: run_job result
+    """
+    names = list(jobs) if names is None else list(names)
+    missing = [n for n in names if n not in jobs]
+    if missing:
+        raise KeyError('unknown jobs: %s' % ', '.join(missing))
+    cpus = os.cpu_count() or 1
+    n_jobs = max(1, min(n_jobs or cpus, len(names)))
+    if n_jobs == 1:
+        return {n: run_job(jobs[n], n_workers = n_workers, verbose = verbose) for n in names}
+
+    n_workers = n_workers or max(1, cpus // n_jobs)
+    ctx = mp.get_context('fork') if 'fork' in mp.get_all_start_methods() else mp.get_context()
+    with cf.ProcessPoolExecutor(n_jobs, mp_context = ctx) as ex:
+        futures = {n: ex.submit(run_job, jobs[n], n_workers, verbose) for n in names}
+        return {n: f.result() for n, f in futures.items()}
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Morocco accessibility model: prep network + OD in one run')
+    parser.add_argument('config', help = 'YAML or TOML config')
+    parser.add_argument('--jobs', nargs = '+', default = None, help = 'jobs to run, default all')
+    parser.add_argument('--n-jobs', type = int, default = None, help = 'jobs run at once')
+    parser.add_argument('--workers', type = int, default = None, help = 'worker processes per job')
+    parser.add_argument('--quiet', action = 'store_true')
+    args = parser.parse_args(argv)
+
+    results = run_jobs(load_config(args.config), names = args.jobs, n_jobs = args.n_jobs,
+                       n_workers = args.workers, verbose = not args.quiet)
+    print(json.dumps(results, indent = 2, default = str))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Morocco Accessibility Model: stage profiling
+#
+# wraps the pipeline stages (ingest, clean, largest component, time conversion, snap, OD per service, export) so
+# every run leaves a JSON report with the wall time, CPU time (this process and its worker processes), peak
+# memory, node / edge counts and rows produced per stage. One stage can also be profiled, with cProfile or
+# with a stack sampler that writes py-spy / flamegraph style collapsed stacks, to see where a regression is.
+
+import cProfile
+import json
+import os
+import platform
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def _rss():
+    # current resident memory of this process, in bytes
+    if psutil is not None:
+        return psutil.Process().memory_info().rss
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return _max_rss()
+
+
+def _max_rss(who = None):
+    # lifetime peak resident memory, in bytes (ru_maxrss is in KB on linux, bytes on macOS)
+    try:
+        import resource
+    except ImportError:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_SELF if who is None else who)
+    return usage.ru_maxrss if sys.platform == 'darwin' else usage.ru_maxrss * 1024
+
+
+def describe(obj):
+    """
+    Function for the size of a stage output
+
+    :param obj: a networkx graph, CSRGraph, GraphTable, DataFrame, array, sparse matrix or sized container
+    :returns: a dict with 'nodes' / 'edges' for graphs, 'rows' (and 'cols') for tables, {} otherwise
+    """
+    if hasattr(obj, 'number_of_nodes') and hasattr(obj, 'number_of_edges'):
+        return {'nodes': obj.number_of_nodes(), 'edges': obj.number_of_edges()}
+    if hasattr(obj, 'n_nodes') and hasattr(obj, 'n_edges'):
+        return {'nodes': int(obj.n_nodes), 'edges': int(obj.n_edges)}
+    if hasattr(obj, 'nodes') and hasattr(obj, 'edges') and hasattr(obj.edges, 'shape'):
+        return {'nodes': len(obj.nodes), 'edges': len(obj.edges)}
+    if hasattr(obj, 'nnz'):
+        return {'rows': int(obj.shape[0]), 'cols': int(obj.shape[1]), 'nnz': int(obj.nnz)}
+    if hasattr(obj, 'shape') and len(getattr(obj, 'shape', ())) >= 1:
+        out = {'rows': int(obj.shape[0])}
+        if len(obj.shape) > 1:
+            out['cols'] = int(obj.shape[1])
+        return out
+    if isinstance(obj, dict):
+        return {'rows': len(obj)}
+    if isinstance(obj, (list, set)):
+        return {'rows': len(obj)}
+    if isinstance(obj, tuple) and obj:
+        return describe(obj[0])
+    return {}
+
+
+class _Sampler(threading.Thread):
+    # background thread keeping the peak RSS of a stage, and optionally sampling the stacks of the main thread
+
+    def __init__(self, interval, stacks = False):
+        super(_Sampler, self).__init__()
+        self.daemon = True
+        self.interval = interval
+        self.stacks = Counter() if stacks else None
+        self.peak = _rss()
+        self._target = threading.current_thread().ident
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, _rss())
+            if self.stacks is not None:
+                frame = sys._current_frames().get(self._target)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), frame.f_lineno))
+                    frame = frame.f_back
+                if stack:
+                    self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, _rss())
+
+
+class Stage(object):
+    """
+    Record of one stage, returned by RunProfiler.stage
+
+    :param name: the stage name
+    """
+    def __init__(self, name):
+        self.name = name
+        self.record = {'stage': name}
+
+    def output(self, obj, label = None):
+        """
+        Function for recording the size of what the stage produced
+
+        :param obj: the stage output, see describe
+        :param label: prefix for the counts when a stage has several outputs, e.g. 'health'
+        :returns: obj, so the call can wrap the output
+        """
+        for k, v in describe(obj).items():
+            self.record[k if label is None else '%s_%s' % (label, k)] = v
+        return obj
+
+    def set(self, **info):
+        # any other value to keep in the report, e.g. cache hits or the number of tiles
+        self.record.update(info)
+
+
+class RunProfiler(object):
+    """
+    Stage-level instrumentation of a pipeline run
+
+    :param name: run name, used in the report and profile file names
+    :param profile_stage: name of the stage to profile, None for none
+    :param profile_mode: 'cprofile', or 'sample' for a stack sampler (collapsed stacks for flamegraph / speedscope)
+    :param out_dir: folder for the profile files, defaults to the current folder
+    :param interval: seconds between memory (and stack) samples
+    """
+    def __init__(self, name = 'run', profile_stage = None, profile_mode = 'cprofile', out_dir = None,
+                 interval = 0.01):
+        if profile_mode not in ('cprofile', 'sample'):
+            raise ValueError("profile_mode must be 'cprofile' or 'sample'")
+        self.name = name
+        self.profile_stage = profile_stage
+        self.profile_mode = profile_mode
+        self.out_dir = out_dir or '.'
+        self.interval = interval
+        self.stages = []
+        self.started = time.strftime('%Y-%m-%dT%H:%M:%S')
+        self._t0 = time.perf_counter()
+
+    def __repr__(self):
+        return 'RunProfiler %s with %d stages' % (self.name, len(self.stages))
+
+    @contextmanager
+    def stage(self, name, **info):
+        """
+        Function for timing a stage
+
+            with prof.stage('clean') as st:
+                G = tcl.clean_network_tiled(...)
+                st.output(G)
+
+        :param name: the stage name
+        :param info: values to keep in the report with the stage
+        :returns: a context manager yielding a Stage
+        """
+        st = Stage(name)
+        st.set(**info)
+        profile = name == self.profile_stage
+        sampler = _Sampler(self.interval, stacks = profile and self.profile_mode == 'sample')
+        prof = cProfile.Profile() if profile and self.profile_mode == 'cprofile' else None
+
+        rss0 = _rss()
+        times0 = os.times()
+        wall0 = time.perf_counter()
+        sampler.start()
+        if prof is not None:
+            prof.enable()
+        try:
+            yield st
+        except BaseException as e:
+            st.record['error'] = repr(e)
+            raise
+        finally:
+            if prof is not None:
+                prof.disable()
+            wall = time.perf_counter() - wall0
+            sampler.stop()
+            times1 = os.times()
+
+            st.record.update({
+                'wall_s': round(wall, 4),
+                'cpu_s': round((times1[0] - times0[0]) + (times1[1] - times0[1]), 4),
+                'cpu_children_s': round((times1[2] - times0[2]) + (times1[3] - times0[3]), 4),
+                'rss_start_mb': round(rss0 / 1e6, 1),
+                'rss_end_mb': round(_rss() / 1e6, 1),
+                'peak_rss_mb': round(sampler.peak / 1e6, 1),
+                'max_rss_process_mb': round(_max_rss() / 1e6, 1),
+            })
+            if prof is not None:
+                st.record['profile'] = self._save_cprofile(name, prof)
+            if sampler.stacks is not None:
+                st.record['profile'] = self._save_stacks(name, sampler.stacks)
+            self.stages.append(st.record)
+
+    def _profile_path(self, name, ext):
+        if not os.path.exists(self.out_dir):
+            os.makedirs(self.out_dir)
+        return os.path.join(self.out_dir, '%s_%s.%s' % (self.name, name, ext))
+
+    def _save_cprofile(self, name, prof, top = 25):
+        fil = self._profile_path(name, 'prof')
+        prof.dump_stats(fil)
+        stats = pstats.Stats(prof).stats
+        rows = sorted(stats.items(), key = lambda kv: -kv[1][3])[:top]
+        return {'file': fil,
+                'top_cumulative': [{'function': '%s (%s:%d)' % (fn, os.path.basename(f), line),
+                                    'calls': nc, 'tottime_s': round(tt, 4), 'cumtime_s': round(ct, 4)}
+                                   for (f, line, fn), (cc, nc, tt, ct, _) in rows]}
+
+    def _save_stacks(self, name, stacks, top = 25):
+        fil = self._profile_path(name, 'collapsed.txt')
+        with open(fil, 'w') as f:
+            for stack, n in stacks.most_common():
+                f.write('%s %d\n' % (stack, n))
+        leaf = Counter()
+        for stack, n in stacks.items():
+            leaf[stack.rsplit(';', 1)[-1]] += n
+        total = float(sum(stacks.values())) or 1.
+        return {'file': fil, 'samples': int(total),
+                'top_self': [{'function': fn, 'share': round(n / total, 4)} for fn, n in leaf.most_common(top)]}
+
+    def report(self):
+        """
+        Function for the run report
+
+        :returns: a dict with the run metadata and one record per stage, in run order
+        """
+        return {'run': self.name,
+                'started': self.started,
+                'host': platform.node(),
+                'python': platform.python_version(),
+                'cpu_count': os.cpu_count(),
+                'total_wall_s': round(time.perf_counter() - self._t0, 4),
+                'max_rss_mb': round(_max_rss() / 1e6, 1),
+                'stages': self.stages}
+
+    def save(self, path):
+        """
+        Save the run report as JSON
+
+        :param path: output file path, e.g. outputs/run_report.json
+        :returns: path
+        """
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent = 2, default = str)
+        return path
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Morocco Accessibility Model: speed scenarios
+#
+# stores per-edge length and infra_type once and derives travel-time weights for any number of
+# speed dictionaries (rainy season, paved-road upgrades, ...) in one vectorized step, instead of
+# re-running gn.convert_network_to_time on a copy of the graph for every scenario.
+# travel times follow gn.convert_network_to_time: seconds = (length * factor / 1000) / kmph * 3600.
+# seasonal profiles (dry / rainy / snow, or months) are a small seasons x road types x surfaces speed array,
+# 0 kmph closing a road; seasonal_accessibility returns the village x service x season nearest facility
+# times in one run, solving each distinct profile once on the shared topology.
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+import od_engine as ode
+from csr_graph import CSRGraph, node_id_array
+
+# OSM surface values grouped into the surface classes of the speed profiles, other values are unknown (None)
+SURFACE_CLASSES = {'paved': 'paved', 'asphalt': 'paved', 'concrete': 'paved', 'paving_stones': 'paved',
+                   'sett': 'paved', 'cobblestone': 'paved', 'metal': 'paved',
+                   'unpaved': 'unpaved', 'compacted': 'unpaved', 'fine_gravel': 'unpaved', 'gravel': 'unpaved',
+                   'pebblestone': 'unpaved', 'ground': 'unpaved', 'dirt': 'unpaved', 'earth': 'unpaved',
+                   'mud': 'unpaved', 'sand': 'unpaved', 'rock': 'unpaved', 'grass': 'unpaved'}
+
+
+class ScenarioGraph(object):
+    """
+    Fixed road topology with per-edge length and road type
+
+    edges are kept in (u, v) order with parallel edges grouped, the fastest parallel edge is picked
+    per scenario since it can change with the speeds.
+
+    :param topology: a CSRGraph with one entry per distinct (u, v) pair, its weights are unused
+    :param length: float32 array of edge lengths, one per original edge
+    :param infra_code: int array of road type codes, one per original edge (index into infra_types)
+    :param group_starts: int array, first original edge of every distinct (u, v) pair
+    :param infra_types: list of road types, position i is code i
+    :param factor: multiplier turning length into meters, 1000 for lengths in km (as gn.convert_network_to_time)
+    :param default_speed: kmph used for road types missing from a speed dictionary
+    :param surface_code: optional int array of surface class codes, one per original edge (index into surfaces)
+    :param surfaces: list of surface classes, position i is code i, None for unknown
+    """
+    def __init__(self, topology, length, infra_code, group_starts, infra_types, factor = 1000, default_speed = 20,
+                 surface_code = None, surfaces = None):
+        self.topology = topology
+        self.length = np.asarray(length, dtype = np.float32)
+        self.infra_code = np.asarray(infra_code, dtype = np.int16)
+        self.group_starts = np.asarray(group_starts, dtype = np.int64)
+        self.infra_types = list(infra_types)
+        self.factor = factor
+        self.default_speed = default_speed
+        if surface_code is None:
+            surface_code, surfaces = np.zeros(len(self.length), dtype = np.int8), [None]
+        self.surface_code = np.asarray(surface_code, dtype = np.int8)
+        self.surfaces = list(surfaces)
+        self._transpose = None
+
+    def __repr__(self):
+        return 'ScenarioGraph with %d nodes, %d edges and %d road types' % (
+            self.topology.n_nodes, len(self.length), len(self.infra_types))
+
+    def speed_table(self, speed_dicts):
+        """
+        Function for turning speed dictionaries into a scenarios x road types array
+
+        :param speed_dicts: a list of speed dictionaries {infra_type: kmph}
+        :returns: a float32 array of shape (len(speed_dicts), len(infra_types))
+        """
+        return np.array([[sd.get(t, self.default_speed) for t in self.infra_types] for sd in speed_dicts],
+                        dtype = np.float32)
+
+    def weights(self, speed_dicts):
+        """
+        Function for the travel-time weights of several speed scenarios at once
+
+        :param speed_dicts: a list of speed dictionaries {infra_type: kmph}
+        :returns: a float32 array of shape (len(speed_dicts), n_edges of the topology) in seconds
+        """
+        speeds = self.speed_table(speed_dicts)
+        km = self.length * self.factor / 1000.
+        W = km[None, :] / speeds[:, self.infra_code] * 3600
+        # fastest of the parallel edges of every (u, v) pair
+        return np.minimum.reduceat(W, self.group_starts, axis = 1)
+
+    def graph(self, speed_dict):
+        """
+        Function for the compiled graph of a single speed scenario
+
+        :param speed_dict: a speed dictionary {infra_type: kmph}
+        :returns: a CSRGraph sharing the topology arrays
+        """
+        return self.topology.with_weights(self.weights([speed_dict])[0])
+
+    def profile_weights(self, profiles):
+        """
+        Function for the travel-time weights of every profile of a SpeedProfiles
+
+        :param profiles: a SpeedProfiles
+        :returns: a float32 array of shape (len(profiles), n_edges of the topology) in seconds, inf for closed edges
+        """
+        table = profiles.lookup(self.infra_types, self.surfaces)
+        speeds = table[:, self.infra_code, self.surface_code]
+        km = self.length * self.factor / 1000.
+        with np.errstate(divide = 'ignore'):
+            W = km[None, :] / speeds * 3600
+        return np.minimum.reduceat(W, self.group_starts, axis = 1)
+
+    def profile_graph(self, weights):
+        """
+        Function for the compiled graph of one weight vector, reusing the reversed topology
+
+        the reversed graph (used by nearest_facility) is only transposed once for all profiles, each profile
+        just permutes its weights into it.
+
+        :param weights: array of edge weights in the order of the topology, e.g. a row of profile_weights
+        :returns: a CSRGraph
+        """
+        topo = self.topology
+        if self._transpose is None:
+            # transpose edge positions (offset by 1 so no entry is an explicit zero)
+            T = sparse.csr_matrix((np.arange(1, topo.n_edges + 1, dtype = np.float64), topo.indices, topo.indptr),
+                                  shape = (topo.n_nodes, topo.n_nodes)).transpose().tocsr()
+            self._transpose = (T.indptr, T.indices, T.data.astype(np.int64) - 1)
+        g = topo.with_weights(weights)
+        indptr, indices, perm = self._transpose
+        g._matrix_T = sparse.csr_matrix((g.weights[perm], indices, indptr), shape = (topo.n_nodes, topo.n_nodes))
+        return g
+
+    def save(self, path):
+        """
+        Save the scenario graph as a single .npz file
+
+        :param path: output file path
+        """
+        topo = self.topology
+        arrays = dict(indptr = topo.indptr, indices = topo.indices, node_ids = topo.node_ids,
+                      length = self.length, infra_code = self.infra_code, group_starts = self.group_starts,
+                      infra_types = np.array(self.infra_types, dtype = object),
+                      surface_code = self.surface_code, surfaces = np.array(self.surfaces, dtype = object),
+                      factor = self.factor, default_speed = self.default_speed)
+        if topo.x is not None:
+            arrays['x'] = topo.x
+            arrays['y'] = topo.y
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load a scenario graph written by ScenarioGraph.save
+
+        :param path: path to the .npz file
+        :returns: a ScenarioGraph
+        """
+        with np.load(path, allow_pickle = True) as f:
+            x = f['x'] if 'x' in f.files else None
+            y = f['y'] if 'y' in f.files else None
+            topo = CSRGraph(f['indptr'], f['indices'], np.zeros(len(f['indices']), dtype = np.float32),
+                            f['node_ids'], x = x, y = y)
+            surface_code = f['surface_code'] if 'surface_code' in f.files else None
+            surfaces = f['surfaces'].tolist() if 'surfaces' in f.files else None
+            return cls(topo, f['length'], f['infra_code'], f['group_starts'], f['infra_types'].tolist(),
+                       factor = f['factor'].item(), default_speed = f['default_speed'].item(),
+                       surface_code = surface_code, surfaces = surfaces)
+
+
+def _surface(d, surface_col, surface_lookup):
+    # surface class of an edge, from its own attribute or from the OSM way it comes from
+    value = d.get(surface_col)
+    if value is None and surface_lookup is not None:
+        osm_id = d.get('osm_id')
+        # cleaned edges can hold several ways, take the first like the road type
+        if isinstance(osm_id, list):
+            osm_id = osm_id[0] if osm_id else None
+        value = surface_lookup.get(osm_id)
+        if value is None and osm_id is not None:
+            value = surface_lookup.get(str(osm_id))
+    if isinstance(value, list):
+        value = value[0] if value else None
+    return SURFACE_CLASSES.get(value) if isinstance(value, str) else None
+
+
+def compile_scenario_graph(G, distance_tag = 'length', road_col = 'infra_type', factor = 1000, default_speed = 20,
+                           surface_col = 'surface', surface_lookup = None):
+    """
+    Function for extracting the road topology, lengths and road types of a graph once
+
+    :param G: a graph containing one or more nodes, before or after gn.convert_network_to_time
+    :param distance_tag: the edge attribute holding the edge length
+    :param road_col: the edge attribute holding the road type
+    :param factor: multiplier turning length into meters, 1000 for lengths in km (as gn.convert_network_to_time)
+    :param default_speed: kmph used for road types missing from a speed dictionary
+    :param surface_col: the edge attribute holding the OSM surface, grouped with SURFACE_CLASSES
+    :param surface_lookup: optional dict / Series of osm_id: surface for edges without surface_col,
+                           e.g. pbf_ingest.OSM_to_network_aoi(..., tags = ['surface']).tags['surface']
+    :returns: a ScenarioGraph
+    """
+    if surface_lookup is not None and hasattr(surface_lookup, 'to_dict'):
+        surface_lookup = surface_lookup.dropna().to_dict()
+    nodes = list(G.nodes())
+    node_index = {n: i for i, n in enumerate(nodes)}
+
+    infra_types = {}
+    surfaces = {None: 0}
+    n_edges = G.number_of_edges()
+    u = np.empty(n_edges, dtype = np.int64)
+    v = np.empty(n_edges, dtype = np.int64)
+    length = np.empty(n_edges, dtype = np.float32)
+    code = np.empty(n_edges, dtype = np.int16)
+    surface = np.empty(n_edges, dtype = np.int8)
+    for i, (a, b, d) in enumerate(G.edges(data = True)):
+        road = d.get(road_col)
+        # osmnx can store several road types on a merged edge, take the first like convert_network_to_time
+        if isinstance(road, list):
+            road = road[0]
+        u[i] = node_index[a]
+        v[i] = node_index[b]
+        length[i] = d[distance_tag]
+        code[i] = infra_types.setdefault(road, len(infra_types))
+        surface[i] = surfaces.setdefault(_surface(d, surface_col, surface_lookup), len(surfaces))
+
+    if not G.is_directed():
+        u, v = np.concatenate([u, v]), np.concatenate([v, u])
+        length = np.concatenate([length, length])
+        code = np.concatenate([code, code])
+        surface = np.concatenate([surface, surface])
+
+    order = np.lexsort((v, u))
+    u, v, length, code, surface = u[order], v[order], length[order], code[order], surface[order]
+    new_pair = np.ones(len(u), dtype = bool)
+    new_pair[1:] = (u[1:] != u[:-1]) | (v[1:] != v[:-1])
+    group_starts = np.flatnonzero(new_pair)
+
+    x = y = None
+    node_data = G.nodes
+    if nodes and all('x' in node_data[n] and 'y' in node_data[n] for n in nodes):
+        x = np.array([node_data[n]['x'] for n in nodes], dtype = float)
+        y = np.array([node_data[n]['y'] for n in nodes], dtype = float)
+
+    indptr = np.zeros(len(nodes) + 1, dtype = np.int64)
+    np.cumsum(np.bincount(u[group_starts], minlength = len(nodes)), out = indptr[1:])
+    topology = CSRGraph(indptr, v[group_starts], np.zeros(len(group_starts), dtype = np.float32),
+                        node_id_array(nodes), x = x, y = y)
+
+    return ScenarioGraph(topology, length, code, group_starts, list(infra_types),
+                         factor = factor, default_speed = default_speed, surface_code = surface,
+                         surfaces = list(surfaces))
+
+
+def run_scenarios(SG, speed_dicts, func, *args, **kwargs):
+    """
+    Function for running an OD function against every speed scenario on the same topology
+
+    all scenario weights are derived in one vectorized step, then func runs on each weight vector.
+
+    :param SG: a ScenarioGraph
+    :param speed_dicts: a dict of scenario name: speed dictionary
+    :param func: an OD function taking the graph first, e.g. ode.calculate_OD or ode.nearest_facility
+    :param args: further positional arguments for func (origins, destinations, ...)
+    :param kwargs: further keyword arguments for func
+    :returns: a dict of scenario name: func output
+    """
+    names = list(speed_dicts)
+    W = SG.weights([speed_dicts[n] for n in names])
+    return {n: func(SG.topology.with_weights(W[i]), *args, **kwargs) for i, n in enumerate(names)}
+
+
+class SpeedProfiles(object):
+    """
+    Speeds per season (or road condition) as a lookup array
+
+    :param names: list of profile names, e.g. ['dry', 'rainy', 'snow']
+    :param infra_types: list of road types
+    :param surfaces: list of surface classes, None is the speed for an unknown surface
+    :param speeds: float32 array of shape (names, infra_types, surfaces) in kmph, 0 closes the road
+    :param default_speed: kmph used for road types missing from the array
+    """
+    def __init__(self, names, infra_types, surfaces, speeds, default_speed = 20):
+        self.names = list(names)
+        self.infra_types = list(infra_types)
+        self.surfaces = list(surfaces)
+        self.speeds = np.asarray(speeds, dtype = np.float32)
+        self.default_speed = default_speed
+
+    def __repr__(self):
+        return 'SpeedProfiles %s over %d road types and %d surfaces' % (self.names, len(self.infra_types),
+                                                                       len(self.surfaces))
+
+    def __len__(self):
+        return len(self.names)
+
+    @classmethod
+    def from_dicts(cls, profiles, default_speed = 20):
+        """
+        Function for building the lookup array from speed dictionaries
+
+            SpeedProfiles.from_dicts({'dry': speedDict,
+                                      'rainy': dict(speedDict, track = {'paved': 20, 'unpaved': 5, 'default': 10}),
+                                      'snow': dict(speedDict, track = 0, unclassified = {'unpaved': 0})})
+
+        :param profiles: dict of profile name: {infra_type: kmph, or {surface class: kmph, 'default': kmph}}.
+                         A road type left out of a surface dict keeps default_speed for its other surfaces
+                         unless 'default' is given
+        :param default_speed: kmph used for road types missing from a profile
+        :returns: a SpeedProfiles
+        """
+        names = list(profiles)
+        infra_types = list(dict.fromkeys(t for p in profiles.values() for t in p))
+        surfaces = [None] + list(dict.fromkeys(s for p in profiles.values() for v in p.values()
+                                               if isinstance(v, dict) for s in v if s != 'default'))
+        speeds = np.full((len(names), len(infra_types), len(surfaces)), default_speed, dtype = np.float32)
+        for i, name in enumerate(names):
+            for j, t in enumerate(infra_types):
+                value = profiles[name].get(t, default_speed)
+                if isinstance(value, dict):
+                    fallback = value.get('default', default_speed)
+                    speeds[i, j] = [value.get(s, fallback) if s is not None else fallback for s in surfaces]
+                else:
+                    speeds[i, j] = value
+        return cls(names, infra_types, surfaces, speeds, default_speed = default_speed)
+
+    def lookup(self, infra_types, surfaces):
+        """
+        Function for the speed array in the road type and surface codes of a graph
+
+        :param infra_types: road types of the graph, e.g. ScenarioGraph.infra_types
+        :param surfaces: surface classes of the graph, e.g. ScenarioGraph.surfaces
+        :returns: a float32 array of shape (profiles, infra_types, surfaces) in kmph
+        """
+        t_pos = {t: i for i, t in enumerate(self.infra_types)}
+        s_pos = {s: i for i, s in enumerate(self.surfaces)}
+        out = np.full((len(self.names), len(infra_types), len(surfaces)), self.default_speed, dtype = np.float32)
+        for j, t in enumerate(infra_types):
+            if t not in t_pos:
+                continue
+            # surfaces the profiles do not know take the unknown surface speed
+            cols = [s_pos.get(s, s_pos[None]) for s in surfaces]
+            out[:, j, :] = self.speeds[:, t_pos[t], cols]
+        return out
+
+
+def seasonal_accessibility(SG, profiles, origins, services, fail_value = 9999999, cutoff = None, calendar = None):
+    """
+    Function for the nearest facility time of every origin, service and season in one run
+
+    profiles with the same edge weights are only solved once, and every profile graph shares the topology
+    and its reversed structure.
+
+    :param SG: a ScenarioGraph
+    :param profiles: a SpeedProfiles
+    :param origins: a list of origin nodes (e.g. villages_ls)
+    :param services: a dict of service name: list of destination nodes, e.g. {'health': health_ls, ...}
+    :param fail_value: the value to return if no destination can be reached, e.g. all roads closed
+    :param cutoff: optional maximum travel time in seconds
+    :param calendar: optional dict of season (e.g. month): profile name, the output columns follow it
+    :returns: a pandas DataFrame indexed by origin with (service, season) columns of travel times in seconds,
+              df['health'] is the villages x seasons matrix
+    """
+    W = SG.profile_weights(profiles)
+    unique, inverse = np.unique(W, axis = 0, return_inverse = True)
+    inverse = np.asarray(inverse).ravel()
+
+    origins = list(origins)
+    solved = {}
+    for k in range(len(unique)):
+        G = SG.profile_graph(unique[k])
+        for name, dests in services.items():
+            solved[k, name] = ode.nearest_facility(G, origins, dests, fail_value = fail_value,
+                                                   cutoff = cutoff)['time'].values
+
+    calendar = calendar or {name: name for name in profiles.names}
+    pos = {name: i for i, name in enumerate(profiles.names)}
+    missing = [p for p in calendar.values() if p not in pos]
+    if missing:
+        raise KeyError('calendar refers to unknown profiles: %s' % ', '.join(map(str, missing)))
+    columns = [(name, season) for name in services for season in calendar]
+    data = np.column_stack([solved[inverse[pos[calendar[season]]], name] for name, season in columns]) \
+        if columns else np.empty((len(origins), 0))
+    return pd.DataFrame(data, index = origins,
+                        columns = pd.MultiIndex.from_tuples(columns, names = ['service', 'season']))
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Morocco Accessibility Model: snap index
+#
+# nearest-node index over the graph nodes, built once per graph in projected coordinates and saved next
+# to the graph, replacing one gn.pandana_snap / pandana_snap_c call (and one rebuilt search tree) per layer.
+# snapped layers get the same NN / NN_dist columns as gn.pandana_snap(..., add_dist_to_node_col = True).
+
+import pickle
+
+import numpy as np
+from pyproj import Transformer
+from scipy.spatial import cKDTree
+
+from csr_graph import CSRGraph, node_id_array
+
+
+class SnapIndex(object):
+    """
+    KD-tree over graph nodes in a projected CRS
+
+    :param node_ids: array of node IDs
+    :param x: node x coordinates in crs
+    :param y: node y coordinates in crs
+    :param crs: the projected CRS of x / y, e.g. 'epsg:32629' (UTM 29N) for Morocco
+    """
+    def __init__(self, node_ids, x, y, crs = 'epsg:32629'):
+        self.node_ids = np.asarray(node_ids)
+        self.crs = crs
+        self.tree = cKDTree(np.column_stack([x, y]))
+
+    def __repr__(self):
+        return 'SnapIndex over %d nodes in %s' % (len(self.node_ids), self.crs)
+
+    def query(self, x, y, max_dist = np.inf):
+        """
+        Function for the nearest node of an array of points
+
+        :param x: point x coordinates in the index CRS
+        :param y: point y coordinates in the index CRS
+        :param max_dist: points further than this from any node get NN None and NN_dist inf
+        :returns: arrays of nearest node IDs and distances (in CRS units, meters for UTM)
+        """
+        dist, idx = self.tree.query(np.column_stack([x, y]), distance_upper_bound = max_dist)
+        found = idx < len(self.node_ids)
+        if found.all():
+            return self.node_ids[idx], dist
+        nn = np.empty(len(idx), dtype = object)
+        nn[found] = self.node_ids[idx[found]]
+        return nn, dist
+
+    def snap(self, *layers, **kwargs):
+        """
+        Function for snapping any number of point layers in one batched query
+
+        :param layers: GeoDataFrames of points, in any CRS (reprojected to the index CRS)
+        :param max_dist: optional keyword, see query
+        :returns: a list of copies of the layers with NN and NN_dist columns, in the order given
+        """
+        max_dist = kwargs.get('max_dist', np.inf)
+        coords = []
+        for layer in layers:
+            pts = layer.geometry if layer.crs is None else layer.geometry.to_crs(self.crs)
+            coords.append(np.column_stack([pts.x.values, pts.y.values]))
+        sizes = [len(c) for c in coords]
+        allc = np.vstack(coords) if coords else np.empty((0, 2))
+
+        nn, dist = self.query(allc[:, 0], allc[:, 1], max_dist = max_dist)
+
+        out = []
+        start = 0
+        for layer, n in zip(layers, sizes):
+            layer = layer.copy()
+            layer['NN'] = nn[start:start + n]
+            layer['NN_dist'] = dist[start:start + n]
+            out.append(layer)
+            start += n
+        return out
+
+    def save(self, path):
+        """
+        Save the index (with its built tree) as a pickle, e.g. next to G_time.pickle
+
+        :param path: output file path
+        """
+        with open(path, 'wb') as f:
+            pickle.dump(self, f, protocol = pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def load(path):
+        """
+        Load an index written by SnapIndex.save
+
+        :param path: path to the pickle
+        :returns: a SnapIndex
+        """
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
+
+def build_snap_index(G, graph_crs = 'epsg:4326', crs = 'epsg:32629'):
+    """
+    Function for building the snap index of a graph
+
+    :param G: a networkx graph with node x / y attributes, or a CSRGraph compiled with coordinates
+    :param graph_crs: the CRS of the node coordinates, OSM graphs are in EPSG:4326
+    :param crs: the projected CRS to index in, so distances are in meters
+    :returns: a SnapIndex
+    """
+    if isinstance(G, CSRGraph):
+        if G.x is None:
+            raise ValueError('CSRGraph has no node coordinates, compile it from a graph with node x / y')
+        node_ids, x, y = G.node_ids, G.x, G.y
+    else:
+        nodes = list(G.nodes())
+        node_ids = node_id_array(nodes)
+        x = np.array([G.nodes[n]['x'] for n in nodes], dtype = float)
+        y = np.array([G.nodes[n]['y'] for n in nodes], dtype = float)
+
+    if graph_crs != crs:
+        x, y = Transformer.from_crs(graph_crs, crs, always_xy = True).transform(x, y)
+
+    return SnapIndex(node_ids, x, y, crs = crs)
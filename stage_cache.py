@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Morocco Accessibility Model: stage cache
+#
+# content-addressed cache for the pipeline stages (ingest, clean, largest SCC, G_time, snaps).
+# every stage is keyed by a hash of its inputs plus the key of the stage it depends on, so a changed
+# speedDict only re-runs the time conversion and everything after it, not the network clean.
+
+import hashlib
+import json
+import os
+import pickle
+import uuid
+
+import numpy as np
+import pandas as pd
+
+
+def _feed(h, obj):
+    # add a canonical byte representation of obj to the hash h
+    if obj is None or isinstance(obj, (bool, int, float, str)):
+        h.update(repr((type(obj).__name__, obj)).encode('utf-8'))
+    elif isinstance(obj, bytes):
+        h.update(b'bytes:')
+        h.update(obj)
+    elif isinstance(obj, dict):
+        h.update(b'dict:')
+        for k in sorted(obj, key = repr):
+            _feed(h, k)
+            _feed(h, obj[k])
+    elif isinstance(obj, (list, tuple)):
+        h.update(('%s:%d:' % (type(obj).__name__, len(obj))).encode('utf-8'))
+        for o in obj:
+            _feed(h, o)
+    elif isinstance(obj, (set, frozenset)):
+        _feed(h, sorted(obj, key = repr))
+    elif isinstance(obj, np.generic):
+        _feed(h, obj.item())
+    elif isinstance(obj, np.ndarray):
+        h.update(('ndarray:%s:%s:' % (obj.dtype.str, obj.shape)).encode('utf-8'))
+        if obj.dtype == object:
+            _feed(h, obj.ravel().tolist())
+        else:
+            h.update(np.ascontiguousarray(obj).tobytes())
+    elif hasattr(obj, 'wkb'):
+        # shapely geometries, e.g. the AOI polygon
+        h.update(b'geom:')
+        h.update(obj.wkb)
+    elif isinstance(obj, (pd.DataFrame, pd.Series)) and hasattr(obj, 'to_wkb'):
+        # geopandas GeoSeries / GeoDataFrame: the attributes, the geometries and the CRS
+        geometry = obj.geometry
+        h.update(('geo:%s:' % (geometry.crs.to_wkt() if geometry.crs is not None else None)).encode('utf-8'))
+        if isinstance(obj, pd.DataFrame):
+            _feed(h, obj.drop(columns = geometry.name))
+        else:
+            _feed(h, obj.index.to_numpy())
+        for g in geometry.to_wkb():
+            h.update(b'' if g is None else g)
+    elif isinstance(obj, (pd.DataFrame, pd.Series)):
+        names = list(obj.columns) if isinstance(obj, pd.DataFrame) else [obj.name]
+        dtypes = list(obj.dtypes) if isinstance(obj, pd.DataFrame) else [obj.dtype]
+        _feed(h, [type(obj).__name__, [str(c) for c in names], [str(d) for d in dtypes]])
+        h.update(pd.util.hash_pandas_object(obj, index = True).values.tobytes())
+    else:
+        raise TypeError('cannot hash stage input of type %s' % type(obj).__name__)
+
+
+def _tmp_name(fil):
+    # temp file next to fil, unique per process and thread
+    return '%s.%d.%s.tmp' % (fil, os.getpid(), uuid.uuid4().hex[:8])
+
+
+def hash_inputs(*inputs):
+    """
+    Function for hashing stage inputs
+
+    :param inputs: any mix of numbers, strings, dicts, lists, numpy arrays, shapely geometries, pandas or
+                   geopandas objects; any other type raises a TypeError
+    :returns: a sha256 hex digest
+    """
+    h = hashlib.sha256()
+    _feed(h, list(inputs))
+    return h.hexdigest()
+
+
+class StageCache(object):
+    """
+    Content-addressed cache of pipeline stage outputs
+
+    :param cache_pth: folder holding the cached artifacts, created if missing
+    :param verbose: print whether each stage was loaded or computed
+    """
+    def __init__(self, cache_pth, verbose = True):
+        self.cache_pth = cache_pth
+        self.verbose = verbose
+        # stage name -> key of the last run, pass these as inputs of the downstream stages
+        self.keys = {}
+        if not os.path.exists(cache_pth):
+            os.makedirs(cache_pth)
+        self._checksum_fil = os.path.join(cache_pth, 'checksums.json')
+
+    def file_checksum(self, fil, block_size = 1 << 20):
+        """
+        Function for the sha256 checksum of an input file (e.g. the osm.pbf)
+
+        checksums are remembered by path, size and modification time, so a multi-GB PBF is only
+        re-read when it changes.
+
+        :param fil: path to the file
+        :param block_size: read size in bytes
+        :returns: a sha256 hex digest
+        """
+        fil = os.path.abspath(fil)
+        st = os.stat(fil)
+        stamp = [st.st_size, st.st_mtime]
+
+        known = {}
+        if os.path.exists(self._checksum_fil):
+            with open(self._checksum_fil) as f:
+                known = json.load(f)
+        if fil in known and known[fil]['stamp'] == stamp:
+            return known[fil]['sha256']
+
+        h = hashlib.sha256()
+        with open(fil, 'rb') as f:
+            for chunk in iter(lambda: f.read(block_size), b''):
+                h.update(chunk)
+        known[fil] = {'stamp': stamp, 'sha256': h.hexdigest()}
+        # temp file + rename, so a concurrent reader or an interrupted run never sees a half-written file
+        tmp = _tmp_name(self._checksum_fil)
+        with open(tmp, 'w') as f:
+            json.dump(known, f, indent = 1)
+        os.replace(tmp, self._checksum_fil)
+        return known[fil]['sha256']
+
+    def path(self, stage, key):
+        return os.path.join(self.cache_pth, '%s-%s.pickle' % (stage, key[:16]))
+
+    def run(self, stage, func, inputs):
+        """
+        Function for running a stage through the cache
+
+        :param stage: stage name, e.g. 'clean'
+        :param func: a function with no arguments computing the stage output
+        :param inputs: list of everything the output depends on, including the keys of upstream stages
+                       (self.keys['clean']) and file checksums (self.file_checksum(f))
+        :returns: the stage output, loaded from the cache when the inputs are unchanged
+        """
+        key = hash_inputs(stage, inputs)
+        self.keys[stage] = key
+        fil = self.path(stage, key)
+
+        if os.path.exists(fil):
+            if self.verbose:
+                print('%s: loaded from cache %s' % (stage, fil))
+            with open(fil, 'rb') as f:
+                return pickle.load(f)
+
+        if self.verbose:
+            print('%s: running' % stage)
+        out = func()
+        # write to a temp file first so an interrupted run never leaves a truncated artifact. The temp name is
+        # unique per writer: concurrent jobs computing the same stage each rename their own complete file
+        tmp = _tmp_name(fil)
+        with open(tmp, 'wb') as f:
+            pickle.dump(out, f, protocol = pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, fil)
+        return out
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Morocco Accessibility Model: tiled network cleaning
+#
+# gn.clean_network runs on one core over the whole graph. Here the network is cut into square tiles in UTM,
+# each tile is cleaned with its neighbours' roads within an overlap buffer, and the tiles are cleaned across a
+# process pool. Every cleaned edge is kept by the one tile whose core holds the midpoint of its end nodes, and
+# the tiles are stitched on their shared nodes: original OSM nodes that survive the cleaning keep their ID and
+# are matched on it. Nodes created by the junction simplification (new_obj_*) carry no original ID, so they are
+# matched across tiles by position, within an explicit tolerance, and never to another new node of the same
+# tile. The overlap should be longer than the longest road segment between junctions, so segments crossing a
+# tile edge are cleaned the same way on both sides. Several countries can also be cleaned concurrently with
+# clean_countries. GOSTnets is only imported when a network is cleaned with the default clean function.
+
+import multiprocessing as mp
+import os
+
+import numpy as np
+import networkx as nx
+from pyproj import Transformer
+
+
+def _default_clean_func():
+    import GOSTnets as gn
+    return gn.clean_network
+
+
+def _projected_xy(nodes, data, WGS, UTM):
+    # node x / y (graph CRS) -> UTM arrays
+    x = np.array([data[n]['x'] for n in nodes], dtype = float)
+    y = np.array([data[n]['y'] for n in nodes], dtype = float)
+    return Transformer.from_crs(WGS, UTM, always_xy = True).transform(x, y)
+
+
+def _cell(x, y, grid):
+    # tile core holding each point, clamped to the grid
+    minx, miny, tile_size, nx_, ny_ = grid
+    i = np.clip(np.floor((np.asarray(x) - minx) / tile_size).astype(int), 0, nx_ - 1)
+    j = np.clip(np.floor((np.asarray(y) - miny) / tile_size).astype(int), 0, ny_ - 1)
+    return i, j
+
+
+# state shared with tile worker processes, inherited on fork or sent once per worker
+_clean_state = {}
+
+
+def _init_clean_worker(state):
+    if state is not None:
+        _clean_state.update(state)
+
+
+def _clean_tile(tile):
+    st = _clean_state
+    tile_id, (ti, tj), nodes = tile
+    sub = st['G'].subgraph(nodes).copy()
+    if sub.number_of_edges() == 0:
+        return tile_id, [], {}, 0
+
+    C = st['clean_func'](sub, st['wpath'], '%s_tile%d' % (st['output_file_name'], tile_id), st['UTM'], st['WGS'],
+                         st['junctdist'], verbose = False)
+
+    c_nodes = list(C.nodes())
+    cx, cy = _projected_xy(c_nodes, C.nodes, st['WGS'], st['UTM'])
+    pos = {n: (cx[k], cy[k]) for k, n in enumerate(c_nodes)}
+
+    edges = list(C.edges(keys = True, data = True)) if C.is_multigraph() else \
+        [(u, v, 0, d) for u, v, d in C.edges(data = True)]
+    if len(edges) == 0:
+        return tile_id, [], {}, 0
+    mx = np.array([(pos[u][0] + pos[v][0]) / 2. for u, v, _, _ in edges])
+    my = np.array([(pos[u][1] + pos[v][1]) / 2. for u, v, _, _ in edges])
+    ei, ej = _cell(mx, my, st['grid'])
+    owned = np.flatnonzero((ei == ti) & (ej == tj))
+
+    # nodes cut off by the tile extent have fewer edges here than in the full graph; owned edges ending there
+    # mean the overlap is shorter than the segment
+    G = st['G']
+    cut = set(n for n in sub.nodes() if sub.degree(n) < G.degree(n))
+    kept = [edges[k] for k in owned]
+    n_cut = sum(1 for u, v, _, _ in kept if u in cut or v in cut)
+
+    used = set(u for u, _, _, _ in kept) | set(v for _, v, _, _ in kept)
+    # original nodes surviving the cleaning are told apart from the new junction nodes here, by the tile input
+    node_data = {n: (dict(C.nodes[n]), pos[n], n in sub) for n in used}
+    return tile_id, kept, node_data, n_cut
+
+
+def clean_network_tiled(G, wpath, output_file_name, UTM, WGS, junctdist, tile_size = 50000, overlap = 5000,
+                        n_workers = None, clean_func = None, verbose = False, stitch_tol = 1.):
+    """
+    Function for cleaning a network tile by tile across a process pool
+
+    same inputs and output as gn.clean_network, plus the tiling.
+
+    :param G: the network graph, nodes with x / y in WGS
+    :param wpath: write path handed to the clean function (one output name per tile)
+    :param output_file_name: output name, tiles are written as <name>_tile<n>
+    :param UTM: projected CRS in meters, e.g. {'init': 'epsg:32629'}
+    :param WGS: CRS of the node coordinates, e.g. {'init': 'epsg:4326'}
+    :param junctdist: junction simplification distance handed to the clean function
+    :param tile_size: tile edge in meters
+    :param overlap: distance in meters the tiles are extended by on every side before cleaning
+    :param n_workers: number of worker processes, defaults to os.cpu_count()
+    :param clean_func: cleaning function with the signature of gn.clean_network, defaults to it
+    :param verbose: print the tiling and stitching summary
+    :param stitch_tol: distance in meters within which nodes created by the cleaning in different tiles are taken
+                       as the same node. Original node IDs are matched on the ID whatever the tolerance
+    :returns: the cleaned MultiDiGraph
+    """
+    clean_func = clean_func or _default_clean_func()
+
+    nodes = list(G.nodes())
+    X, Y = _projected_xy(nodes, G.nodes, WGS, UTM)
+    minx, miny = X.min(), Y.min()
+    nx_ = max(1, int(np.ceil((X.max() - minx) / tile_size)))
+    ny_ = max(1, int(np.ceil((Y.max() - miny) / tile_size)))
+    grid = (minx, miny, float(tile_size), nx_, ny_)
+
+    # every node goes to the tiles whose extended extent holds it
+    tiles = []
+    lo_i, lo_j = _cell(X - overlap, Y - overlap, grid)
+    hi_i, hi_j = _cell(X + overlap, Y + overlap, grid)
+    members = {}
+    for k in range(len(nodes)):
+        for i in range(lo_i[k], hi_i[k] + 1):
+            for j in range(lo_j[k], hi_j[k] + 1):
+                members.setdefault((i, j), []).append(nodes[k])
+    for tile_id, cell in enumerate(sorted(members)):
+        tiles.append((tile_id, cell, members[cell]))
+    if verbose:
+        print('%d tiles of %d m with %d m overlap' % (len(tiles), tile_size, overlap))
+
+    state = dict(G = G, clean_func = clean_func, wpath = wpath, output_file_name = output_file_name, UTM = UTM,
+                 WGS = WGS, junctdist = junctdist, grid = grid)
+
+    n_workers = n_workers or os.cpu_count() or 1
+    if n_workers == 1 or len(tiles) == 1:
+        _clean_state.update(state)
+        try:
+            results = [_clean_tile(t) for t in tiles]
+        finally:
+            _clean_state.clear()
+    else:
+        if 'fork' in mp.get_all_start_methods():
+            ctx = mp.get_context('fork')
+            _clean_state.update(state)
+            initargs = (None,)
+        else:
+            ctx = mp.get_context()
+            initargs = (state,)
+        try:
+            # biggest tiles first so the pool is not left waiting on one large tile at the end
+            order = sorted(tiles, key = lambda t: -len(t[2]))
+            with ctx.Pool(min(n_workers, len(tiles)), initializer = _init_clean_worker,
+                          initargs = initargs) as pool:
+                results = sorted(pool.imap_unordered(_clean_tile, order), key = lambda r: r[0])
+        finally:
+            _clean_state.clear()
+
+    return _stitch(results, stitch_tol, verbose = verbose)
+
+
+def _stitch(results, tol, verbose = False):
+    # merge the owned edges of every tile. Original nodes keep their ID. A node made by the cleaning takes the
+    # name of the nearest new node of another tile within tol, else a new name; new nodes of one tile are distinct
+    # nodes, so two of them are never merged. New nodes are renumbered new_obj_<n> across the whole network.
+    tol = float(tol)
+    cells = {}      # (i, j) grid cell of size tol -> names of the new nodes in it
+    new_xy = {}     # name -> position
+    new_tiles = {}  # name -> tiles holding it
+    out = nx.MultiDiGraph()
+    n_cut = 0
+
+    def _name(n, xy, original, tile_id):
+        if original:
+            return n
+        # tol 0 never matches, every new node of every tile is kept as its own node
+        ci, cj = (int(np.floor(xy[0] / tol)), int(np.floor(xy[1] / tol))) if tol > 0 else (0, 0)
+        best, best_d = None, np.inf
+        if tol > 0:
+            for i in (ci - 1, ci, ci + 1):
+                for j in (cj - 1, cj, cj + 1):
+                    for name in cells.get((i, j), ()):
+                        if tile_id in new_tiles[name]:
+                            continue
+                        d = np.hypot(new_xy[name][0] - xy[0], new_xy[name][1] - xy[1])
+                        if d <= tol and d < best_d:
+                            best, best_d = name, d
+        if best is None:
+            best = 'new_obj_%d' % len(new_xy)
+            new_xy[best] = xy
+            new_tiles[best] = set()
+            cells.setdefault((ci, cj), []).append(best)
+        new_tiles[best].add(tile_id)
+        return best
+
+    for tile_id, kept, node_data, cut in results:
+        n_cut += cut
+        rename = {}
+        for n, (data, xy, original) in node_data.items():
+            rename[n] = _name(n, xy, original, tile_id)
+            if rename[n] not in out:
+                out.add_node(rename[n], **data)
+        for u, v, _, data in kept:
+            out.add_edge(rename[u], rename[v], **data)
+
+    if verbose:
+        print('stitched: %d nodes, %d edges' % (out.number_of_nodes(), out.number_of_edges()))
+    if n_cut:
+        print('%d edges end at a tile edge, consider a larger overlap' % n_cut)
+    return out
+
+
+def _clean_country(country, G, wpath, UTM, WGS, junctdist, tile_size, overlap, clean_func, n_workers = 1):
+    if tile_size is None:
+        return country, (clean_func or _default_clean_func())(G, wpath, country, UTM, WGS, junctdist,
+                                                              verbose = False)
+    return country, clean_network_tiled(G, wpath, country, UTM, WGS, junctdist, tile_size = tile_size,
+                                        overlap = overlap, n_workers = n_workers, clean_func = clean_func)
+
+
+def clean_countries(graphs, wpath, UTMs, WGS, junctdist, n_workers = None, tile_size = None, overlap = 5000,
+                    clean_func = None):
+    """
+    Function for cleaning several countries concurrently, one process per country
+
+    :param graphs: dict of country code: network graph, e.g. {'MAR': G}
+    :param wpath: write path handed to the clean function
+    :param UTMs: dict of country code: UTM EPSG code, e.g. UTMZs
+    :param WGS: CRS of the node coordinates
+    :param junctdist: junction simplification distance
+    :param n_workers: number of worker processes, defaults to one per country up to os.cpu_count()
+    :param tile_size: if set, every country is cleaned tile by tile (in its own process, or across the pool
+                      when there is only one country)
+    :param overlap: tile overlap in meters, see clean_network_tiled
+    :param clean_func: cleaning function with the signature of gn.clean_network, defaults to it
+    :returns: dict of country code: cleaned graph
+    """
+    jobs = [(c, G, wpath, {'init': 'epsg:%d' % UTMs[c]}, WGS, junctdist, tile_size, overlap, clean_func)
+            for c, G in graphs.items()]
+    n_workers = n_workers or os.cpu_count() or 1
+    if len(jobs) == 1:
+        # one country: its tiles get the whole pool
+        return dict([_clean_country(*jobs[0], n_workers = n_workers)])
+    n_workers = min(n_workers, len(jobs))
+    if n_workers == 1:
+        return dict(_clean_country(*job) for job in jobs)
+    with mp.get_context().Pool(n_workers) as pool:
+        return dict(pool.starmap(_clean_country, jobs))
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Morocco Accessibility Model: walking model (phases 5-7)
+#
+# villages far from the road network are not attached to their nearest node at zero cost. Each far village
+# becomes its own node, joined to its k nearest road nodes by walking connector edges whose time comes from
+# the walking distance (optionally scaled by a terrain friction surface). Connectors are found in one batched
+# query of the snap index and appended to the compiled graph arrays in one step, instead of adding edges
+# one by one to the networkx graph.
+
+import numpy as np
+from pyproj import Transformer
+
+from csr_graph import from_edge_arrays
+
+
+def add_walk_connectors(G, villages, snap_idx, min_dist = 5000, walk_speed = 5, k = 3, friction_fil = None,
+                        graph_crs = 'epsg:4326', node_col = 'NN', dist_col = 'NN_dist'):
+    """
+    Function for building the combined walk + drive graph
+
+    :param G: the compiled drive graph (CSRGraph), travel times in seconds
+    :param villages: villages GeoDataFrame snapped with snap_idx (NN / NN_dist columns)
+    :param snap_idx: a snap_index.SnapIndex over the nodes of G
+    :param min_dist: villages further than this from the network (meters) get walking connectors
+    :param walk_speed: walking speed in km/h
+    :param k: number of road nodes each far village is connected to
+    :param friction_fil: optional raster of walking-time multipliers (1 = flat terrain), sampled at the villages
+    :param graph_crs: CRS of the node coordinates of G, used for the coordinates of the new village nodes
+    :param node_col: villages column holding the snapped node, updated for far villages
+    :param dist_col: villages column holding the snap distance
+    :returns: the combined CSRGraph and a copy of villages where far villages point (node_col) to their own
+              node, with 'walk_dist' (meters) and 'walk_time' (seconds) to the nearest connected road node
+    """
+    villages = villages.copy()
+    villages['walk_dist'] = 0.
+    villages['walk_time'] = 0.
+
+    far = np.asarray(villages[dist_col].values > min_dist)
+    n_far = int(far.sum())
+    if n_far == 0:
+        return G, villages
+
+    pts = villages.geometry[far]
+    if villages.crs is not None:
+        pts = pts.to_crs(snap_idx.crs)
+    xy = np.column_stack([pts.x.values, pts.y.values])
+
+    # k nearest road nodes of every far village in one query
+    dist, idx = snap_idx.tree.query(xy, k = k)
+    dist = dist.reshape(n_far, -1)
+    idx = idx.reshape(n_far, -1)
+    valid = idx < len(snap_idx.node_ids)
+    targets = np.full(idx.shape, -1, dtype = np.int64)
+    targets[valid] = G.index(snap_idx.node_ids[idx[valid]].tolist())
+    valid &= targets >= 0
+
+    walk_time = dist / (walk_speed / 3.6)
+    if friction_fil is not None:
+        import rasterio
+        with rasterio.open(friction_fil) as src:
+            fxy = xy
+            if src.crs is not None and src.crs != snap_idx.crs:
+                fxy = np.column_stack(Transformer.from_crs(snap_idx.crs, src.crs, always_xy = True)
+                                      .transform(xy[:, 0], xy[:, 1]))
+            friction = np.array([v[0] for v in src.sample(fxy)], dtype = float)
+        walk_time = walk_time * np.where(np.isfinite(friction) & (friction > 0), friction, 1.)[:, None]
+
+    # new village nodes after the existing ones, with IDs that cannot clash with OSM node IDs, nor with the
+    # connectors of an earlier call when G already has walking connectors
+    if G.node_ids.dtype.kind in 'iu':
+        start = min(0, int(G.node_ids.min())) if G.n_nodes else 0
+        new_ids = start - np.arange(1, n_far + 1, dtype = np.int64)
+    else:
+        used = [int(n[5:]) for n in G.node_ids.tolist() if isinstance(n, str) and n[:5] == 'walk_' and n[5:].isdigit()]
+        start = max(used) + 1 if used else 0
+        new_ids = np.array(['walk_%d' % i for i in range(start, start + n_far)], dtype = object)
+    new_idx = G.n_nodes + np.arange(n_far)
+
+    rows, cols = np.nonzero(valid)
+    u_walk = new_idx[rows]
+    v_walk = targets[rows, cols]
+    w_walk = walk_time[rows, cols]
+
+    u = np.concatenate([np.repeat(np.arange(G.n_nodes), np.diff(G.indptr)), u_walk, v_walk])
+    v = np.concatenate([G.indices, v_walk, u_walk])
+    w = np.concatenate([G.weights, w_walk, w_walk])
+
+    node_ids = np.concatenate([G.node_ids.astype(new_ids.dtype), new_ids])
+    x = y = None
+    if G.x is not None:
+        nx_, ny_ = Transformer.from_crs(snap_idx.crs, graph_crs, always_xy = True).transform(xy[:, 0], xy[:, 1])
+        x = np.concatenate([G.x, nx_])
+        y = np.concatenate([G.y, ny_])
+
+    G_walk = from_edge_arrays(node_ids, u, v, w, x = x, y = y)
+
+    nearest = np.where(valid, dist, np.inf).min(axis = 1)
+    nearest_time = np.where(valid, walk_time, np.inf).min(axis = 1)
+    far_index = villages.index[far]
+    villages[node_col] = villages[node_col].astype(object)
+    villages.loc[far_index, node_col] = new_ids
+    villages.loc[far_index, 'walk_dist'] = nearest
+    villages.loc[far_index, 'walk_time'] = nearest_time
+
+    return G_walk, villages